@@ -0,0 +1 @@
+"""Benchmarks for the pipeline stages on synthetic APOGEE-like data."""
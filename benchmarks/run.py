@@ -0,0 +1,412 @@
+"""
+Time the pipeline stages on synthetic data (see `benchmarks.synthetic`) on a
+single machine. Run this from the root of the repository with::
+
+    python3 -m benchmarks.run -v
+
+The synthetic runs (with 1k, 10k, and 100k allStar sources by default) are
+made in ``cache/benchmarks/`` the first time, and reused after that. Each
+benchmark is timed ``--repeat`` times, and the best time is kept:
+
+- ``parent_sample``: the parent sample cuts on the allStar and allVisit
+  columns (`vacpipe.parent_sample.get_parent_sample_mask`)
+- ``assemble``: the join of the metadata with allStar and the masses
+  (`vacpipe.assemble.assemble_metadata`)
+- ``catalog_cuts``: the gold sample and binary catalog selections from the
+  catalog notebooks, including the join with the percentile table
+- ``percentiles``: percentiles of the posterior samples of all sources
+  (`vacpipe.percentiles.get_percentile_table`)
+- ``masses``: the minimum companion masses of all sources, in one task
+  (``worker`` in ``catalog-helpers/starhorse/make_masses.py``)
+- ``plot_diagnostic`` and ``plot_diagnostic_fast``: the diagnostic plots
+  (``plots/make_unimodal.py``) for ``--n-plots`` sources, saved to memory
+
+The times are written to ``cache/benchmarks/results-<date>.json`` and compared
+with the baseline file (``benchmarks/baseline.json``, recorded on the same
+machine): benchmarks that are more than ``--tolerance`` slower than the
+baseline are reported as regressions, and the exit status is 1. If there is no
+baseline file yet, or with ``--save-baseline``, the times are saved as the new
+baseline.
+"""
+
+# Standard library
+import argparse
+import datetime
+import gc
+import importlib.util
+import io
+import json
+import logging
+import os
+import pathlib
+import platform
+import sys
+import time
+
+# Third-party
+import astropy.table as at
+import numpy as np
+from threadpoolctl import threadpool_limits
+import yaml
+
+# Project
+from hq.config import Config
+from hq.log import logger
+from vacpipe.assemble import assemble_metadata, take_rows
+from vacpipe.catalogs import get_row_index, lookup_rows, read_fits_columns
+from vacpipe.parent_sample import (allstar_colnames, allvisit_cut_colnames,
+                                   get_parent_sample_mask)
+from vacpipe import percentiles
+from vacpipe.samples import SamplesReader
+from .synthetic import make_synthetic_run, repo_path
+
+default_data_path = repo_path / 'cache' / 'benchmarks'
+default_baseline_file = repo_path / 'benchmarks' / 'baseline.json'
+
+default_sizes = [1_000, 10_000, 100_000]
+
+# Helper scripts that are not importable as modules, loaded by filename
+_scripts = {}
+
+
+def load_script(filename):
+    filename = str(filename)
+    if filename not in _scripts:
+        name = pathlib.Path(filename).stem
+        spec = importlib.util.spec_from_file_location(name, filename)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _scripts[filename] = module
+    return _scripts[filename]
+
+
+def get_make_masses():
+    return load_script(repo_path / 'catalog-helpers' / 'starhorse' /
+                       'make_masses.py')
+
+
+def get_make_unimodal():
+    # Render off-screen, as on the cluster:
+    import matplotlib
+    matplotlib.use('agg')
+    return load_script(repo_path / 'plots' / 'make_unimodal.py')
+
+
+class SyntheticRun:
+    """
+    The inputs of the benchmarks for one synthetic run, loaded (once) when
+    they are first needed.
+    """
+
+    def __init__(self, run_path, n_plots=8):
+        self.run_path = pathlib.Path(run_path)
+        self.conf = Config(self.run_path / 'config.yml')
+        with open(self.run_path / 'parent-sample.yml', 'r') as f:
+            self.cuts = yaml.safe_load(f)
+
+        self.n_plots = n_plots
+        self.column_cache_path = self.run_path / 'catalog-columns'
+        self.metadata = at.QTable.read(self.conf.metadata_file)
+        self.masses = at.QTable.read(self.run_path /
+                                     'starhorse_mass_m2_min.fits')
+        self._assembled = None
+        self._percentile_table = None
+
+    def read_columns(self, filename, colnames=None):
+        return read_fits_columns(filename, colnames,
+                                 cache_path=self.column_cache_path)
+
+    def get_allstar(self):
+        return self.read_columns(self.cuts['allstar_file'])
+
+    def get_allstar_index(self):
+        return get_row_index(self.cuts['allstar_file'],
+                             cache_path=self.column_cache_path)
+
+    def get_assembled(self):
+        if self._assembled is None:
+            self._assembled, _ = assemble_metadata(
+                self.metadata, self.get_allstar(), self.get_allstar_index(),
+                self.masses)
+        return self._assembled
+
+    def get_percentile_table(self):
+        if self._percentile_table is None:
+            self._percentile_table = get_percentile_table(self)
+        return self._percentile_table
+
+
+def get_percentile_table(run):
+    tbl = run.metadata
+    with SamplesReader(run.conf) as reader:
+        return percentiles.get_percentile_table(
+            reader, tbl['APOGEE_ID'], np.asarray(tbl['mcmc_completed']),
+            percentiles.percentiles, percentiles.params)
+
+
+def bench_parent_sample(run):
+    allstar = run.read_columns(run.cuts['allstar_file'], allstar_colnames)
+    allvisit = run.read_columns(run.cuts['allvisit_file'],
+                                allvisit_cut_colnames)
+    verr_ids = run.read_columns(run.cuts['calib_verr_file'],
+                                ['VISIT_ID'])['VISIT_ID']
+
+    def func():
+        get_parent_sample_mask(allstar, allvisit, verr_ids, run.cuts)
+    return func, len(allvisit)
+
+
+def bench_assemble(run):
+    allstar = run.get_allstar()
+    allstar_index = run.get_allstar_index()
+
+    def func():
+        assemble_metadata(run.metadata, allstar, allstar_index, run.masses)
+    return func, len(run.metadata)
+
+
+def bench_catalog_cuts(run):
+    meta = run.get_assembled()
+    tbl = run.get_percentile_table()
+    pct = percentiles.percentiles
+
+    def func():
+        # notebooks/pipeline/3-Make-gold-sample.ipynb
+        mask = ((meta['n_visits'] > 5) &
+                (meta['mcmc_status'] <= 2) &
+                (meta['mcmc_completed']) &
+                (meta['LOGG'] > 1) &
+                (meta['phase_coverage'] > 0.25) &
+                (meta['max_phase_gap'] < 0.5))
+        meta[mask]
+
+        # notebooks/pipeline/4-Make-binary-catalogs.ipynb
+        row_idx = {str(apid).strip(): i
+                   for i, apid in enumerate(tbl['APOGEE_ID'])}
+        percentiles_tbl = tbl[[row_idx[str(apid).strip()]
+                               for apid in meta['APOGEE_ID']]]
+        K_lenient = percentiles_tbl['K'][:, pct.index(5)] > 1
+        K_strict = percentiles_tbl['K'][:, pct.index(1)] > 1
+        llr_const = (meta['max_unmarginalized_ln_likelihood'] -
+                     meta['robust_constant_ln_likelihood'])
+        meta[K_strict & (llr_const > 8)]
+        meta[K_lenient & (llr_const > 4)]
+    return func, len(meta)
+
+
+def bench_percentiles(run):
+    def func():
+        get_percentile_table(run)
+    return func, len(run.metadata)
+
+
+def bench_masses(run):
+    # The same inputs as make_masses.main, from the synthetic StarHorse file:
+    starhorse_file = run.run_path / 'starhorse-synthetic.fits'
+    sh = run.read_columns(starhorse_file, ['mass16', 'mass50', 'mass84'])
+    sh_idx = lookup_rows(
+        get_row_index(starhorse_file, cache_path=run.column_cache_path),
+        np.char.strip(np.asarray(run.metadata['APOGEE_ID'], dtype=str)))
+    meta_sh = at.QTable(run.metadata)
+    meta_sh.add_columns(list(take_rows(sh, sh_idx).columns.values()))
+    meta_sh['mass1'] = meta_sh['mass50']
+    meta_sh['mass1_err'] = np.max([meta_sh['mass1'] - meta_sh['mass16'],
+                                   meta_sh['mass84'] - meta_sh['mass1']],
+                                  axis=0)
+
+    worker = get_make_masses().worker
+    task = {'conf': run.conf,
+            'metadata': meta_sh,
+            'seed': np.random.SeedSequence(42)}
+
+    def func():
+        worker(task)
+    return func, len(meta_sh)
+
+
+def _get_plot_rows(run):
+    meta = run.get_assembled()
+    good = meta[(meta['mcmc_status'] <= 2) & (meta['mcmc_completed'])]
+    return good[:run.n_plots]
+
+
+def _get_cmd_cache(run, make_unimodal):
+    cmd_cache_file = run.run_path / 'cmd-cache.npz'
+    if not cmd_cache_file.exists():
+        make_unimodal.make_cmd_cache(
+            run.read_columns(run.cuts['allstar_file'],
+                             make_unimodal.allstar_plot_colnames),
+            cmd_cache_file)
+    return make_unimodal.load_cmd_cache(cmd_cache_file)
+
+
+def bench_plot_diagnostic(run):
+    make_unimodal = get_make_unimodal()
+    plt = make_unimodal.plt
+    cmd_cache = _get_cmd_cache(run, make_unimodal)
+    rows = _get_plot_rows(run)
+
+    def func():
+        for row in rows:
+            fig = make_unimodal.plot_diagnostic(run.conf, row, cmd_cache)
+            fig.savefig(io.BytesIO(), format='png', dpi=200)
+            plt.close(fig)
+    return func, len(rows)
+
+
+def bench_plot_diagnostic_fast(run):
+    make_unimodal = get_make_unimodal()
+    cmd_cache = _get_cmd_cache(run, make_unimodal)
+    rows = _get_plot_rows(run)
+    diagnostic_figure = make_unimodal.get_diagnostic_figure(cmd_cache)
+
+    def func():
+        for row in rows:
+            fig = diagnostic_figure.update(
+                row, make_unimodal.get_plot_data(run.conf, row))
+            fig.savefig(io.BytesIO(), format='png', dpi=200)
+    return func, len(rows)
+
+
+benchmarks = {
+    'parent_sample': bench_parent_sample,
+    'assemble': bench_assemble,
+    'catalog_cuts': bench_catalog_cuts,
+    'percentiles': bench_percentiles,
+    'masses': bench_masses,
+    'plot_diagnostic': bench_plot_diagnostic,
+    'plot_diagnostic_fast': bench_plot_diagnostic_fast
+}
+
+
+def time_benchmark(func, repeat):
+    """The best time out of ``repeat`` calls of ``func``."""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def get_machine_info():
+    return {'platform': platform.platform(),
+            'processor': platform.processor(),
+            'n_cpu': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Log the ratio of each time to the baseline time, and return the names of
+    the benchmarks that are more than ``tolerance`` slower.
+    """
+    if baseline['machine'] != results['machine']:
+        logger.warn('The baseline was recorded on a different machine or '
+                    'environment: times may not be comparable')
+
+    regressions = []
+    for name, sizes in results['results'].items():
+        for size, res in sizes.items():
+            base = baseline['results'].get(name, {}).get(size)
+            if base is None:
+                logger.info(f'{name} [{size}]: {res["time"]:.3f} sec (no '
+                            'baseline)')
+                continue
+
+            ratio = res['time'] / base['time']
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = '  REGRESSION'
+                regressions.append(f'{name} [{size}]')
+            logger.info(f'{name} [{size}]: {res["time"]:.3f} sec, '
+                        f'{ratio:.2f}x baseline{flag}')
+    return regressions
+
+
+def main(sizes, names, data_path, baseline_file, repeat=3, n_plots=8,
+         tolerance=0.2, save_baseline=False):
+    data_path = pathlib.Path(data_path)
+    baseline_file = pathlib.Path(baseline_file)
+
+    results = {'machine': get_machine_info(),
+               'date': datetime.datetime.now().strftime('%Y%m%dT%H%M%S'),
+               'repeat': repeat,
+               'results': {name: {} for name in names}}
+
+    for size in sizes:
+        run = SyntheticRun(make_synthetic_run(data_path, size),
+                           n_plots=n_plots)
+        for name in names:
+            func, n = benchmarks[name](run)
+            t = time_benchmark(func, repeat)
+            results['results'][name][str(size)] = {
+                'time': t, 'n': n, 'per_item': t / max(n, 1)}
+            logger.debug(f'{name} [{size}]: {t:.3f} sec for {n} items')
+
+    data_path.mkdir(parents=True, exist_ok=True)
+    results_file = data_path / f"results-{results['date']}.json"
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f'Wrote results to {results_file!s}')
+
+    if save_baseline or not baseline_file.exists():
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f'Saved the baseline to {baseline_file!s}')
+        return []
+
+    with open(baseline_file, 'r') as f:
+        baseline = json.load(f)
+    return compare(results, baseline, tolerance)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("-v", "--verbose", dest="verbose", default=False,
+                        action="store_true", help="Verbose logging")
+    parser.add_argument("--sizes", dest="sizes", default=default_sizes,
+                        type=int, nargs='+',
+                        help="Numbers of allStar sources in the synthetic "
+                             "runs")
+    parser.add_argument("--only", dest="names", default=list(benchmarks),
+                        choices=list(benchmarks), nargs='+',
+                        help="Only run these benchmarks")
+    parser.add_argument("--repeat", dest="repeat", default=3, type=int,
+                        help="Number of times to run each benchmark")
+    parser.add_argument("--n-plots", dest="n_plots", default=8, type=int,
+                        help="Number of sources to make diagnostic plots of")
+    parser.add_argument("--tolerance", dest="tolerance", default=0.2,
+                        type=float,
+                        help="Fractional slowdown reported as a regression")
+    parser.add_argument("--data-path", dest="data_path",
+                        default=default_data_path, type=pathlib.Path,
+                        help="Where to make the synthetic runs")
+    parser.add_argument("--baseline", dest="baseline_file",
+                        default=default_baseline_file, type=pathlib.Path,
+                        help="The baseline file to compare with")
+    parser.add_argument("--save-baseline", dest="save_baseline",
+                        default=False, action="store_true",
+                        help="Save the times as the new baseline")
+    args = parser.parse_args(sys.argv[1:])
+
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    with threadpool_limits(limits=1, user_api='blas'):
+        regressions = main(sizes=args.sizes,
+                           names=args.names,
+                           data_path=args.data_path,
+                           baseline_file=args.baseline_file,
+                           repeat=args.repeat,
+                           n_plots=args.n_plots,
+                           tolerance=args.tolerance,
+                           save_baseline=args.save_baseline)
+
+    if regressions:
+        logger.warn(f'{len(regressions)} regressions: '
+                    + ', '.join(regressions))
+        sys.exit(1)
+
+    sys.exit(0)
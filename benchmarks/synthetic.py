@@ -0,0 +1,485 @@
+"""
+Synthetic APOGEE-like inputs and HQ outputs for the benchmarks.
+
+`make_synthetic_run` writes a self-contained run directory with stand-ins for
+all of the files that the pipeline stages read:
+
+- allStar, allVisit, calibrated visit error, and StarHorse FITS files, with
+  the columns that the pipeline uses
+- ``config.yml`` and ``parent-sample.yml`` (copied from ``hq-config/``, with
+  the paths pointing into the run directory), and the parent sample visit
+  file made from them by `vacpipe.parent_sample`
+- the HQ metadata file and the Joker and MCMC result files in ``cache/``
+- the primary and minimum companion mass table that
+  ``catalog-helpers/starhorse/make_masses.py`` makes
+
+The number of visits and posterior samples per source follow the shape of the
+DR17 run: most sources have a few visits, with a long tail of sources in
+fields that were observed many times, and most sources have full Joker
+samplings, some are multimodal, and about 10% are unimodal with MCMC samples.
+To keep the 100k source runs within a laptop's disk and memory, there are
+fewer samples per source than in the run configuration (``n_joker_samples``
+and ``n_mcmc_samples``). All samples share the same reference time.
+"""
+
+# Standard library
+import json
+import pathlib
+
+# Third-party
+import astropy.table as at
+from astropy.time import Time
+import astropy.units as u
+import h5py
+import numpy as np
+import yaml
+
+# Project
+from hq.log import logger
+from vacpipe import parent_sample
+
+__all__ = ['make_synthetic_run']
+
+repo_path = pathlib.Path(__file__).resolve().parent.parent
+hq_config_path = repo_path / 'hq-config'
+
+# Increment this when the synthetic files change, so that existing runs are
+# remade:
+synthetic_version = 1
+
+sample_units = {
+    'P': u.day,
+    'e': u.one,
+    'omega': u.rad,
+    'M0': u.rad,
+    's': u.km/u.s,
+    'K': u.km/u.s,
+    'v0': u.km/u.s,
+    'ln_prior': u.one,
+    'ln_likelihood': u.one
+}
+sample_dtype = np.dtype([(name, 'f8') for name in sample_units])
+
+mass_percentiles = [1, 5, 16, 50, 84, 95, 99]
+
+# Period range of the prior (see hq-config/prior.py):
+P_min = 1.5
+P_max = 16384.
+
+
+def get_run_path(data_path, n_sources):
+    return pathlib.Path(data_path) / f'synthetic-{n_sources}'
+
+
+def make_apogee_ids(rng, n):
+    """Unique, sorted 2MASS-style IDs at random positions."""
+    ids = np.array([], dtype=str)
+    while len(ids) < n:
+        m = n - len(ids)
+        ra = rng.integers(0, 24 * 3600 * 100, m)  # RA in 0.01 sec
+        dec = rng.integers(-90 * 3600 * 10, 90 * 3600 * 10, m)  # 0.1 arcsec
+        new_ids = [
+            f'2M{r // 360000:02d}{r // 6000 % 60:02d}{r % 6000:04d}'
+            f'{"+" if d >= 0 else "-"}{abs(d) // 36000:02d}'
+            f'{abs(d) // 600 % 60:02d}{abs(d) % 600:03d}'
+            for r, d in zip(ra, dec)]
+        ids = np.unique(np.concatenate((ids, new_ids)))
+    return ids
+
+
+def get_n_visits(rng, n):
+    """
+    Visits per source: mostly one to a few, with a tail of sources that were
+    observed tens to hundreds of times.
+    """
+    n_visits = rng.geometric(0.3, size=n)
+    deep = rng.uniform(size=n) < 0.05
+    n_visits[deep] = 3 + rng.geometric(0.05, size=deep.sum())
+    very_deep = rng.uniform(size=n) < 0.005
+    n_visits[very_deep] = rng.integers(50, 200, size=very_deep.sum())
+    return n_visits
+
+
+def _loguniform(rng, lo, hi, size=None):
+    return np.exp(rng.uniform(np.log(lo), np.log(hi), size=size))
+
+
+def make_catalogs(run_path, n_sources, rng):
+    """
+    Write the allStar, allVisit, calibrated visit error, and StarHorse files.
+    """
+    ids = make_apogee_ids(rng, n_sources)
+    n_fields = max(1, n_sources // 250)
+    field = np.array([f'F{i:04d}' for i in range(n_fields)])[
+        rng.integers(0, n_fields, n_sources)]
+    telescope = np.where(rng.uniform(size=n_sources) < 0.7,
+                         'apo25m', 'lco25m')
+
+    # allStar: one row per source, plus a second row for sources observed
+    # from both telescopes, in no particular order
+    dup = np.flatnonzero(rng.uniform(size=n_sources) < 0.03)
+    star_idx = rng.permutation(np.concatenate((np.arange(n_sources), dup)))
+    n_star = len(star_idx)
+
+    allstar = at.Table()
+    allstar['APOGEE_ID'] = ids[star_idx]
+    allstar['TELESCOPE'] = telescope[star_idx]
+    allstar['FIELD'] = field[star_idx]
+    allstar['STARFLAG'] = np.where(rng.uniform(size=n_star) < 0.02,
+                                   2**3, 0).astype(np.int64)
+    allstar['STARFLAGS'] = np.where(allstar['STARFLAG'] > 0,
+                                    'VERY_BRIGHT_NEIGHBOR', '')
+    allstar['ASPCAPFLAG'] = np.where(rng.uniform(size=n_star) < 0.02,
+                                     2**23, 0).astype(np.int64)
+    allstar['ASPCAPFLAGS'] = np.where(allstar['ASPCAPFLAG'] > 0,
+                                      'STAR_BAD', '')
+    allstar['RV_FLAG'] = np.zeros(n_star, dtype=np.int32)
+    allstar['N_COMPONENTS'] = np.ones(n_star, dtype=np.int16)
+    allstar['SNR'] = np.exp(rng.normal(np.log(80), 0.7, n_star)).astype('f4')
+    giant = rng.uniform(size=n_star) < 0.6
+    allstar['TEFF'] = np.where(giant, rng.normal(4700, 300, n_star),
+                               rng.normal(5500, 700, n_star)).astype('f4')
+    allstar['LOGG'] = np.where(giant, rng.uniform(0.5, 3.5, n_star),
+                               rng.normal(4.3, 0.3, n_star)).astype('f4')
+    allstar['M_H'] = rng.normal(-0.2, 0.35, n_star).astype('f4')
+    allstar['VSINI'] = np.exp(rng.normal(1.5, 0.8, n_star)).astype('f4')
+    no_aspcap = rng.uniform(size=n_star) < 0.05
+    for name in ['TEFF', 'LOGG', 'M_H', 'VSINI']:
+        allstar[name][no_aspcap] = np.nan
+    allstar['J'] = rng.uniform(7, 14, n_star).astype('f4')
+    allstar['K'] = (allstar['J'] -
+                    rng.uniform(0.3, 1.2, n_star)).astype('f4')
+    no_2mass = rng.uniform(size=n_star) < 0.01
+    allstar['J'][no_2mass] = -9999.
+    allstar['K'][no_2mass] = -9999.
+    allstar['GAIAEDR3_PARALLAX'] = rng.lognormal(-1, 1, n_star).astype('f4')
+    allstar['GAIAEDR3_PARALLAX_ERROR'] = rng.uniform(
+        0.01, 0.1, n_star).astype('f4')
+    allstar.write(run_path / 'allStar-synthetic.fits', overwrite=True)
+
+    # allVisit: a true RV curve for the ~30% of sources that are binaries,
+    # sampled at clustered visit times
+    n_visits = get_n_visits(rng, n_sources)
+    visit_star = np.repeat(np.arange(n_sources), n_visits)
+    n_all = len(visit_star)
+
+    t0 = rng.uniform(2455800, 2459000, n_sources)
+    gaps = np.where(rng.uniform(size=n_all) < 0.5,
+                    rng.uniform(1, 4, n_all), rng.exponential(120, n_all))
+    offsets = np.concatenate(([0], np.cumsum(n_visits)))
+    gaps[offsets[:-1]] = 0.
+    cum_gaps = np.cumsum(gaps)
+    jd = t0[visit_star] + cum_gaps - cum_gaps[offsets[:-1]][visit_star]
+
+    binary = rng.uniform(size=n_sources) < 0.3
+    P = _loguniform(rng, P_min, P_max, n_sources)
+    K = np.where(binary, _loguniform(rng, 0.5, 50, n_sources), 0.)
+    v0 = rng.normal(0, 40, n_sources)
+    phase = rng.uniform(0, 2*np.pi, n_sources)
+    verr = np.exp(rng.normal(np.log(0.15), 0.8, n_all))
+    vhelio = (v0[visit_star] +
+              K[visit_star] * np.sin(2*np.pi * jd / P[visit_star] +
+                                     phase[visit_star]) +
+              rng.normal(0, 1, n_all) * verr)
+    vhelio[rng.uniform(size=n_all) < 0.01] = np.nan
+    bc = rng.uniform(-30, 30, n_all)
+    mjd = (jd - 2400000.5).astype(int)
+    plate = rng.integers(4000, 15000, n_all).astype(str)
+    fiber = rng.integers(1, 301, n_all)
+    visit_ids = np.char.add(np.char.add(np.char.add(
+        'apogee.', telescope[visit_star]), '.s.stars.'),
+        np.char.add(np.char.add(plate, '.'), np.char.add(
+            mjd.astype(str), np.char.add('.', ids[visit_star]))))
+
+    allvisit = at.Table()
+    allvisit['APOGEE_ID'] = ids[visit_star]
+    allvisit['TARGET_ID'] = np.char.add(
+        np.char.add(telescope[visit_star], '.'),
+        np.char.add(np.char.add(field[visit_star], '.'), ids[visit_star]))
+    allvisit['VISIT_ID'] = visit_ids
+    allvisit['FILE'] = np.char.add(
+        np.char.add('apVisit-dr17-', plate),
+        np.char.add(np.char.add('-', mjd.astype(str)), '.fits'))
+    allvisit['FIBERID'] = fiber.astype(np.int16)
+    allvisit['CARTID'] = rng.integers(1, 30, n_all).astype(np.int16)
+    allvisit['PLATE'] = plate
+    allvisit['MJD'] = mjd.astype(np.int32)
+    allvisit['TELESCOPE'] = telescope[visit_star]
+    allvisit['SURVEY'] = np.full(n_all, 'apogee2')
+    allvisit['FIELD'] = field[visit_star]
+    allvisit['SNR'] = np.exp(rng.normal(np.log(40), 0.7, n_all)).astype('f4')
+    allvisit['STARFLAG'] = np.where(rng.uniform(size=n_all) < 0.01,
+                                    2**3, 0).astype(np.int64)
+    allvisit['STARFLAGS'] = np.where(allvisit['STARFLAG'] > 0,
+                                     'VERY_BRIGHT_NEIGHBOR', '')
+    allvisit['JD'] = jd
+    allvisit['VREL'] = (vhelio - bc).astype('f4')
+    allvisit['VRELERR'] = verr.astype('f4')
+    allvisit['VHELIO'] = vhelio.astype('f4')
+    allvisit['AUTOFWHM'] = rng.uniform(15, 40, n_all).astype('f4')
+    allvisit['BC'] = bc.astype('f4')
+    allvisit['N_COMPONENTS'] = np.ones(n_all, dtype=np.int16)
+    allvisit['RV_FLAG'] = np.where(rng.uniform(size=n_all) < 0.01,
+                                   2**4, 0).astype(np.int32)
+    allvisit.write(run_path / 'allVisit-synthetic.fits', overwrite=True)
+
+    # Calibrated visit errors for almost all visits:
+    has_verr = rng.uniform(size=n_all) < 0.98
+    calib = at.Table()
+    calib['VISIT_ID'] = visit_ids[has_verr]
+    calib['CALIB_VERR'] = np.sqrt((1.3 * verr[has_verr])**2 + 0.05**2)
+    calib.write(run_path / 'allVisit-synthetic-calib-verr.fits',
+                overwrite=True)
+
+    # StarHorse masses for most sources:
+    has_mass = rng.uniform(size=n_sources) < 0.85
+    mass = np.exp(rng.normal(0.1, 0.35, has_mass.sum()))
+    frac_err = rng.uniform(0.03, 0.2, has_mass.sum())
+    starhorse = at.Table()
+    starhorse['APOGEE_ID'] = ids[has_mass]
+    starhorse['mass16'] = (mass * (1 - frac_err)).astype('f4')
+    starhorse['mass50'] = mass.astype('f4')
+    starhorse['mass84'] = (mass * (1 + frac_err)).astype('f4')
+    starhorse.write(run_path / 'starhorse-synthetic.fits', overwrite=True)
+
+
+def write_configs(run_path, n_joker_samples, n_mcmc_samples):
+    with open(hq_config_path / 'config.yml', 'r') as f:
+        conf = yaml.safe_load(f)
+    conf['name'] = run_path.name
+    conf['description'] = 'Synthetic run for the benchmarks'
+    conf['cache_path'] = str(run_path / 'cache')
+    conf['input_data_file'] = str(run_path /
+                                  'allVisit-synthetic-min3-calibverr.fits')
+    conf['prior_file'] = str(hq_config_path / 'prior.py')
+    conf['requested_samples_per_star'] = n_joker_samples
+    conf['mcmc_draw_steps'] = n_mcmc_samples // conf['mcmc_chains']
+    with open(run_path / 'config.yml', 'w') as f:
+        yaml.safe_dump(conf, f, sort_keys=False)
+
+    with open(hq_config_path / 'parent-sample.yml', 'r') as f:
+        cuts = yaml.safe_load(f)
+    cuts['allstar_file'] = str(run_path / 'allStar-synthetic.fits')
+    cuts['allvisit_file'] = str(run_path / 'allVisit-synthetic.fits')
+    cuts['calib_verr_file'] = str(run_path /
+                                  'allVisit-synthetic-calib-verr.fits')
+    cuts['output_file'] = conf['input_data_file']
+    with open(run_path / 'parent-sample.yml', 'w') as f:
+        yaml.safe_dump(cuts, f, sort_keys=False)
+
+    return conf
+
+
+def _draw_orbits(rng, n):
+    return {
+        'P': _loguniform(rng, P_min, P_max, n),
+        'e': rng.beta(0.867, 3.03, n),
+        'omega': rng.uniform(0, 2*np.pi, n),
+        'M0': rng.uniform(0, 2*np.pi, n),
+        's': rng.lognormal(-3.5, 1., n),
+        'K': rng.normal(0, 10., n),
+        'v0': rng.normal(0, 40., n),
+        'ln_prior': rng.normal(-10, 2, n),
+        'ln_likelihood': rng.normal(-20, 5, n)
+    }
+
+
+def _jitter_orbits(rng, MAP, n, scale):
+    """Samples around a MAP orbit, with relative widths set by ``scale``."""
+    return {
+        'P': MAP['P'] * (1 + scale * 1e-2 * rng.normal(size=n)),
+        'e': np.clip(MAP['e'] + scale * 0.02 * rng.normal(size=n), 0, 0.99),
+        'omega': MAP['omega'] + scale * 0.1 * rng.normal(size=n),
+        'M0': MAP['M0'] + scale * 0.1 * rng.normal(size=n),
+        's': np.abs(MAP['s'] + scale * 0.01 * rng.normal(size=n)),
+        'K': MAP['K'] * (1 + scale * 0.05 * rng.normal(size=n)),
+        'v0': MAP['v0'] + scale * 0.1 * rng.normal(size=n),
+        'ln_prior': MAP['ln_prior'] + rng.normal(size=n),
+        'ln_likelihood': MAP['ln_likelihood'] - rng.exponential(size=n)
+    }
+
+
+def _to_array(pars):
+    n = len(pars['P'])
+    arr = np.empty(n, dtype=sample_dtype)
+    for name in sample_units:
+        arr[name] = pars[name]
+    return arr
+
+
+class SamplesWriter:
+    """
+    Write per-source samples groups in the same layout as
+    ``JokerSamples.write``. The table metadata (units and reference time) is
+    the same for all sources, so it is serialized once by astropy and copied
+    to each group.
+    """
+
+    def __init__(self, filename, t_ref):
+        tbl = at.QTable()
+        for name, unit in sample_units.items():
+            tbl[name] = np.zeros(1) * unit
+        tbl.meta['t_ref'] = t_ref
+        tbl.meta['poly_trend'] = 1
+        tbl.meta['n_offsets'] = 0
+
+        with h5py.File('template.h5', 'w', driver='core',
+                       backing_store=False) as f:
+            tbl.write(f, path='samples', serialize_meta=True,
+                      maxshape=(None, ))
+            self.meta = f['samples.__table_column_meta__'][()]
+
+        self.f = h5py.File(filename, 'w')
+
+    def write(self, source_id, samples):
+        g = self.f.create_group(source_id)
+        g.create_dataset('samples', data=samples, maxshape=(None, ))
+        g.create_dataset('samples.__table_column_meta__', data=self.meta)
+
+    def close(self):
+        self.f.close()
+
+
+def make_hq_outputs(conf, n_joker_samples, n_mcmc_samples, rng):
+    """
+    Write the HQ metadata file and the Joker and MCMC result files for the
+    sources in the parent sample visit file.
+    """
+    cache_path = pathlib.Path(conf['cache_path'])
+    cache_path.mkdir(exist_ok=True)
+
+    visits = at.Table.read(conf['input_data_file'])
+    ids, n_visits = np.unique(np.asarray(visits['APOGEE_ID']),
+                              return_counts=True)
+    n = len(ids)
+
+    # Broad (full) Joker samplings, multimodal, and unimodal sources:
+    kind = rng.choice(3, size=n, p=[0.6, 0.3, 0.1])
+    n_samples = np.full(n, n_joker_samples)
+    n_samples[kind == 1] = _loguniform(rng, 2, n_joker_samples,
+                                       (kind == 1).sum()).astype(int)
+    n_samples[kind == 2] = rng.geometric(0.6, size=(kind == 2).sum())
+    unimodal = kind == 2
+    mcmc_completed = unimodal & (rng.uniform(size=n) < 0.95)
+    mcmc_status = np.where(mcmc_completed,
+                           rng.choice([1, 2, 3], size=n, p=[0.85, 0.1, 0.05]),
+                           0)
+
+    t_ref = Time(2457000, format='jd', scale='tcb')
+    MAP = _draw_orbits(rng, n)
+    joker_writer = SamplesWriter(cache_path / 'thejoker-samples.hdf5', t_ref)
+    mcmc_writer = SamplesWriter(cache_path / 'mcmc-samples.hdf5', t_ref)
+    try:
+        for i, source_id in enumerate(ids):
+            this_MAP = {name: vals[i] for name, vals in MAP.items()}
+            if kind[i] == 0:
+                pars = _draw_orbits(rng, n_samples[i])
+            elif kind[i] == 1:
+                modes = rng.integers(0, 4, n_samples[i])
+                pars = _jitter_orbits(rng, this_MAP, n_samples[i], 1.)
+                pars['P'] = pars['P'] * 2.**modes
+            else:
+                pars = _jitter_orbits(rng, this_MAP, n_samples[i], 0.1)
+            joker_writer.write(source_id, _to_array(pars))
+
+            if mcmc_completed[i]:
+                pars = _jitter_orbits(rng, this_MAP, n_mcmc_samples, 0.1)
+                mcmc_writer.write(source_id, _to_array(pars))
+    finally:
+        joker_writer.close()
+        mcmc_writer.close()
+
+    max_lnL = -0.5 * n_visits + rng.normal(0, 1, n)
+    llr = np.where(unimodal | (kind == 1), rng.exponential(50, n),
+                   rng.exponential(2, n))
+    phase_coverage = rng.uniform(0, 1, n)
+
+    meta = at.QTable()
+    meta['APOGEE_ID'] = ids
+    meta['n_visits'] = n_visits
+    meta['joker_completed'] = n_samples >= n_joker_samples
+    meta['unimodal'] = unimodal
+    meta['mcmc_completed'] = mcmc_completed
+    meta['mcmc_status'] = mcmc_status
+    for name in ['P', 'e', 'omega', 'M0', 's', 'K', 'v0']:
+        meta[f'MAP_{name}'] = MAP[name] * sample_units[name]
+    meta['max_unmarginalized_ln_likelihood'] = max_lnL
+    meta['robust_constant_ln_likelihood'] = max_lnL - llr
+    meta['robust_linear_ln_likelihood'] = (max_lnL - llr +
+                                           np.abs(rng.normal(0, 1, n)))
+    meta['gelman_rubin_max'] = np.where(
+        mcmc_completed, 1 + rng.lognormal(np.log(0.01), 1, n), np.nan)
+    meta['phase_coverage'] = phase_coverage
+    meta['max_phase_gap'] = rng.uniform(0, 1, n) * (1 - phase_coverage)
+    meta.write(cache_path / 'metadata.fits', overwrite=True)
+
+    return meta
+
+
+def make_mass_table(run_path, meta, rng):
+    """
+    The output of ``make_masses.py``: StarHorse primary masses and minimum
+    companion mass percentiles for the sources with StarHorse masses.
+    """
+    starhorse = at.Table.read(run_path / 'starhorse-synthetic.fits')
+    sh_ids = np.asarray(starhorse['APOGEE_ID'])
+    ids = np.asarray(meta['APOGEE_ID'])
+    i = np.clip(np.searchsorted(sh_ids, ids), 0, len(sh_ids) - 1)
+    has_mass = sh_ids[i] == ids
+    i = i[has_mass]
+
+    mass1 = np.asarray(starhorse['mass50'], dtype=float)[i]
+    mass1_err = np.max([
+        mass1 - np.asarray(starhorse['mass16'])[i],
+        np.asarray(starhorse['mass84'])[i] - mass1], axis=0)
+
+    tbl = at.QTable()
+    tbl['APOGEE_ID'] = ids[has_mass]
+    tbl['mass1_50'] = mass1 * u.Msun
+    tbl['mass1_err'] = mass1_err * u.Msun
+    m2_50 = rng.lognormal(-2, 1.5, len(tbl))
+    width = rng.uniform(0.1, 1, len(tbl))
+    z = [-2.33, -1.64, -1., 0., 1., 1.64, 2.33]
+    for pp, zz in zip(mass_percentiles, z):
+        tbl[f'mass2_min_{pp}'] = m2_50 * np.exp(zz * width) * u.Msun
+    tbl.write(run_path / 'starhorse_mass_m2_min.fits', overwrite=True)
+
+
+def make_synthetic_run(data_path, n_sources, seed=42, n_joker_samples=256,
+                       n_mcmc_samples=1000, overwrite=False):
+    """
+    Make (or reuse) a synthetic run directory with ``n_sources`` allStar
+    sources. About half of these pass the parent sample cuts, and so have HQ
+    outputs.
+
+    Returns
+    -------
+    run_path : `pathlib.Path`
+    """
+    run_path = get_run_path(data_path, n_sources)
+    info_file = run_path / 'synthetic.json'
+    info = {'n_sources': n_sources,
+            'seed': seed,
+            'n_joker_samples': n_joker_samples,
+            'n_mcmc_samples': n_mcmc_samples,
+            'version': synthetic_version}
+
+    if info_file.exists() and not overwrite:
+        with open(info_file, 'r') as f:
+            if json.load(f) == info:
+                return run_path
+    run_path.mkdir(parents=True, exist_ok=True)
+
+    logger.info(f'Making synthetic data with {n_sources} sources in '
+                f'{run_path!s}')
+    rng = np.random.default_rng(seed)
+    make_catalogs(run_path, n_sources, rng)
+    conf = write_configs(run_path, n_joker_samples, n_mcmc_samples)
+    parent_sample.main(run_path, overwrite=True)
+    meta = make_hq_outputs(conf, n_joker_samples, n_mcmc_samples, rng)
+    make_mass_table(run_path, meta, rng)
+
+    with open(info_file, 'w') as f:
+        json.dump(info, f, indent=2)
+
+    return run_path
@@ -4,109 +4,180 @@ import pathlib
 # Third-party
 import astropy.table as at
 import astropy.units as u
-import h5py
 import numpy as np
-import thejoker as tj
-from schwimmbad.utils import batch_tasks
 from scipy.stats import truncnorm as _truncnorm
 
 from hq.config import Config
 from hq.log import logger
 from hq.physics_helpers import fast_m2_min, fast_mf
-
-
-def truncnorm(mu, sigma, clip_a, clip_b):
-    a, b = (clip_a - mu) / sigma, (clip_b - mu) / sigma
-    return _truncnorm(loc=mu, scale=sigma, a=a, b=b)
+from vacpipe.assemble import take_rows
+from vacpipe.catalogs import (get_row_index, lookup_rows, read_fits_columns,
+                              starhorse_file)
+from vacpipe.incremental import get_changed_sources, merge_rows
+from vacpipe.samples import SamplesReader, get_use_mcmc
+from vacpipe.scheduler import get_source_cost, make_chunks, map_tasks
+from vacpipe.stats import grouped_nanpercentiles
+from vacpipe.telemetry import get_telemetry
+
+
+def get_m2_min_percentiles(mass1, mass1_err, P, K, e, n_samples,
+                           percentiles, n_m1, rng):
+    """
+    Compute percentiles of the minimum companion mass for a batch of sources.
+    The input P, K, e samples are the samples for all sources in the batch
+    concatenated, where ``n_samples`` is the number of samples per source.
+    """
+    mf = fast_mf(P, K, e)
+    mf = np.repeat(mf.value, n_m1) * mf.unit
+
+    # Draw all primary masses at once from truncated normal distributions:
+    idx = np.repeat(np.arange(len(n_samples)), n_samples * n_m1)
+    mu = mass1[idx]
+    sigma = mass1_err[idx]
+    m1_samples = _truncnorm.rvs(a=(0 - mu) / sigma,
+                                b=(1e2 - mu) / sigma,
+                                loc=mu, scale=sigma,
+                                random_state=rng) * u.Msun
+
+    m2_min = fast_m2_min(m1_samples.to_value(mf.unit), mf.value)
+
+    offsets = np.concatenate(([0], np.cumsum(n_samples * n_m1)))
+    vals, _ = grouped_nanpercentiles(m2_min, offsets, percentiles)
+    return vals * mf.unit
 
 
 def worker(task):
     conf = task['conf']
+    rng = np.random.default_rng(task['seed'])
 
     percentiles = [1, 5, 16, 50, 84, 95, 99]
     n_m1 = 16  # number of M1 samples to produce per Joker/MCMC sample
+    max_batch_size = 2**22  # max. number of m2_min samples to compute at once
 
-    new_rows = []
-    with h5py.File(conf.joker_results_file, 'r') as joker_f, \
-         h5py.File(conf.mcmc_results_file, 'r') as mcmc_f:
-
-        for row in task['metadata']:
-            if np.isnan(row['mass1']) or row['mass1_err'] <= 0:
-                continue
-
-            source_id = str(row['APOGEE_ID']).strip()
-
-            if 0 < row['mcmc_status'] <= 2:
-                results_f = mcmc_f
-            else:
-                results_f = joker_f
+    metadata = task['metadata']
+    metadata = metadata[~np.isnan(metadata['mass1']) &
+                        ~(metadata['mass1_err'] <= 0)]
+    use_mcmc = get_use_mcmc(metadata)
+    row_idx = {str(source_id).strip(): i
+               for i, source_id in enumerate(metadata['APOGEE_ID'])}
 
-            samples = tj.JokerSamples.read(
-                results_f[f'{source_id}'], path='samples')
-
-            m1_samples = truncnorm(
-                row['mass1'], row['mass1_err'],
-                0, 1e2).rvs(size=(len(samples), n_m1)).ravel() * u.Msun
-            mf = fast_mf(samples['P'], samples['K'], samples['e'])
-            mf = np.repeat(mf.value[:, None], n_m1, axis=1).ravel() * mf.unit
-
-            m2_min = fast_m2_min(m1_samples.to_value(mf.unit),
-                                 mf.value) * mf.unit
-
-            new_row = {
-                'APOGEE_ID': row['APOGEE_ID'],
-                'mass1_50': row['mass1'] * u.Msun,
-                'mass1_err': row['mass1_err'] * u.Msun
-            }
-            for pp in percentiles:
-                new_row[f'mass2_min_{pp}'] = np.nanpercentile(m2_min, pp)
-            new_rows.append(new_row)
+    if len(metadata) == 0:
+        return None
 
-    if len(new_rows) == 0:
+    # The m2_min samples of a batch of sources are computed together, so each
+    # source's telemetry record gets a share of the batch time (reading and
+    # computing) by its number of samples:
+    telemetry = get_telemetry(conf, 'masses')
+    results = []
+    with SamplesReader(conf) as reader:
+        batches = reader.iter_batches(metadata['APOGEE_ID'], use_mcmc,
+                                      max_samples=max_batch_size // n_m1)
+        while True:
+            with telemetry.record_batch() as record:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+
+                n_samples = np.array([len(samples) for _, samples in batch])
+                record['items'] = [source_id for source_id, _ in batch]
+                record['weights'] = record['n_samples'] = n_samples
+                idx = np.array([row_idx[source_id] for source_id, _ in batch])
+
+                pars = {'P': [], 'K': [], 'e': []}
+                for i, (_, samples) in zip(idx, batch):
+                    units = reader.get_units(use_mcmc[i])
+                    for name in pars:
+                        pars[name].append(samples[name] * units[name])
+                pars = {name: np.concatenate(vals)
+                        for name, vals in pars.items()}
+
+                mass1 = np.asarray(metadata['mass1'])[idx]
+                mass1_err = np.asarray(metadata['mass1_err'])[idx]
+                m2_min = get_m2_min_percentiles(
+                    mass1, mass1_err, pars['P'], pars['K'], pars['e'],
+                    n_samples, percentiles, n_m1, rng)
+
+                tbl = at.QTable()
+                tbl['APOGEE_ID'] = metadata['APOGEE_ID'][idx]
+                tbl['mass1_50'] = mass1 * u.Msun
+                tbl['mass1_err'] = mass1_err * u.Msun
+                for i, pp in enumerate(percentiles):
+                    tbl[f'mass2_min_{pp}'] = m2_min[:, i]
+                results.append(tbl)
+
+    if len(results) == 0:
         return None
     else:
-        return at.QTable(new_rows)
+        return at.vstack(results)
 
 
-def main(run_path, pool, overwrite, seed):
+def main(run_path, pool, overwrite, seed, update=False):
     output_path = pathlib.Path(__file__).resolve().parent
     output_file = output_path / 'starhorse_mass_m2_min.fits'
 
-    if output_file.exists() and not overwrite:
+    # Only recompute the sources that changed since the last incremental
+    # commit, and merge them into the existing output file:
+    update = update and output_file.exists() and not overwrite
+
+    if output_file.exists() and not overwrite and not update:
         logger.warn(f'Output file exists at {output_file!s}')
         return
 
     conf = Config(run_path / 'config.yml')
     meta = at.QTable.read(conf.metadata_file, hdu=1)
 
-    starhorse_file = (
-        '/mnt/home/apricewhelan/data/APOGEE_DR17/'
-        'APOGEE_DR17_EDR3_STARHORSE_v1.fits'
-    )
-    sh = at.Table.read(starhorse_file)
-    meta_sh = at.join(meta, sh, keys='APOGEE_ID', join_type='left')
+    if update:
+        changed, removed = get_changed_sources(conf)
+        meta = meta[np.isin(np.char.strip(np.asarray(meta['APOGEE_ID'],
+                                                     dtype=str)),
+                            changed)]
+
+    # Left join with StarHorse on APOGEE_ID:
+    sh = read_fits_columns(starhorse_file, ['mass16', 'mass50', 'mass84'])
+    sh_idx = lookup_rows(get_row_index(starhorse_file, 'APOGEE_ID'),
+                         np.char.strip(np.asarray(meta['APOGEE_ID'],
+                                                  dtype=str)))
+    meta_sh = at.QTable(meta)
+    meta_sh.add_columns(list(take_rows(sh, sh_idx).columns.values()))
 
     # Primary masses and uncertainties from starhorse:
-    meta_sh['mass1'] = meta_sh['mass50'].filled(np.nan)
+    meta_sh['mass1'] = meta_sh['mass50']
     err = np.max([
         meta_sh['mass1'] - meta_sh['mass16'],
         meta_sh['mass84'] - meta_sh['mass1']
     ], axis=0)
     meta_sh['mass1_err'] = err
 
-    tasks = []
-    for i1, i2 in batch_tasks(4 * pool.size, len(meta_sh)):
-        tasks.append({
-            'conf': conf,
-            'metadata': meta_sh[i1:i2]
-        })
-
-    results = []
-    for res in pool.map(worker, tasks):
-        if res is not None:
-            results.append(res)
+    # The cost is mostly the number of m2_min samples to compute, and sources
+    # without a primary mass are skipped by the worker:
+    cost = get_source_cost(meta_sh, conf, per_source=256., per_sample=1.)
+    has_mass1 = (np.isfinite(np.asarray(meta_sh['mass1'])) &
+                 ~(np.asarray(meta_sh['mass1_err']) <= 0))
+    cost[~has_mass1] = 1.
 
-    result_table = at.vstack(results)
+    tasks = []
+    if len(meta_sh) > 0:
+        chunks = make_chunks(cost, 4 * pool.size)
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+        for idx, task_seed in zip(chunks, seeds):
+            tasks.append({
+                'conf': conf,
+                'metadata': meta_sh[idx],
+                'seed': task_seed
+            })
+
+    results = [res for res in map_tasks(pool, worker, tasks)
+               if res is not None]
+
+    if update:
+        old = at.QTable.read(output_file)
+        new = at.vstack(results) if results else old[:0]
+        result_table = merge_rows(old, new, np.union1d(changed, removed))
+        logger.info(f'Updated {len(new)} rows of {output_file!s} '
+                    f'({len(result_table)} rows)')
+    else:
+        result_table = at.vstack(results)
+        result_table.sort('APOGEE_ID')
     result_table.write(output_file, overwrite=True)
 
 
@@ -119,6 +190,10 @@ if __name__ == '__main__':
 
     parser.add_argument("-s", "--seed", dest="seed", default=None,
                         type=int, help="Random number seed")
+    parser.add_argument("--update", dest="update", default=False,
+                        action="store_true",
+                        help="Only recompute the sources that changed since "
+                             "the last incremental commit")
     args = parser.parse_args(sys.argv[2:])
 
     if args.seed is None:
@@ -131,6 +206,7 @@ if __name__ == '__main__':
             main(run_path=args.run_path,
                  pool=pool,
                  overwrite=args.overwrite,
-                 seed=args.seed)
+                 seed=args.seed,
+                 update=args.update)
 
     sys.exit(0)
@@ -7,9 +7,7 @@
 #SBATCH -p cca
 #SBATCH --constraint=rome
 
-source ~/.bash_profile
-init_conda
-conda activate dr17-binaries
+source /mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/vac-pipeline/hq-config/init.sh
 echo $HQ_RUN_PATH
 
 cd /mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/catalog-helpers/starhorse
@@ -19,5 +17,8 @@ date
 mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
 make_masses.py -v --mpi -o
 
+# Merge the metadata, allStar, and the new masses for the plots and catalogs
+python3 -m vacpipe.assemble -v -o
+
 date
 
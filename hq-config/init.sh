@@ -4,3 +4,6 @@ init_conda
 conda activate dr17-binaries
 
 export HQ_RUN_PATH=/mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/vac-pipeline/hq-config
+
+# Shared pipeline helpers (the vacpipe package at the root of this repository)
+export PYTHONPATH=/mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/vac-pipeline:$PYTHONPATH
@@ -0,0 +1,20 @@
+#!/bin/bash
+#SBATCH -J apogee-calib-verr
+#SBATCH -o logs/apogee-calib-verr.o%j
+#SBATCH -e logs/apogee-calib-verr.e%j
+#SBATCH -N 1
+#SBATCH -t 2:00:00
+#SBATCH -p cca
+#SBATCH --constraint=rome
+
+# Relocate and initialize shell
+cd /mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/vac-pipeline
+source hq-config/init.sh
+echo $HQ_RUN_PATH
+
+date
+
+mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+-m vacpipe.calib_verr -v --mpi
+
+date
@@ -17,6 +17,14 @@ date
 mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
 $CONDA_PREFIX/bin/hq make_prior_cache -v --mpi
 
+# A second, sharded and memory-mappable prior cache (new samples drawn from the
+# same prior, see vacpipe/prior_cache.py). Only vacpipe.joker reads it, so only
+# build it when 2-run.sh will run vacpipe.joker (VACPIPE_JOKER=1).
+if [ "$VACPIPE_JOKER" = "1" ]; then
+    mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+    -m vacpipe.prior_cache -v --mpi
+fi
+
 hq make_tasks -v
 
 date
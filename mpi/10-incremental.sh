@@ -0,0 +1,48 @@
+#!/bin/bash
+#SBATCH -J apogee-incremental
+#SBATCH -o logs/apogee-incremental.o%j
+#SBATCH -e logs/apogee-incremental.e%j
+#SBATCH -N 1
+#SBATCH -t 8:00:00
+#SBATCH -p cca
+#SBATCH --constraint=rome
+
+# Relocate and initialize shell
+cd /mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/vac-pipeline
+source hq-config/init.sh
+echo $HQ_RUN_PATH
+
+date
+
+# Incremental update of the leaf products after a partial rerun (e.g.,
+# 4-rerun.sh, or MCMC for some sources). See vacpipe/incremental.py.
+#
+# NOT incremental -- these must still be run IN FULL (on all sources) first:
+#   4-analyze.sh, 6-mcmc-analyze.sh, and 7-combine-metadata.sh
+# NOT incremental -- these must still be rebuilt IN FULL afterwards:
+#   the gold sample and binary catalogs (notebooks/pipeline/3-*.ipynb and
+#   4-*.ipynb), and the release archives (9-b-tar.sh, with --overwrite added to
+#   vacpipe.package, since finished archives are otherwise skipped)
+# Incremental (only the sources whose samples or metadata row changed since
+# the last commit are recomputed and merged into the existing files):
+#   the percentiles, the companion masses, and the assembled metadata (this
+#   script), and the diagnostic plots (plots/make_unimodal.py, run separately)
+#
+# The versions are only committed if all of the stages below succeed:
+set -e
+
+mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+-m vacpipe.incremental -v --mpi --detect
+
+mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+-m vacpipe.percentiles -v --mpi --update
+
+(cd catalog-helpers/starhorse && \
+mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+make_masses.py -v --mpi --update)
+
+python3 -m vacpipe.assemble -v --update
+
+python3 -m vacpipe.incremental -v --commit
+
+date
@@ -15,8 +15,20 @@ echo $HQ_RUN_PATH
 
 date
 
-mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
-$CONDA_PREFIX/bin/hq run_thejoker -v --mpi
+# hq run_thejoker is the default. vacpipe.joker (blocks from the sharded prior
+# cache, with the first block size estimated for each source from its visits,
+# see vacpipe/joker.py) is only run with VACPIPE_JOKER=1 until it has been
+# validated against hq run_thejoker on real sources.
+if [ "$VACPIPE_JOKER" = "1" ]; then
+    mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+    -m vacpipe.joker -v --mpi --adaptive
+
+    # Per-source time and memory summary (see vacpipe/telemetry.py)
+    python3 -m vacpipe.telemetry -v --stage joker
+else
+    mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+    $CONDA_PREFIX/bin/hq run_thejoker -v --mpi
+fi
 
 date
 
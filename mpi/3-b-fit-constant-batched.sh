@@ -0,0 +1,23 @@
+#!/bin/bash
+#SBATCH -J apogee-constant-batched
+#SBATCH -o logs/apogee-constant-batched.o%j
+#SBATCH -e logs/apogee-constant-batched.e%j
+#SBATCH -N 1
+#SBATCH -t 1:00:00
+#SBATCH -p cca
+#SBATCH --constraint=rome
+
+# Relocate and initialize shell
+cd /mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/vac-pipeline
+source hq-config/init.sh
+echo $HQ_RUN_PATH
+
+date
+
+# Fast batched constant/linear fits (see vacpipe/constant.py).
+# These do not replace 3-fit-constant.sh: the metadata and catalog cuts use the
+# hq run_constant results.
+mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+-m vacpipe.constant -v --mpi
+
+date
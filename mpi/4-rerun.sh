@@ -14,9 +14,17 @@ source hq-config/init.sh
 echo $HQ_RUN_PATH
 
 date
+start=$(date +%s.%N)
 
 mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
 $CONDA_PREFIX/bin/hq rerun_thejoker -v --mpi
+status=$?
+
+# hq rerun_thejoker can't write per-source telemetry, so record the whole run
+# as one item, and summarize (see vacpipe/telemetry.py)
+python3 -m vacpipe.telemetry -v --record-run rerun_thejoker \
+--start $start --exit-status $status
+python3 -m vacpipe.telemetry -v --stage rerun_thejoker
 
 date
 
@@ -1,3 +1,24 @@
 #!/bin/bash
-module load disBatch
-sbatch -N6 --constraint=rome -p cca disBatch.py mcmc_taskfile
+#SBATCH -J apogee-mcmc
+#SBATCH -o logs/apogee-mcmc.o%j
+#SBATCH -e logs/apogee-mcmc.e%j
+#SBATCH -N 6
+#SBATCH -t 48:00:00
+#SBATCH -p cca
+#SBATCH --constraint=rome
+
+# Relocate and initialize shell
+cd /mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/vac-pipeline
+source hq-config/init.sh
+echo $HQ_RUN_PATH
+
+date
+
+# Resubmit this script to resume after a timeout: finished sources are skipped
+mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+-m vacpipe.mcmc -v --mpi
+
+# Per-source time and memory summary (see vacpipe/telemetry.py)
+python3 -m vacpipe.telemetry -v --stage mcmc
+
+date
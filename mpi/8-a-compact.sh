@@ -0,0 +1,19 @@
+#!/bin/bash
+#SBATCH -J apogee-compact
+#SBATCH -o logs/apogee-compact.o%j
+#SBATCH -e logs/apogee-compact.e%j
+#SBATCH -n 1
+#SBATCH -t 4:00:00
+#SBATCH -p cca
+#SBATCH --constraint=rome
+
+# Relocate and initialize shell
+cd /mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/vac-pipeline
+source hq-config/init.sh
+echo $HQ_RUN_PATH
+
+date
+
+python3 -m vacpipe.compact -v -o
+
+date
@@ -2,17 +2,22 @@
 #SBATCH -J apogee-tar
 #SBATCH -o logs/apogee-tar.o%j
 #SBATCH -e logs/apogee-tar.e%j
-#SBATCH -n 1
+#SBATCH -N 2
 #SBATCH -t 12:00:00
 #SBATCH -p cca
+#SBATCH --constraint=rome
 
-source ~/.bash_profile
-
-cd /mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/vac-pipeline/cache/hq
+# Relocate and initialize shell
+cd /mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/vac-pipeline
+source hq-config/init.sh
+echo $HQ_RUN_PATH
 
 date
 
-tar -czf samples.tar.gz samples
+# One samples-<FIELD>.tar.gz per field, plus manifest.json and SHA256SUMS, in
+# cache/hq/samples-archives (add --from-expanded to archive the tree written
+# by 9-a-expand.sh instead of reading the result files)
+mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+-m vacpipe.package -v --mpi
 
 date
-
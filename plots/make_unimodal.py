@@ -1,27 +1,147 @@
 # Standard library
+from functools import lru_cache
+import hashlib
+import json
 import pathlib
+import time
 
 # Third-party
 import astropy.coordinates as coord
 import astropy.table as at
 from astropy.time import Time
 import astropy.units as u
+import h5py
 import matplotlib as mpl
+from matplotlib.collections import LineCollection
 import matplotlib.pyplot as plt
 import numpy as np
 import thejoker as tj
-from schwimmbad.utils import batch_tasks
 
 from hq.config import Config
 from hq.log import logger
-
-
-def plot_diagnostic(c, row, allstar, mcmc=True):
+from hq.samples_analysis import extract_MAP_sample
+from vacpipe.assemble import load_metadata
+from vacpipe.catalogs import load_allstar
+from vacpipe.scheduler import get_source_cost, make_chunks, map_tasks
+from vacpipe.telemetry import get_telemetry
+from vacpipe.visits import get_visit_index
+
+# The only allStar columns needed to build the CMD background histograms:
+allstar_plot_colnames = (
+    'GAIAEDR3_PARALLAX',
+    'GAIAEDR3_PARALLAX_ERROR',
+    'J',
+    'K',
+    'M_H'
+)
+
+# CMD background histograms: these are precomputed on a grid in [M/H] so that
+# each plot only has to look up the histogram closest to the source [M/H]
+cmd_color_bins = np.arange(-0.1, 1.5, 0.02)
+cmd_mag_bins = np.arange(-5, 8, 0.04)
+cmd_m_h_grid = np.arange(-2.5, 1+1e-3, 0.02)
+cmd_m_h_half_width = 0.2
+
+# Time grid for the RV curves in the fast plotting mode: the saved panel is
+# about 1000 pixels wide, so more points than this are not resolved
+fast_n_per_period = 64
+fast_min_t_grid = 256
+fast_max_t_grid = 2048
+
+# Figure templates for the fast plotting mode, one per process
+_figures = {}
+
+
+def make_cmd_cache(allstar, cache_file):
+    """
+    Precompute the 2D (J-K, M_J) histograms of high parallax S/N allStar
+    sources in a sliding window of [M/H] (of half-width
+    ``cmd_m_h_half_width``) centered on each value in ``cmd_m_h_grid``, and
+    save them to ``cache_file``. A plot uses the window centered on the grid
+    value nearest to the source's [M/H], so the window can be off by up to
+    half a grid step from the source's own.
+    """
+    t0 = time.time()
+
+    plx_snr = (allstar['GAIAEDR3_PARALLAX'] /
+               allstar['GAIAEDR3_PARALLAX_ERROR'])
+    mask = ((plx_snr > 6) &
+            np.isfinite(allstar['M_H']) &
+            (allstar['J'] > -999) &
+            (allstar['K'] > -999))
+
+    dist = coord.Distance(parallax=allstar['GAIAEDR3_PARALLAX'][mask] * u.mas)
+    mag = allstar['J'][mask] - dist.distmod.value
+    col = allstar['J'][mask] - allstar['K'][mask]
+    m_h = allstar['M_H'][mask]
+
+    # Histogram into fine [M/H] bins with edges at the window half-width
+    # from each grid point, so that the window around grid point i is
+    # exactly the fine bins i to i + 2*n_pad - 1, then sum over the window
+    # with a cumulative sum along the [M/H] axis:
+    step = cmd_m_h_grid[1] - cmd_m_h_grid[0]
+    n_pad = int(round(cmd_m_h_half_width / step))
+    m_h_bins = (cmd_m_h_grid[0] - n_pad * step +
+                step * np.arange(len(cmd_m_h_grid) + 2*n_pad))
+
+    H, _ = np.histogramdd(
+        np.stack((np.asarray(m_h), np.asarray(col), np.asarray(mag))).T,
+        bins=(m_h_bins, cmd_color_bins, cmd_mag_bins))
+    cumH = np.concatenate((np.zeros((1, ) + H.shape[1:]),
+                           np.cumsum(H, axis=0)))
+    H = cumH[2*n_pad:] - cumH[:-2*n_pad]
+
+    np.savez_compressed(cache_file,
+                        m_h_grid=cmd_m_h_grid,
+                        color_bins=cmd_color_bins,
+                        mag_bins=cmd_mag_bins,
+                        H=H.astype(np.int32))
+    logger.debug(f"Built CMD cache with {len(cmd_m_h_grid)} [M/H] bins from "
+                 f"{mask.sum()} sources in {time.time() - t0:.2f} seconds")
+
+
+@lru_cache(maxsize=None)
+def load_cmd_cache(cache_file):
+    with np.load(cache_file) as f:
+        return {k: f[k] for k in f.files}
+
+
+def get_cmd_hist(cmd_cache, m_h):
+    grid = cmd_cache['m_h_grid']
+    i = int(np.clip(np.round((m_h - grid[0]) / (grid[1] - grid[0])),
+                    0, len(grid) - 1))
+    return cmd_cache['H'][i]
+
+
+def get_samples_fingerprint(results_fs, source_id):
+    """
+    A hash of the raw samples for a source in each of the input (open) result
+    files. This changes whenever the samples for the source are rewritten.
+    """
+    h = hashlib.sha1()
+    for results_f in results_fs:
+        h.update(results_f[source_id]['samples'][()].tobytes())
+    return h.hexdigest()
+
+
+def get_samples(results_file, source_id):
+    with h5py.File(results_file, 'r') as f:
+        samples = tj.JokerSamples.read(f[source_id], path='samples')
+    return samples, extract_MAP_sample(samples)
+
+
+def get_plot_data(c, row, mcmc=True):
+    """The visits and samples for the diagnostic plot of one source."""
     source_id = row['APOGEE_ID']
 
-    data, joker_samples, joker_MAP_s = c.get_data_samples(source_id)
+    visit_index = get_visit_index(c)
+    visits = visit_index[source_id]
+    data = visit_index.get_rvdata(source_id)
+
+    joker_samples, joker_MAP_s = get_samples(c.joker_results_file, source_id)
+    samples = None
     if mcmc:
-        _, samples, MAP_s = c.get_data_samples(source_id, mcmc=True)
+        samples, MAP_s = get_samples(c.mcmc_results_file, source_id)
 
         P_mask = samples['P'] < 0.5*u.day
         if P_mask.sum():
@@ -30,8 +150,58 @@ def plot_diagnostic(c, row, allstar, mcmc=True):
     else:
         MAP_s = joker_MAP_s
 
+    return {'visits': visits,
+            'data': data,
+            'joker_samples': joker_samples,
+            'joker_MAP_sample': joker_MAP_s,
+            'samples': samples,
+            'MAP_sample': MAP_s}
+
+
+def get_panel_texts(row, visits):
+    """The text in the bottom row of panels of the diagnostic plot."""
+    info_text = (
+        "Joker log-like".rjust(18) +
+        f"  ${row['max_unmarginalized_ln_likelihood']:.3f}$\n" +
+        "const log-like".rjust(18) +
+        f"  ${row['robust_constant_ln_likelihood']:.3f}$\n" +
+        "linear log-like".rjust(18) +
+        f"  ${row['robust_linear_ln_likelihood']:.3f}$\n\n" +
+        "Teff".rjust(8) + f"  ${row['TEFF']:.0f}$\n" +
+        "logg".rjust(8) + f"  ${row['LOGG']:.2f}$\n" +
+        "[M/H]".rjust(8) + f"  ${row['M_H']:.3f}$\n" +
+        "vsini".rjust(8) + f"  ${row['VSINI']:.1f}$\n" +
+        "S/N".rjust(8) + f"  ${row['SNR']:.0f}$\n"
+    )
+    rv_flag_text = (
+        f"RV_FLAG: {row['RV_FLAG']}\n" +
+        f"N_COMPONENTS: {row['N_COMPONENTS']}"
+    )
+    starflags_text = "STARFLAGS:\n" + '\n'.join(row['STARFLAGS'].split(','))
+    aspcapflags_text = ("ASPCAPFLAGS:\n" +
+                        '\n'.join(row['ASPCAPFLAGS'].split(',')))
+
+    med_verr_ratio = np.nanmedian(visits['VRELERR'] / visits['CALIB_VERR'])
+    sampling_text = (
+        f"Joker completed: {str(row['joker_completed'])}\n" +
+        f"MCMC converged: {str(row['gelman_rubin_max'] < 1.4)}\n" +
+        f"Gelman-Rubin: {row['gelman_rubin_max']:.2f}\n" +
+        f"Median VRELERR/CALIB_VERR: {med_verr_ratio:.2f}"
+    )
+    return [info_text, rv_flag_text, starflags_text, aspcapflags_text,
+            sampling_text]
+
+
+def plot_diagnostic(c, row, cmd_cache, mcmc=True):
+    plot_data = get_plot_data(c, row, mcmc=mcmc)
+    visits = plot_data['visits']
+    data = plot_data['data']
+    joker_samples = plot_data['joker_samples']
+    joker_MAP_s = plot_data['joker_MAP_sample']
+    samples = plot_data['samples']
+    MAP_s = plot_data['MAP_sample']
+
     # Also plot VRELERR error bars...
-    visits = c.data[c.data['APOGEE_ID'] == source_id]
     data_vrelerr = tj.RVData(
         Time(visits['JD'], format='jd', scale='tdb'),
         visits['VHELIO']*u.km/u.s,
@@ -81,26 +251,15 @@ def plot_diagnostic(c, row, allstar, mcmc=True):
     ax = axes[0]
     plx_snr = row['GAIAEDR3_PARALLAX'] / row['GAIAEDR3_PARALLAX_ERROR']
     if row['M_H'] > -2.5 and plx_snr > 4:
-        plx_snr = (allstar['GAIAEDR3_PARALLAX'] /
-                   allstar['GAIAEDR3_PARALLAX_ERROR'])
-        mask = ((np.abs(allstar['M_H'] - row['M_H']) < 0.2) &
-                (plx_snr > 6) &
-                (allstar['J'] > -999) &
-                (allstar['K'] > -999))
-
         dist = coord.Distance(parallax=row['GAIAEDR3_PARALLAX']*u.mas)
         mag_row = row['J'] - dist.distmod.value
         col_row = row['J'] - row['K']
 
-        dist = coord.Distance(
-            parallax=allstar['GAIAEDR3_PARALLAX'][mask] * u.mas)
-        mag = allstar['J'][mask] - dist.distmod.value
-        col = allstar['J'][mask] - allstar['K'][mask]
-
-        ax.hist2d(col, mag,
-                  bins=(np.arange(-0.1, 1.5, 0.02),
-                        np.arange(-5, 8, 0.04)),
-                  cmap='Blues', norm=mpl.colors.LogNorm())
+        H = get_cmd_hist(cmd_cache, row['M_H'])
+        if H.any():
+            ax.pcolormesh(cmd_cache['color_bins'], cmd_cache['mag_bins'],
+                          np.ma.masked_less_equal(H.T, 0),
+                          cmap='Blues', norm=mpl.colors.LogNorm())
         ax.errorbar(col_row, mag_row,
                     marker='o', ls='none',
                     color='tab:red', alpha=0.8)
@@ -159,86 +318,422 @@ def plot_diagnostic(c, row, allstar, mcmc=True):
         ax.yaxis.set_visible(False)
         ax.set(xlim=(0, 1), ylim=(0, 1))
 
-    ax = axes[0]
-    text = (
-        "Joker log-like".rjust(18) +
-        f"  ${row['max_unmarginalized_ln_likelihood']:.3f}$\n" +
-        "const log-like".rjust(18) +
-        f"  ${row['robust_constant_ln_likelihood']:.3f}$\n" +
-        "linear log-like".rjust(18) +
-        f"  ${row['robust_linear_ln_likelihood']:.3f}$\n\n" +
-        "Teff".rjust(8) + f"  ${row['TEFF']:.0f}$\n" +
-        "logg".rjust(8) + f"  ${row['LOGG']:.2f}$\n" +
-        "[M/H]".rjust(8) + f"  ${row['M_H']:.3f}$\n" +
-        "vsini".rjust(8) + f"  ${row['VSINI']:.1f}$\n" +
-        "S/N".rjust(8) + f"  ${row['SNR']:.0f}$\n"
-    )
-    ax.text(0.05, 0.95, text,
-            fontsize=14, va='top', ha='left',
-            fontfamily='monospace')
-
-    text = (
-        f"RV_FLAG: {row['RV_FLAG']}\n" +
-        f"N_COMPONENTS: {row['N_COMPONENTS']}"
-    )
-    ax.text(0.05, 0.05, text,
-            fontsize=14, va='bottom', ha='left',
-            fontfamily='monospace')
+    texts = get_panel_texts(row, visits)
+    style = dict(fontsize=14, ha='left', fontfamily='monospace')
+    axes[0].text(0.05, 0.95, texts[0], va='top', **style)
+    axes[0].text(0.05, 0.05, texts[1], va='bottom', **style)
 
     # Flagging:
-    ax = axes[1]
-    ax.text(0.05, 0.95,
-            "STARFLAGS:\n" + '\n'.join(row['STARFLAGS'].split(',')),
-            fontsize=14, va='top', ha='left',
-            fontfamily='monospace')
-    ax.text(0.05, 0.05,
-            "ASPCAPFLAGS:\n" + '\n'.join(row['ASPCAPFLAGS'].split(',')),
-            fontsize=14, va='bottom', ha='left',
-            fontfamily='monospace')
+    axes[1].text(0.05, 0.95, texts[2], va='top', **style)
+    axes[1].text(0.05, 0.05, texts[3], va='bottom', **style)
 
     # Sampling statistics:
-    ax = axes[2]
-    med_verr_ratio = np.nanmedian(visits['VRELERR'] / visits['CALIB_VERR'])
-    text = (
-        f"Joker completed: {str(row['joker_completed'])}\n" +
-        f"MCMC converged: {str(row['gelman_rubin_max'] < 1.4)}\n" +
-        f"Gelman-Rubin: {row['gelman_rubin_max']:.2f}\n" +
-        f"Median VRELERR/CALIB_VERR: {med_verr_ratio:.2f}"
-    )
-    ax.text(0.05, 0.95, text,
-            fontsize=14, va='top', ha='left',
-            fontfamily='monospace')
+    axes[2].text(0.05, 0.95, texts[4], va='top', **style)
 
     fig.set_facecolor('w')
 
     return fig
 
 
+def solve_kepler(M, e, tol=1e-10, maxiter=128):
+    """
+    Solve Kepler's equation for the eccentric anomaly with Newton's method
+    (the same as `twobody.eccentric_anomaly_from_mean_anomaly`), for arrays
+    of mean anomaly ``M`` and eccentricity ``e``.
+    """
+    E = M + e * np.sin(M)
+    for _ in range(maxiter):
+        dE = (E - e * np.sin(E) - M) / (1 - e * np.cos(E))
+        E = E - dE
+        if np.all(np.abs(dE) < tol):
+            break
+    return E
+
+
+def get_orbit_pars(samples):
+    """
+    The orbital parameters of a `~thejoker.JokerSamples` as plain arrays (P in
+    days, omega and M0 in radians, and K and the velocity trend coefficients
+    in km/s, km/s/day, ...), plus the reference time as a TCB MJD.
+    """
+    pars = {
+        'P': np.atleast_1d(samples['P'].to_value(u.day)),
+        'e': np.atleast_1d(samples['e'].to_value(u.one)),
+        'omega': np.atleast_1d(samples['omega'].to_value(u.radian)),
+        'M0': np.atleast_1d(samples['M0'].to_value(u.radian)),
+        'K': np.atleast_1d(samples['K'].to_value(u.km/u.s))
+    }
+    pars['trend'] = [
+        np.atleast_1d(samples[f'v{k}'].to_value(u.km/u.s/u.day**k))
+        for k in range(samples.poly_trend)]
+    pars['t_ref'] = samples.t_ref.tcb.mjd
+    return pars
+
+
+def get_rv_curves(pars, t):
+    """
+    Compute the RV curves (in km/s) of all samples at once, with the same
+    conventions as `thejoker.JokerSamples.get_orbit`.
+
+    Parameters
+    ----------
+    pars : dict
+        The sample parameters, from `get_orbit_pars`.
+    t : array-like
+        Times as TCB MJD.
+
+    Returns
+    -------
+    rv : `numpy.ndarray`
+        Shape ``(n_samples, len(t))``.
+    """
+    t = np.asarray(t)[None]
+    P, e, omega, M0, K = [pars[k][:, None]
+                          for k in ['P', 'e', 'omega', 'M0', 'K']]
+    dt = t - pars['t_ref']
+
+    M = 2 * np.pi * dt / P - M0
+    E = solve_kepler(M, e)
+    f = 2 * np.arctan2(np.sqrt(1 + e) * np.sin(E / 2),
+                       np.sqrt(1 - e) * np.cos(E / 2))
+    rv = K * (np.cos(omega + f) + e * np.cos(omega))
+    for k, coeff in enumerate(pars['trend']):
+        rv = rv + coeff[:, None] * dt**k
+    return rv
+
+
+def get_fast_t_grid(t, P_min, span_factor=0.1):
+    """
+    A time grid over the data with ``fast_n_per_period`` points per (shortest)
+    period, but at most ``fast_max_t_grid`` points: the curves of samples
+    with shorter periods are not resolved on the saved figure anyway.
+    """
+    w = np.ptp(t)
+    n_grid = int(np.clip(np.ceil(w / P_min * fast_n_per_period),
+                         fast_min_t_grid, fast_max_t_grid))
+    return np.linspace(t.min() - w * span_factor / 2,
+                       t.max() + w * span_factor / 2,
+                       n_grid)
+
+
+def get_autoscale_lim(vmin, vmax, axis):
+    """
+    The axis limits that matplotlib's autoscaling gives for data from
+    ``vmin`` to ``vmax`` (with the default margins, on a linear axis).
+    """
+    margin = plt.rcParams[f'axes.{axis}margin'] * (vmax - vmin)
+    return vmin - margin, vmax + margin
+
+
+class DiagnosticFigure:
+    """
+    The same panels as `plot_diagnostic`, but the figure and axes are made
+    (and laid out) once per process, and only the data of the artists are
+    updated for each source. The RV curves of the samples are computed in one
+    vectorized batch on a time grid set by the period (`get_fast_t_grid`).
+    """
+
+    def __init__(self, cmd_cache):
+        self.cmd_cache = cmd_cache
+
+        # The same layout as `plot_diagnostic`:
+        self.fig, self.all_axes = plt.subplots(3, 3, figsize=(16, 12),
+                                               constrained_layout=True)
+        self.fig.set_facecolor('w')
+        self.suptitle = self.fig.suptitle('', fontsize=20)
+
+        # Artists that are remade for each source (the error bars and the
+        # CMD histogram):
+        self._source_artists = []
+
+        self._init_rv_axes()
+        self._init_metadata_axes()
+        self._init_text_axes()
+
+    def _init_rv_axes(self):
+        axes = self.all_axes[0]
+        rv_label = f'RV [{u.km/u.s:latex_inline}]'
+        phase_label = (r'phase, $(t-t_0)~{\rm mod}~P$ ' +
+                       f'[{u.day:latex_inline}]')
+
+        self.sample_curves = LineCollection([], colors='#555555',
+                                            linewidths=0.5, zorder=10,
+                                            rasterized=True)
+        axes[0].add_collection(self.sample_curves)
+        self.map_curve, = axes[0].plot([], [], marker='', linestyle='-',
+                                       linewidth=0.5, color='tab:blue',
+                                       zorder=50, rasterized=True)
+        axes[0].set_xlabel('BMJD')
+        axes[0].set_ylabel(rv_label)
+
+        self.phase_curve, = axes[1].plot([], [], marker='', linestyle='-',
+                                         linewidth=0.5, color='#555555',
+                                         rasterized=True)
+        axes[1].set_xlabel(phase_label)
+        axes[1].set_yticklabels([])
+
+        axes[2].axhline(0, color='tab:green', alpha=0.4, zorder=-10)
+        axes[2].set_xlabel(phase_label)
+
+        axes[0].set_title("raw time series", fontsize=18)
+        axes[1].set_title("phase-folded", fontsize=18)
+        axes[2].set_title("residual", fontsize=18)
+
+    def _init_metadata_axes(self):
+        axes = self.all_axes[1]
+
+        # CMD:
+        ax = axes[0]
+        self.cmd_point, = ax.plot([], [], marker='o', linestyle='none',
+                                  color='tab:red', alpha=0.8)
+        ax.set_xlabel('$J-K$')
+        ax.set_ylabel('$M_J$')
+        ax.set_xlim(-0.1, 1.5)
+        ax.set_ylim(8, -5)
+
+        # Period-Eccentricity
+        ax = axes[1]
+        style = dict(marker='o', linestyle='none', mew=0, ms=2, alpha=0.7)
+        self.mcmc_P_e, = ax.plot([], [], color='k', **style)
+        self.joker_P_e, = ax.plot([], [], color='tab:blue', **style)
+        ax.set_xlim(1, 3e3)
+        ax.set_ylim(0, 1)
+        ax.set_xscale('log')
+        ax.set_xlabel('period $P$')
+        ax.set_ylabel('eccentricity $e$')
+
+        # Mass / m2_min
+        ax = axes[2]
+        self.mass_point, = ax.plot([], [], marker='o', linestyle='none',
+                                   ms=3.5, zorder=100)
+        self.mass_err1, = ax.plot([], [], marker='', color='tab:blue',
+                                  zorder=50)
+        self.mass_err2, = ax.plot([], [], marker='', color='tab:red',
+                                  zorder=25)
+
+        grid = np.geomspace(1e-3, 1e2, 128)
+        ax.plot(grid, grid, marker='', ls='--', color='#aaaaaa', zorder=0)
+        ax.axhline(0.08, ls='-', color='tab:green', zorder=0, alpha=0.6)
+
+        ax.set_xlabel(f'$M_1$ [{u.Msun:latex_inline}]')
+        ax.set_ylabel(r'$M_{2, {\rm min}}$ ' + f'[{u.Msun:latex_inline}]')
+        ax.set_xlim(0, 3)
+        ax.set_yscale('log')
+        ax.set_ylim(1e-3, 1e2)
+
+    def _init_text_axes(self):
+        axes = self.all_axes[2]
+        for ax in axes:
+            ax.xaxis.set_visible(False)
+            ax.yaxis.set_visible(False)
+            ax.set(xlim=(0, 1), ylim=(0, 1))
+
+        style = dict(fontsize=14, ha='left', fontfamily='monospace')
+        self.texts = [
+            axes[0].text(0.05, 0.95, '', va='top', **style),
+            axes[0].text(0.05, 0.05, '', va='bottom', **style),
+            axes[1].text(0.05, 0.95, '', va='top', **style),
+            axes[1].text(0.05, 0.05, '', va='bottom', **style),
+            axes[2].text(0.05, 0.95, '', va='top', **style)
+        ]
+
+    def _errorbar(self, ax, *args, **kwargs):
+        self._source_artists.append(ax.errorbar(*args, **kwargs))
+
+    def update(self, row, plot_data):
+        """Update the figure for a new source (see `get_plot_data`)."""
+        for artist in self._source_artists:
+            artist.remove()
+        self._source_artists = []
+
+        self.suptitle.set_text(row['APOGEE_ID'])
+        self._update_rv_axes(plot_data)
+        self._update_metadata_axes(row, plot_data)
+        for text, new_text in zip(self.texts,
+                                  get_panel_texts(row, plot_data['visits'])):
+            text.set_text(new_text)
+
+        return self.fig
+
+    def _update_rv_axes(self, plot_data):
+        axes = self.all_axes[0]
+        data = plot_data['data']
+        visits = plot_data['visits']
+
+        t = data.t.tcb.mjd
+        rv = data.rv.to_value(u.km/u.s)
+        rv_err = data.rv_err.to_value(u.km/u.s)
+
+        # Raw time series, with the MAP sample from The Joker and (if MCMC
+        # was run) 128 MCMC samples:
+        ax = axes[0]
+        joker_map_pars = get_orbit_pars(plot_data['joker_MAP_sample'])
+        P_min = joker_map_pars['P'].min()
+        if plot_data['samples'] is not None:
+            curve_pars = get_orbit_pars(plot_data['samples'][:128])
+            P_min = min(P_min, curve_pars['P'].min())
+        t_grid = get_fast_t_grid(t, P_min)
+
+        model_rv = get_rv_curves(joker_map_pars, t_grid)
+        self.map_curve.set_data(t_grid, model_rv[0])
+
+        if plot_data['samples'] is not None:
+            model_rv = get_rv_curves(curve_pars, t_grid)
+            segments = np.stack((np.broadcast_to(t_grid, model_rv.shape),
+                                 model_rv), axis=-1)
+            self.sample_curves.set_segments(segments)
+            self.sample_curves.set_alpha(0.05 + 4. / (len(model_rv) + 4.))
+        else:
+            self.sample_curves.set_segments([])
+
+        self._errorbar(ax, t, rv, rv_err, linestyle='none', marker='o',
+                       markersize=4., elinewidth=1, color='k',
+                       ecolor='#666666', zorder=100)
+        self._errorbar(ax, t, rv, np.asarray(visits['VRELERR']),
+                       linestyle='none', marker='', elinewidth=1,
+                       color='tab:green', zorder=99)
+
+        # The same y limits as thejoker.plot_rv_curves (from the last set
+        # of curves plotted), and the x limits that matplotlib's autoscaling
+        # gives in `plot_diagnostic`:
+        drv = np.ptp(rv)
+        ylim = (min(rv.min() - 0.2 * drv,
+                    np.percentile(model_rv.min(axis=1), 5)),
+                max(rv.max() + 0.2 * drv,
+                    np.percentile(model_rv.max(axis=1), 95)))
+        ax.set_xlim(get_autoscale_lim(t_grid.min(), t_grid.max(), 'x'))
+        ax.set_ylim(ylim)
+
+        # Phase-folded and residuals:
+        map_pars = get_orbit_pars(plot_data['MAP_sample'])
+        P = map_pars['P'][0]
+        t0 = map_pars['t_ref'] + P * map_pars['M0'][0] / (2 * np.pi)
+        phase = (t - t0) % P
+        phase_grid = np.linspace(0, 1, 4096) * P
+        self.phase_curve.set_data(
+            phase_grid, get_rv_curves(map_pars, t0 + phase_grid)[0])
+
+        s = plot_data['MAP_sample']['s'].to_value(u.km/u.s)
+        resid = rv - get_rv_curves(map_pars, t)[0]
+        err = np.sqrt(rv_err**2 + s**2)
+        for ax, y in zip(axes[1:], [rv, resid]):
+            self._errorbar(ax, phase, y, rv_err, linestyle='none',
+                           marker='o', markersize=4., zorder=10)
+            self._errorbar(ax, phase, y, err,
+                           linestyle='none', marker='', elinewidth=0.,
+                           color='#aaaaaa', alpha=0.9, capsize=0, zorder=9)
+
+        # The phase-folded panel has the limits of the raw time series in y,
+        # and of the MAP curve over one period in x. The residual panel is
+        # autoscaled to the data and the line at 0:
+        axes[1].set_xlim(get_autoscale_lim(0, P, 'x'))
+        axes[1].set_ylim(ylim)
+        axes[2].set_xlim(get_autoscale_lim(phase.min(), phase.max(), 'x'))
+        axes[2].set_ylim(get_autoscale_lim(min((resid - err).min(), 0),
+                                           max((resid + err).max(), 0), 'y'))
+
+    def _update_metadata_axes(self, row, plot_data):
+        axes = self.all_axes[1]
+
+        # CMD:
+        plx_snr = row['GAIAEDR3_PARALLAX'] / row['GAIAEDR3_PARALLAX_ERROR']
+        if row['M_H'] > -2.5 and plx_snr > 4:
+            dist = coord.Distance(parallax=row['GAIAEDR3_PARALLAX']*u.mas)
+            self.cmd_point.set_data([row['J'] - row['K']],
+                                    [row['J'] - dist.distmod.value])
+
+            H = get_cmd_hist(self.cmd_cache, row['M_H'])
+            if H.any():
+                self._source_artists.append(axes[0].pcolormesh(
+                    self.cmd_cache['color_bins'], self.cmd_cache['mag_bins'],
+                    np.ma.masked_less_equal(H.T, 0),
+                    cmap='Blues', norm=mpl.colors.LogNorm()))
+        else:
+            self.cmd_point.set_data([], [])
+
+        # Period-Eccentricity
+        samples = plot_data['samples']
+        if samples is not None:
+            self.mcmc_P_e.set_data(samples['P'].value, samples['e'].value)
+        else:
+            self.mcmc_P_e.set_data([], [])
+        joker_samples = plot_data['joker_samples']
+        self.joker_P_e.set_data(joker_samples['P'].value,
+                                joker_samples['e'].value)
+
+        # Mass / m2_min
+        ax = axes[2]
+        if np.isfinite(row['mass1_50']):
+            m1 = row['mass1_50'].value
+            self.mass_point.set_data([m1], [row['mass2_min_50'].value])
+            self.mass_err1.set_data([m1, m1],
+                                    [row['mass2_min_16'].value,
+                                     row['mass2_min_84'].value])
+            self.mass_err2.set_data([m1, m1],
+                                    [row['mass2_min_1'].value,
+                                     row['mass2_min_99'].value])
+            ax.set_visible(True)
+        else:
+            ax.set_visible(False)
+
+
+def get_diagnostic_figure(cmd_cache):
+    """The `DiagnosticFigure` for this process."""
+    if 'diagnostic' not in _figures:
+        _figures['diagnostic'] = DiagnosticFigure(cmd_cache)
+    return _figures['diagnostic']
+
+
 def worker(task):
-    allstar = at.QTable.read(
-        '/mnt/home/apricewhelan/data/APOGEE_DR17/allStar-dr17-synspec.fits',
-        hdu=1)
+    conf = task['conf']
+    telemetry = get_telemetry(conf, 'plots')
+    cmd_cache = load_cmd_cache(task['cmd_cache_file'])
+    if task['fast']:
+        diagnostic_figure = get_diagnostic_figure(cmd_cache)
+
+    fingerprints = {}
+    with h5py.File(conf.joker_results_file, 'r') as joker_f, \
+         h5py.File(conf.mcmc_results_file, 'r') as mcmc_f:
+
+        for row in task['metadata']:
+            source_id = row['APOGEE_ID']
+            this_plot_path = task['plot_path'] / f"{source_id}.png"
 
-    paths = []
-    for row in task['metadata']:
-        this_plot_path = task['plot_path'] / f"{row['APOGEE_ID']}.png"
+            try:
+                with telemetry.record(source_id,
+                                      n_visits=int(row['n_visits'])) as rec:
+                    fingerprint = get_samples_fingerprint([joker_f, mcmc_f],
+                                                          source_id)
 
-        try:
-            fig = plot_diagnostic(task['conf'], row, allstar)
-        except Exception as e:  # noqa
-            print(f"FAILED {row['APOGEE_ID']}: \n\t {e!s}")
-            continue
+                    # Skip sources whose plot was made from the same
+                    # samples:
+                    if (this_plot_path.exists() and
+                            task['manifest'].get(source_id) == fingerprint):
+                        fingerprints[source_id] = fingerprint
+                        rec['status'] = 'skipped'
+                        continue
 
-        fig.savefig(this_plot_path, dpi=200)
-        plt.close(fig)
+                    if task['fast']:
+                        fig = diagnostic_figure.update(
+                            row, get_plot_data(conf, row))
+                    else:
+                        fig = plot_diagnostic(conf, row, cmd_cache)
 
-        paths.append(this_plot_path)
+                    fig.savefig(this_plot_path, dpi=200)
+                    if not task['fast']:
+                        plt.close(fig)
 
-    return paths
+            except Exception as e:  # noqa
+                logger.warn(f"FAILED {source_id}: {e!s}")
+                continue
 
+            fingerprints[source_id] = fingerprint
 
-def make_gallery(www_path, paths):
-    filenames = [p.name for p in paths]
+    return fingerprints
+
+
+def make_gallery(www_path):
+    filenames = [p.name for p in www_path.glob('*.png')]
 
     fmt_str_visible = "<a href='{path}' data-sub-html='#{captionid}'><img src='{path}' width='512px' /></a>"
     fmt_str_hidden = "<a href='{path}' data-sub-html='#{captionid}'><img src='{path}' style='display: none;' /></a>"
@@ -334,7 +829,7 @@ def make_gallery(www_path, paths):
         f.write(html_page)
 
 
-def main(run_path, pool, overwrite, seed):
+def main(run_path, pool, overwrite, seed, fast=False):
     project_path = pathlib.Path(
         '/mnt/home/apricewhelan/projects/apogee-dr17-binaries/'
     )
@@ -343,43 +838,54 @@ def main(run_path, pool, overwrite, seed):
 
     conf = Config(project_path / 'hq-config/config.yml')
 
-    allstar = at.QTable.read(
-        '/mnt/home/apricewhelan/data/APOGEE_DR17/allStar-dr17-synspec.fits',
-        hdu=1)
-
-    sh = at.Table.read(
-        project_path / 'catalog-helpers/starhorse/starhorse_mass_m2_min.fits')
+    cmd_cache_file = project_path / 'plots/cmd-cache.npz'
+    if not cmd_cache_file.exists() or overwrite:
+        make_cmd_cache(load_allstar(allstar_plot_colnames),
+                       cmd_cache_file)
 
-    metadata = at.QTable.read(conf.metadata_file)
-    metadata = at.join(metadata, allstar, keys='APOGEE_ID')
-    metadata = at.join(at.Table(metadata), at.Table(sh),
-                       keys='APOGEE_ID', join_type='left')
-    metadata = at.unique(metadata, keys='APOGEE_ID')
-
-    # HACK: deal with the fact that QTable can't handle masking
-    for col in metadata.colnames:
-        if hasattr(metadata[col], 'mask') and np.any(metadata[col].mask):
-            metadata[col] = metadata[col].filled(np.nan)
-    metadata = at.QTable(metadata)
+    # Metadata merged with allStar and StarHorse masses, made by the
+    # vacpipe.assemble stage:
+    metadata = load_metadata(conf)
 
     # Select only good MCMC unimodal stars:
     good = metadata[(metadata['mcmc_status'] <= 2) &
                     (metadata['mcmc_completed'])]
 
+    # The manifest records the samples fingerprint of each plot on disk, so
+    # that only plots of sources with new samples are remade:
+    manifest_file = plot_path / 'manifest.json'
+    manifest = {}
+    if manifest_file.exists() and not overwrite:
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+
+    # Each plot has a large fixed cost (making and saving the figure), plus
+    # the cost of reading and plotting the visits and samples. Use smaller
+    # batches than workers, so the manifest is checkpointed often:
+    cost = get_source_cost(good, conf, per_source=1., per_visit=1e-2,
+                           per_sample=1e-4)
     tasks = []
-    for i1, i2 in batch_tasks(max(1, pool.size - 1), len(good)):
+    for idx in make_chunks(cost, 8 * max(1, pool.size - 1)):
+        task_metadata = good[idx]
         tasks.append({
             'conf': conf,
-            'metadata': good[i1:i2],
-            'plot_path': plot_path
+            'metadata': task_metadata,
+            'plot_path': plot_path,
+            'cmd_cache_file': cmd_cache_file,
+            'fast': fast,
+            'manifest': {k: manifest[k]
+                         for k in task_metadata['APOGEE_ID']
+                         if k in manifest}
         })
 
-    all_paths = []
-    for paths in pool.map(worker, tasks):
-        all_paths.append(paths)
-    all_paths = [path for sublist in all_paths for path in sublist]
+    def callback(fingerprints):
+        manifest.update(fingerprints)
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f)
+
+    map_tasks(pool, worker, tasks, callback=callback)
 
-    make_gallery(plot_path, all_paths)
+    make_gallery(plot_path)
 
 
 if __name__ == '__main__':
@@ -391,6 +897,11 @@ if __name__ == '__main__':
 
     parser.add_argument("-s", "--seed", dest="seed", default=None,
                         type=int, help="Random number seed")
+    parser.add_argument("--fast", dest="fast", default=False,
+                        action="store_true",
+                        help="Reuse one figure per worker and compute the "
+                             "RV curves in a vectorized batch on a coarser "
+                             "time grid")
     args = parser.parse_args(sys.argv[2:])
 
     if args.seed is None:
@@ -403,6 +914,7 @@ if __name__ == '__main__':
             main(run_path=args.run_path,
                  pool=pool,
                  overwrite=args.overwrite,
-                 seed=args.seed)
+                 seed=args.seed,
+                 fast=args.fast)
 
     sys.exit(0)
@@ -7,9 +7,7 @@
 #SBATCH -p cca
 #SBATCH --constraint=rome
 
-source ~/.bash_profile
-init_conda
-conda activate dr17-binaries
+source /mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/vac-pipeline/hq-config/init.sh
 echo $HQ_RUN_PATH
 
 cd /mnt/ceph/users/apricewhelan/projects/apogee-dr17-binaries/plots
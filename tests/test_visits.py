@@ -0,0 +1,43 @@
+# Third-party
+import astropy.table as at
+import numpy as np
+import pytest
+
+pytest.importorskip('thejoker')
+
+# Project
+from vacpipe.visits import VisitIndex
+
+
+def test_visit_index_fits_roundtrip(tmp_path):
+    ids = np.array(['2M00000002+7417074', '2M00000019-1924498',
+                    '2M00000002+7417074', 'VESTA', '2M00000019-1924498'])
+    data = at.Table()
+    data['APOGEE_ID'] = ids
+    data['JD'] = 2457000. + np.arange(len(ids))
+    data['VHELIO'] = np.arange(len(ids), dtype=float)
+    data['CALIB_VERR'] = np.full(len(ids), 0.1)
+
+    filename = tmp_path / 'visits.fits'
+    data.write(filename)
+    data = at.Table.read(filename)
+    assert np.asarray(data['APOGEE_ID']).dtype.kind == 'S'
+
+    index = VisitIndex(data)
+    assert index.source_ids.dtype.kind == 'U'
+    assert len(index) == 3
+    np.testing.assert_array_equal(index.get_counts(), [2, 2, 1])
+
+    for source_id in np.unique(ids):
+        for key in [source_id, source_id.encode(), source_id + '  ']:
+            assert key in index
+            visits = index[key]
+            assert np.all(np.char.strip(np.char.decode(
+                np.asarray(visits['APOGEE_ID']))) == source_id)
+            np.testing.assert_array_equal(
+                np.sort(visits['VHELIO']),
+                np.flatnonzero(ids == source_id))
+
+    assert 'missing' not in index
+    with pytest.raises(KeyError):
+        index.get_slice('missing')
@@ -0,0 +1 @@
+"""Shared helpers for the APOGEE DR17 binaries VAC pipeline scripts."""
@@ -0,0 +1,229 @@
+"""
+Assemble the source metadata used to make the plots and final catalogs: the
+HQ metadata file merged with the allStar columns for each source and (if it
+has been made with ``catalog-helpers/starhorse/make_masses.py``) the StarHorse
+primary masses and companion minimum masses. Run this as a pipeline stage
+with::
+
+    python3 -m vacpipe.assemble -v
+
+This replaces the ``at.join`` / ``at.unique`` / masked-to-NaN steps that were
+repeated in the plotting script and catalog notebooks. The rows of each table
+are found with a sorted APOGEE_ID index (for allStar, prebuilt and cached by
+`vacpipe.catalogs.get_row_index`), and each column is merged with a single
+array gather. Downstream code should use `load_metadata` to read the output
+(``cache/hq/metadata-assembled.fits``).
+
+With ``--update``, only the sources that changed since the last incremental
+commit (see `vacpipe.incremental`) are assembled again, and their rows are
+merged into the existing output file.
+"""
+
+# Standard library
+import json
+import pathlib
+
+# Third-party
+import astropy.table as at
+import numpy as np
+
+# Project
+from hq.config import Config
+from hq.log import logger
+from .catalogs import (allstar_file, get_row_index, load_allstar,
+                       lookup_rows)
+from .incremental import get_changed_sources, merge_rows
+
+__all__ = ['take_rows', 'assemble_metadata', 'load_metadata']
+
+starhorse_mass_file = (pathlib.Path(__file__).resolve().parent.parent /
+                       'catalog-helpers' / 'starhorse' /
+                       'starhorse_mass_m2_min.fits')
+
+
+def get_assembled_metadata_file(conf):
+    return pathlib.Path(conf.cache_path) / 'metadata-assembled.fits'
+
+
+def _get_ids(tbl):
+    return np.char.strip(np.asarray(tbl['APOGEE_ID'], dtype=str))
+
+
+def take_rows(tbl, idx):
+    """
+    Gather rows ``idx`` from all columns of a table. Rows with ``idx == -1``
+    are missing, and are filled with NaN (or 0 / empty for non-float
+    columns). Masked values in the input table are filled the same way, so
+    the output never has masked columns.
+    """
+    idx = np.asarray(idx)
+    missing = idx < 0
+    safe_idx = np.where(missing, 0, idx)
+
+    out = at.Table()
+    for name in tbl.colnames:
+        col = tbl[name]
+        unit = getattr(col, 'unit', None)
+        if getattr(col, 'mask', None) is not None and np.any(col.mask):
+            fill = np.nan if col.dtype.kind == 'f' else col.dtype.type(0)
+            col = col.filled(fill)
+        data = np.asarray(getattr(col, 'value', col))
+
+        data = data[safe_idx]
+        if np.any(missing):
+            if data.dtype.kind == 'f':
+                data[missing] = np.nan
+            else:
+                data[missing] = np.zeros((), dtype=data.dtype)
+
+        out[name] = at.Column(data, unit=unit)
+    return out
+
+
+def _merge_columns(out, other):
+    """
+    Add the columns of ``other`` to ``out`` in place, renaming conflicting
+    column names with ``_1`` and ``_2`` suffixes like `astropy.table.join`.
+    """
+    for name in other.colnames:
+        if name in out.colnames:
+            out.rename_column(name, f'{name}_1')
+            out[f'{name}_2'] = other[name]
+        else:
+            out[name] = other[name]
+
+
+def assemble_metadata(metadata, allstar, allstar_index, starhorse=None):
+    """
+    Merge the HQ metadata with allStar (an inner join on APOGEE_ID, using the
+    first allStar row for each source) and StarHorse masses (a left join).
+
+    Parameters
+    ----------
+    metadata : `~astropy.table.Table`
+    allstar : `~astropy.table.Table`
+    allstar_index : tuple
+        The APOGEE_ID index of ``allstar``, from
+        `vacpipe.catalogs.get_row_index`.
+    starhorse : `~astropy.table.Table` (optional)
+
+    Returns
+    -------
+    tbl : `~astropy.table.QTable`
+        One row per unique APOGEE_ID, sorted by APOGEE_ID. This is the same
+        as the output of `astropy.table.join` followed by
+        `astropy.table.unique`, except for sources with more than one allStar
+        row: the join leaves the order of those rows undefined (so
+        `astropy.table.unique` keeps an arbitrary one), and this always uses
+        the first one in the allStar file.
+    starhorse_colnames : list
+        The names of the columns that came from ``starhorse``.
+    """
+    ids, meta_idx = np.unique(_get_ids(metadata), return_index=True)
+
+    allstar_idx = lookup_rows(allstar_index, ids)
+    has_allstar = allstar_idx >= 0
+    if not np.all(has_allstar):
+        logger.debug(f'{np.sum(~has_allstar)} sources in the metadata file '
+                     'are not in allStar')
+    ids = ids[has_allstar]
+    meta_idx = meta_idx[has_allstar]
+    allstar_idx = allstar_idx[has_allstar]
+
+    tbl = take_rows(metadata, meta_idx)
+    tbl['APOGEE_ID'] = ids
+    _merge_columns(
+        tbl, take_rows(allstar[[x for x in allstar.colnames
+                                if x != 'APOGEE_ID']], allstar_idx))
+
+    starhorse_colnames = []
+    if starhorse is not None:
+        starhorse_index = np.unique(_get_ids(starhorse), return_index=True)
+        starhorse_idx = lookup_rows(starhorse_index, ids)
+        sh = take_rows(starhorse[[x for x in starhorse.colnames
+                                  if x != 'APOGEE_ID']], starhorse_idx)
+        colnames = set(tbl.colnames)
+        _merge_columns(tbl, sh)
+        starhorse_colnames = [x for x in tbl.colnames if x not in colnames]
+
+    return at.QTable(tbl), starhorse_colnames
+
+
+def load_metadata(conf, starhorse=True):
+    """
+    Read the assembled metadata file made by this stage.
+
+    Parameters
+    ----------
+    conf : `hq.config.Config`
+    starhorse : bool (optional)
+        Set this to False to drop the StarHorse mass columns.
+    """
+    tbl = at.QTable.read(get_assembled_metadata_file(conf))
+    starhorse_colnames = json.loads(tbl.meta.pop('SHCOLS', '[]'))
+    if not starhorse:
+        tbl.remove_columns(starhorse_colnames)
+    return tbl
+
+
+def main(run_path, overwrite=False, update=False):
+    conf = Config(run_path / 'config.yml')
+
+    output_file = get_assembled_metadata_file(conf)
+    update = update and output_file.exists() and not overwrite
+    if output_file.exists() and not overwrite and not update:
+        logger.warn(f'Output file exists at {output_file!s}')
+        return
+
+    metadata = at.QTable.read(conf.metadata_file)
+    allstar = load_allstar()
+    allstar_index = get_row_index(allstar_file, 'APOGEE_ID')
+
+    if starhorse_mass_file.exists():
+        starhorse = at.QTable.read(starhorse_mass_file)
+    else:
+        starhorse = None
+        logger.warn(f'No StarHorse mass file at {starhorse_mass_file!s}: '
+                    'run catalog-helpers/starhorse/make_masses.py to add '
+                    'the mass columns')
+
+    if update:
+        changed, removed = get_changed_sources(conf)
+        new, starhorse_colnames = assemble_metadata(
+            metadata[np.isin(_get_ids(metadata), changed)], allstar,
+            allstar_index, starhorse)
+
+        old = at.QTable.read(output_file)
+        old.meta.clear()
+        if old.colnames == new.colnames:
+            tbl = merge_rows(old, new, np.union1d(changed, removed))
+            logger.info(f'Updated {len(new)} rows of {output_file!s}')
+        else:
+            logger.info(f'The columns changed since {output_file!s} was '
+                        'made: assembling all sources')
+            update = False
+
+    if not update:
+        tbl, starhorse_colnames = assemble_metadata(metadata, allstar,
+                                                    allstar_index, starhorse)
+    tbl.meta['SHCOLS'] = json.dumps(starhorse_colnames)
+    tbl.write(output_file, overwrite=True)
+    logger.info(f'Wrote {len(tbl)} sources with {len(tbl.colnames)} columns '
+                f'to {output_file!s}')
+
+
+if __name__ == '__main__':
+    import sys
+    from hq.cli.helpers import get_parser
+
+    parser = get_parser(loggers=[logger])
+    parser.add_argument("--update", dest="update", default=False,
+                        action="store_true",
+                        help="Only assemble the sources that changed since "
+                             "the last incremental commit")
+    args = parser.parse_args(sys.argv[1:])
+
+    main(run_path=args.run_path, overwrite=args.overwrite,
+         update=args.update)
+
+    sys.exit(0)
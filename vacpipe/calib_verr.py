@@ -0,0 +1,810 @@
+"""
+Fit the visit velocity error calibration model of
+``notebooks/pipeline/1-Visit-Error-Calibrate.ipynb`` in overlapping bins of
+TEFF and LOGG. Run this as a pipeline stage with::
+
+    mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+        -m vacpipe.calib_verr -v --mpi
+
+The visit selection is the same as in the notebook, but the velocity of each
+visit relative to the mean of its star (``DVHELIO``) is computed once for all
+stars instead of once per bin, and the stars in each bin are found with a
+TEFF-sorted index and the visits of each star with an offset table. The pymc3
+model, and the functions for its log-probability, gradient, and parameter
+values, are built and compiled once in each worker process: fitting a bin
+only swaps in the bin's data and runs the optimizer.
+
+The MAP parameters for each bin are written to ``cache/calib-verr-model.fits``
+(one row per bin, with the bin centers and mean TEFF/LOGG of the stars in the
+bin), and also in the ``(bin_means, map_estimates)`` pickle format read by the
+notebook.
+
+With ``--apply``, the fitted model is instead evaluated for all visits in the
+allVisit file (the "Apply to the full allVisit file" section of the notebook)
+to write the calibrated visit errors, ``CALIB_VERR``. This is done with
+`get_calib_verr`, which evaluates the model with numpy on arrays of TEFF,
+LOGG, SNR, M_H, and CCFWHM, so it can also be used for new or reprocessed
+visits. The errors are written to
+``cache/allVisit-dr17-synspec-calib-verr.fits`` (VISIT_ID and CALIB_VERR), and
+the array with one value per allVisit row (NaN for visits that are not
+calibrated) that `get_calib_verr_rows` and `lookup_calib_verr` read is then
+made from that file. Add ``--check`` to compare the errors with the existing
+file instead of writing them.
+
+`get_calib_verr` has not been checked against the errors computed by theano in
+the notebook, so ``--apply`` only replaces an existing file if the errors agree
+with it to within ``--rtol`` (relative, ``default_check_rtol`` by default).
+"""
+
+# Standard library
+import os
+import pathlib
+import pickle
+import time
+
+# Third-party
+import astropy.table as at
+import numpy as np
+
+# Project
+from hq.log import logger
+from .catalogs import (allvisit_file, get_row_index, load_allstar,
+                       load_allvisit, lookup_rows, read_fits_columns)
+
+__all__ = ['get_calibration_visits', 'get_bins', 'fit_bin', 'read_model',
+           'get_calib_verr', 'get_calib_verr_rows', 'lookup_calib_verr']
+
+cache_path = pathlib.Path(__file__).resolve().parent.parent / 'cache'
+model_file = cache_path / 'calib-verr-model.fits'
+map_pickle_file = cache_path / 'logg_teff_grid_MAPs-vsini.pkl'
+calib_verr_file = cache_path / f'{allvisit_file.stem}-calib-verr.fits'
+calib_verr_rows_file = cache_path / f'{allvisit_file.stem}-calib-verr-rows.npy'
+
+allstar_colnames = ['APOGEE_ID', 'TEFF', 'LOGG', 'M_H', 'STARFLAG',
+                    'ASPCAPFLAG']
+allvisit_colnames = ['APOGEE_ID', 'PLATE', 'MJD', 'FIBERID', 'STARFLAG',
+                     'RV_FLAG', 'N_COMPONENTS', 'SNR', 'VHELIO', 'CCFWHM']
+
+starflag_bits = [
+    3,   # VERY_BRIGHT_NEIGHBOR
+    16,  # SUSPECT_RV_COMBINATION
+    18,  # BAD_RV_COMBINATION
+    19,  # RV_REJECT
+    20,  # RV_SUSPECT
+    21,  # MULTIPLE_SUSPECT
+    22   # RV_FAIL
+]
+rvflag_bits = [
+    1,   # RV_BCFIT_FAIL
+    3,   # RV_WINDOW_MASK
+    4,   # RV_VALUE_ERROR
+    5,   # RV_RUNTIME_ERROR
+    6,   # RV_ERROR
+    8,   # NO_GOOD_VISITS
+    9,   # ALL_VISITS_REJECTED
+    10,  # RV_REJECT
+    11,  # RV_SUSPECT
+]
+min_nvisits = 3
+
+# Bins are boxes 3 steps wide, centered on a grid with these steps:
+teff_step = 400
+logg_step = 0.4
+teff_ctrs = np.arange(3000, 8000+1e-3, teff_step)
+logg_ctrs = np.arange(-logg_step, 6+1e-3, logg_step)
+m_h_lim = (-2.5, 1)
+n_visit_min = 256
+n_star_min = 64
+
+# Constants in the model:
+snr0 = 40.
+Z0 = 1.
+n_components = 3
+R = 22500
+
+# Visits the model is applied to (the limits are on the allStar values):
+apply_allstar_colnames = ['APOGEE_ID', 'TEFF', 'LOGG', 'M_H', 'SNR']
+apply_allvisit_colnames = ['APOGEE_ID', 'VISIT_ID', 'PLATE', 'MJD',
+                           'FIBERID', 'SNR', 'CCFWHM']
+apply_lims = {'TEFF': (2500, 8000),
+              'LOGG': (-1, 6),
+              'M_H': (-4, 1),
+              'SNR': (2, 1e6)}
+max_calib_verr = 1e2
+
+# The largest relative difference from an existing CALIB_VERR file that
+# --apply accepts before replacing it (float64 rounding differences only):
+default_check_rtol = 1e-10
+
+model_parnames = ['a_0', 'a_z1', 'b_0', 'b_z1', 'b_vrot1', 'f_vrot',
+                  'lnbs1', 'lnbs2', 'w']
+init_pars = {
+    'a_0': 0.05,
+    'a_z1': -0.003,
+    'b_0': 0.05,
+    'b_z1': 1e-4,
+    'b_vrot1': 0.01465298,
+    'f_vrot': 0.09,
+    'lnbs1': 1.6,
+    'lnbs2': 4.5,
+    'w': np.ones(n_components)
+}
+
+# Compiled models, one per process
+_models = {}
+
+
+def get_bitmask(bits):
+    return int(np.sum(2 ** np.array(bits, dtype=np.int64)))
+
+
+def get_calibration_visits(allstar, allvisit):
+    """
+    Apply the star and visit cuts used for the calibration, and compute the
+    velocity of each visit relative to the mean velocity of its star.
+
+    Returns
+    -------
+    stars : `~astropy.table.Table`
+        One row per star, sorted by TEFF, with columns APOGEE_ID, TEFF, LOGG,
+        and M_H.
+    visits : `~astropy.table.Table`
+        The visits, grouped by star in the same order as ``stars``, with
+        columns SNR, CCFWHM, M_H (of the star), and DVHELIO.
+    offsets : `numpy.ndarray`
+        The visits of star ``i`` are ``visits[offsets[i]:offsets[i+1]]``.
+    """
+    starflag_bitmask = get_bitmask(starflag_bits)
+    rvflag_bitmask = get_bitmask(rvflag_bits)
+
+    # One allStar row per APOGEE_ID:
+    star_ids, idx = np.unique(np.asarray(allstar['APOGEE_ID']),
+                              return_index=True)
+    star_mask = (((allstar['ASPCAPFLAG'][idx] & 2**23) == 0) &  # STAR_BAD
+                 ((allstar['STARFLAG'][idx] & starflag_bitmask) == 0) &
+                 (allstar['M_H'][idx] > -2.5))
+    star_ids = star_ids[star_mask]
+    idx = idx[star_mask]
+
+    # Visit cuts (note: the STARFLAG cut is a modulus, as in the notebook):
+    visit_ids = np.asarray(allvisit['APOGEE_ID'])
+    visit_mask = (((allvisit['STARFLAG'] % starflag_bitmask) == 0) &
+                  (allvisit['N_COMPONENTS'] == 1) &
+                  ((allvisit['RV_FLAG'] & rvflag_bitmask) == 0) &
+                  (allvisit['SNR'] > 4) &
+                  np.isfinite(allvisit['VHELIO']) &
+                  np.isin(visit_ids, star_ids))
+    visit_idx = np.flatnonzero(visit_mask)
+
+    # Remove duplicate visits (the first of each PLATE, MJD, FIBERID):
+    keys = [np.asarray(allvisit[name])[visit_idx]
+            for name in ['PLATE', 'MJD', 'FIBERID']]
+    order = np.lexsort(keys[::-1])
+    sorted_keys = [k[order] for k in keys]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = np.any([k[1:] != k[:-1] for k in sorted_keys], axis=0)
+    visit_idx = visit_idx[np.sort(order[first])]
+
+    # Only keep stars with enough visits:
+    star_code = np.searchsorted(star_ids, visit_ids[visit_idx])
+    counts = np.bincount(star_code, minlength=len(star_ids))
+    keep_star = counts >= min_nvisits
+    keep_visit = keep_star[star_code]
+    visit_idx = visit_idx[keep_visit]
+    star_code = star_code[keep_visit]
+
+    # Velocities relative to the mean of each star:
+    vhelio = np.asarray(allvisit['VHELIO'], dtype=float)[visit_idx]
+    mean_v = (np.bincount(star_code, weights=vhelio, minlength=len(counts)) /
+              np.maximum(counts, 1))
+    dv = vhelio - mean_v[star_code]
+
+    # The stellar parameters, SNR, and CCFWHM keep the dtypes of the catalog
+    # columns, so that the cuts, bin means, and median CCFWHM are computed
+    # the same way as in the notebook:
+    stars = at.Table()
+    stars['APOGEE_ID'] = star_ids
+    for name in ['TEFF', 'LOGG', 'M_H']:
+        stars[name] = np.asarray(allstar[name])[idx]
+
+    # Sort the stars by TEFF, and group the visits in the same order:
+    new_code = np.full(len(star_ids), -1)
+    star_order = np.flatnonzero(keep_star)
+    star_order = star_order[np.argsort(stars['TEFF'][star_order],
+                                       kind='stable')]
+    new_code[star_order] = np.arange(len(star_order))
+    stars = stars[star_order]
+
+    visit_order = np.argsort(new_code[star_code], kind='stable')
+    visits = at.Table()
+    visits['SNR'] = np.asarray(allvisit['SNR'])[visit_idx][visit_order]
+    visits['CCFWHM'] = np.asarray(allvisit['CCFWHM'])[visit_idx][visit_order]
+    visits['M_H'] = stars['M_H'][new_code[star_code][visit_order]]
+    visits['DVHELIO'] = dv[visit_order]
+
+    offsets = np.concatenate(([0], np.cumsum(counts[star_order])))
+    return stars, visits, offsets
+
+
+def get_visit_idx(offsets, star_idx):
+    """The indices of all visits of the stars ``star_idx``."""
+    counts = offsets[star_idx + 1] - offsets[star_idx]
+    starts = offsets[star_idx] - np.cumsum(counts) + counts
+    return np.repeat(starts, counts) + np.arange(counts.sum())
+
+
+def get_star_mask(stars, i1, i2, logg_lim, m_h_lim):
+    s = slice(i1, i2)
+    return ((stars['LOGG'][s] > logg_lim[0]) &
+            (stars['LOGG'][s] < logg_lim[1]) &
+            (stars['M_H'][s] > m_h_lim[0]) &
+            (stars['M_H'][s] < m_h_lim[1]))
+
+
+def get_bins(stars, offsets):
+    """
+    Find the stars and visits in each bin on the TEFF, LOGG grid.
+
+    Returns
+    -------
+    bins : list of dict
+        The grid point, the indices of the stars in the bin, and the indices
+        of their visits, for each bin with enough stars and visits.
+    """
+    teff = np.asarray(stars['TEFF'])
+    teff_half_size = teff_step * 3 / 2
+    logg_half_size = logg_step * 3 / 2
+
+    teff_grid, logg_grid = np.meshgrid(teff_ctrs, logg_ctrs)
+    bins = []
+    for teff_val, logg_val in zip(teff_grid.ravel(), logg_grid.ravel()):
+        # The stars are sorted by TEFF, so the ones in the TEFF range of the
+        # bin are a contiguous slice:
+        i1 = np.searchsorted(teff, teff_val - teff_half_size, side='right')
+        i2 = np.searchsorted(teff, teff_val + teff_half_size, side='left')
+        star_idx = i1 + np.flatnonzero(
+            get_star_mask(stars, i1, i2,
+                          (logg_val - logg_half_size,
+                           logg_val + logg_half_size),
+                          m_h_lim))
+
+        visit_idx = get_visit_idx(offsets, star_idx)
+        if len(star_idx) < n_star_min or len(visit_idx) < n_visit_min:
+            continue
+
+        bins.append({'teff_ctr': teff_val,
+                     'logg_ctr': logg_val,
+                     'star_idx': star_idx,
+                     'visit_idx': visit_idx})
+
+    return bins
+
+
+def get_med_ccfwhm(stars, visits, offsets):
+    """
+    CCFWHM is measured relative to its median over the full TEFF, LOGG, M_H
+    range of the calibration sample.
+    """
+    full_mask = get_star_mask(stars, 0, len(stars), (-0.6, 6), (-3, 1))
+    full_mask &= (stars['TEFF'] > 2000) & (stars['TEFF'] < 8000)
+    return np.median(np.asarray(visits['CCFWHM'])[
+        get_visit_idx(offsets, np.flatnonzero(full_mask))])
+
+
+def get_model_data(visits, med_ccfwhm):
+    return {
+        'vs': np.asarray(visits['DVHELIO']),
+        'snrs': np.asarray(visits['SNR']),
+        'm_hs': np.asarray(visits['M_H']),
+        'ccfwhms': np.asarray(visits['CCFWHM']) - med_ccfwhm
+    }
+
+
+def get_vsini_floor():
+    from astropy.constants import c as speedoflight
+    import astropy.units as u
+
+    return (speedoflight / R).to_value(u.km/u.s)
+
+
+def make_model():
+    """The calibration model (the same as in the notebook)."""
+    import pymc3 as pm
+    import theano.tensor as tt
+
+    vsini_floor = get_vsini_floor()
+
+    with pm.Model() as model:
+        snr0_ = pm.Data('snr0', snr0)
+        Z0_ = pm.Data('Z0', Z0)
+
+        vs = pm.Data('vs', np.zeros(1))
+        snrs = pm.Data('snrs', np.zeros(1))
+        m_hs = pm.Data('m_hs', np.zeros(1))
+        ccfwhms = pm.Data('ccfwhms', np.zeros(1))
+
+        ws = pm.Dirichlet('w', a=np.ones(n_components), shape=n_components)
+
+        Z = 10 ** m_hs
+        dZ = Z - Z0_
+        b_vrot1 = pm.Bound(pm.Normal, lower=0.)('b_vrot1', 0, 0.1)
+        f_vrot = pm.Bound(pm.Normal, lower=0)('f_vrot', 0, 0.1)
+        vsini_term = b_vrot1**2 * (ccfwhms**2 + f_vrot * vsini_floor**2)
+
+        a_0 = pm.Normal('a_0', 0, 0.1)
+        a_z1 = pm.Normal('a_z1', 0, 0.2)
+        a = a_0 + a_z1 * dZ
+
+        b_0 = pm.Normal('b_0', 0, 0.2)
+        b_z1 = pm.Normal('b_z1', 0, 0.2)
+        b = b_0 + b_z1 * dZ
+
+        err1 = pm.Deterministic(
+            'err1', tt.sqrt(a**2 + b**2 / (snrs / snr0_)**2 + vsini_term))
+        norm1 = pm.Normal.dist(0, err1)
+
+        # binaries
+        lnbs1 = pm.Uniform('lnbs1', -0.7, 4)
+        err2 = pm.Deterministic('err2', tt.sqrt(err1**2 + tt.exp(lnbs1)**2))
+        norm2 = pm.Normal.dist(0, err2)
+
+        # excess variance
+        lnbs2 = pm.Uniform('lnbs2', 1.6, 5.5)
+        err3 = pm.Deterministic('err3', tt.sqrt(err2**2 + tt.exp(lnbs2)**2))
+        norm3 = pm.Normal.dist(0, err3)
+
+        pm.Mixture('like', w=ws, comp_dists=[norm1, norm2, norm3],
+                   observed=vs)
+
+    return model
+
+
+def get_compiled_model():
+    """
+    Build the model and compile its log-probability (and gradient) function
+    and the function that returns all parameter values, once per process.
+    The data are ``pm.Data`` containers, so these stay valid when the data
+    are changed with ``pm.set_data``.
+    """
+    if 'model' not in _models:
+        from pymc3.util import get_default_varnames
+
+        model = make_model()
+        with model:
+            logp_dlogp = model.logp_dlogp_function()
+            logp_dlogp.set_extra_values({})
+            outputs = get_default_varnames(model.unobserved_RVs,
+                                           include_transformed=True)
+            point_fn = model.fastfn(outputs)
+        _models['model'] = (model, logp_dlogp, [x.name for x in outputs],
+                            point_fn)
+    return _models['model']
+
+
+def fit_bin(data, start=None):
+    """
+    Find the MAP parameters of the calibration model for the visits in one
+    bin (see `get_model_data`).
+
+    Returns
+    -------
+    map_estimate : dict, None
+        The values of all parameters (including transformed parameters and
+        deterministics) at the MAP, or None if the optimizer failed.
+    """
+    import pymc3 as pm
+    from pymc3.util import update_start_vals
+    from scipy.optimize import minimize
+
+    model, logp_dlogp, names, point_fn = get_compiled_model()
+
+    if start is None:
+        start = init_pars
+    start = {k: np.array(v) for k, v in start.items()}
+
+    with model:
+        pm.set_data(data)
+        update_start_vals(start, model.test_point, model)
+
+    def neg_logp(x):
+        logp, dlogp = logp_dlogp(x)
+        return -logp, -dlogp
+
+    try:
+        x0 = logp_dlogp.dict_to_array(start)
+        res = minimize(neg_logp, x0, jac=True, method='L-BFGS-B')
+    except Exception as e:
+        logger.warn(f'Optimizer failed: {e!s}')
+        return None
+
+    values = point_fn(logp_dlogp.array_to_full_dict(res.x))
+    return dict(zip(names, values))
+
+
+def read_model(filename=None):
+    """
+    Read the fitted calibration model, either from the output file of this
+    stage (the default) or from a ``(bin_means, map_estimates)`` pickle file
+    written by the notebook.
+
+    Returns
+    -------
+    tbl : `~astropy.table.Table`
+        One row per bin, with columns TEFF_MEAN, LOGG_MEAN, and the MAP value
+        of each model parameter. The pickle files do not store the median
+        CCFWHM, so for these ``tbl.meta`` does not have ``MEDCCFWH``.
+    """
+    if filename is None:
+        filename = model_file
+    filename = pathlib.Path(filename)
+
+    if filename.suffix != '.pkl':
+        return at.Table.read(filename)
+
+    with open(filename, 'rb') as f:
+        bin_means, map_estimates = pickle.load(f)
+
+    tbl = at.Table()
+    tbl['TEFF_MEAN'] = bin_means[:, 0]
+    tbl['LOGG_MEAN'] = bin_means[:, 1]
+    for name in model_parnames:
+        tbl[name] = np.array([x[name] for x in map_estimates])
+    return tbl
+
+
+def get_bin_index(model_tbl, teff, logg):
+    """
+    The index of the nearest bin (in TEFF_MEAN, LOGG_MEAN, in units of the
+    grid steps) for each visit.
+    """
+    from scipy.spatial import cKDTree
+
+    metric = np.array([teff_step, logg_step])
+    bin_means = np.stack((model_tbl['TEFF_MEAN'], model_tbl['LOGG_MEAN'])).T
+    X = np.stack((np.asarray(teff), np.asarray(logg))).T
+
+    kdtree = cKDTree(bin_means / metric)
+    _, idx = kdtree.query(X / metric)
+    return idx
+
+
+def get_calib_verr(model_tbl, teff, logg, snr, m_h, ccfwhm, med_ccfwhm=None):
+    """
+    Evaluate the calibrated visit velocity error (the ``err1`` term of the
+    model, with the MAP parameters of the nearest bin) for arrays of visits.
+
+    The inputs are cast, and the terms are computed, in the same order as when
+    ``err1`` is evaluated in the pymc3 model in the notebook, so that the
+    output matches the ``CALIB_VERR`` values computed there.
+
+    Parameters
+    ----------
+    model_tbl : `~astropy.table.Table`
+        The fitted model (see `read_model`).
+    teff, logg, m_h : array-like
+        The stellar parameters (from allStar) for each visit.
+    snr, ccfwhm : array-like
+        The visit SNR and CCFWHM (from allVisit).
+    med_ccfwhm : float (optional)
+        The median CCFWHM of the calibration sample. Defaults to the value in
+        ``model_tbl.meta['MEDCCFWH']``.
+
+    Returns
+    -------
+    calib_verr : `numpy.ndarray`
+        The calibrated errors in km/s, clipped at ``max_calib_verr``.
+    """
+    if med_ccfwhm is None:
+        med_ccfwhm = model_tbl.meta['MEDCCFWH']
+
+    idx = get_bin_index(model_tbl, teff, logg)
+    pars = {name: np.asarray(model_tbl[name], dtype=np.float64)[idx]
+            for name in ['a_0', 'a_z1', 'b_0', 'b_z1', 'b_vrot1', 'f_vrot']}
+
+    # The median is subtracted in the precision of the CCFWHM column (as in
+    # the notebook), and the data are then cast to float64 like the pm.Data
+    # containers in the model:
+    ccfwhm = np.asarray(ccfwhm)
+    dtype = np.result_type(ccfwhm.dtype, np.float32)
+    ccfwhms = (ccfwhm.astype(dtype) -
+               dtype.type(med_ccfwhm)).astype(np.float64)
+    snrs = np.asarray(snr, dtype=np.float64)
+    m_hs = np.asarray(m_h, dtype=np.float64)
+
+    dZ = 10 ** m_hs - Z0
+    vsini_term = pars['b_vrot1']**2 * (
+        ccfwhms**2 + pars['f_vrot'] * get_vsini_floor()**2)
+    a = pars['a_0'] + pars['a_z1'] * dZ
+    b = pars['b_0'] + pars['b_z1'] * dZ
+    err1 = np.sqrt(a**2 + b**2 / (snrs / snr0)**2 + vsini_term)
+
+    return np.clip(err1, None, max_calib_verr)
+
+
+def get_apply_visits(allstar, allvisit):
+    """
+    Select the visits to calibrate, with the same cuts as the notebook: the
+    visits of all allStar rows within ``apply_lims``, with duplicate visits
+    (by PLATE, MJD, FIBERID) removed, and with finite stellar parameters, SNR,
+    and CCFWHM.
+
+    Returns
+    -------
+    visit_idx : `numpy.ndarray`
+        The allVisit rows of the visits, sorted by PLATE, MJD, FIBERID (the
+        order of the ``CALIB_VERR`` file).
+    star_idx : `numpy.ndarray`
+        The allStar row of the star for each visit.
+    """
+    star_mask = np.ones(len(allstar['APOGEE_ID']), dtype=bool)
+    for name, lim in apply_lims.items():
+        star_mask &= (allstar[name] > lim[0]) & (allstar[name] < lim[1])
+    star_rows = np.flatnonzero(star_mask)
+    star_ids = np.asarray(allstar['APOGEE_ID'])[star_rows]
+
+    visit_ids = np.asarray(allvisit['APOGEE_ID'])
+    visit_rows = np.flatnonzero(np.isin(visit_ids, star_ids))
+
+    # Which of the duplicate visits is kept depends on the order of the rows
+    # in the output of `astropy.table.join`, so this uses the same join and
+    # unique as the notebook, but with only the key and row index columns:
+    stars = at.Table({'APOGEE_ID': star_ids, 'star_idx': star_rows})
+    visits = at.Table({'APOGEE_ID': visit_ids[visit_rows],
+                       'visit_idx': visit_rows})
+    for name in ['PLATE', 'MJD', 'FIBERID']:
+        visits[name] = np.asarray(allvisit[name])[visit_rows]
+    visits = at.join(visits, stars, keys='APOGEE_ID', join_type='left')
+    visits = at.unique(visits, keys=('PLATE', 'MJD', 'FIBERID'))
+    visit_idx = np.asarray(visits['visit_idx'])
+    star_idx = np.asarray(visits['star_idx'])
+
+    finite = np.all([np.isfinite(np.asarray(allstar[name])[star_idx])
+                     for name in ['LOGG', 'TEFF', 'M_H']] +
+                    [np.isfinite(np.asarray(allvisit[name])[visit_idx])
+                     for name in ['SNR', 'CCFWHM']], axis=0)
+    return visit_idx[finite], star_idx[finite]
+
+
+def save_calib_verr_rows(rows):
+    # Write to a temporary file first, so that processes reading the array
+    # at the same time never see a partial file:
+    tmp_file = calib_verr_rows_file.with_name(
+        f'.{calib_verr_rows_file.name}.{os.getpid()}.npy')
+    np.save(tmp_file, rows)
+    os.replace(tmp_file, calib_verr_rows_file)
+
+
+def get_calib_verr_rows():
+    """
+    The ``CALIB_VERR`` of each row of the allVisit file (NaN for visits that
+    are not calibrated), as a read-only memory-mapped array.
+
+    The array is written by the ``--apply`` stage. If it does not exist, or
+    is older than ``calib_verr_file`` (e.g., if that was written by the
+    notebook), it is made from ``calib_verr_file`` first.
+    """
+    if (not calib_verr_rows_file.exists() or
+            (calib_verr_file.exists() and
+             calib_verr_rows_file.stat().st_mtime <
+             calib_verr_file.stat().st_mtime)):
+        verr = read_fits_columns(calib_verr_file, cache_path=False)
+        verr_index = np.unique(np.asarray(verr['VISIT_ID']),
+                               return_index=True)
+        i = lookup_rows(verr_index, load_allvisit(['VISIT_ID'])['VISIT_ID'])
+
+        rows = np.full(len(i), np.nan)
+        rows[i >= 0] = np.asarray(verr['CALIB_VERR'])[i[i >= 0]]
+        save_calib_verr_rows(rows)
+
+    return np.load(calib_verr_rows_file, mmap_mode='r')
+
+
+def lookup_calib_verr(visit_ids):
+    """
+    Look up the ``CALIB_VERR`` for the given VISIT_IDs (NaN for visits that
+    are not calibrated or not in the allVisit file).
+    """
+    rows = lookup_rows(get_row_index(allvisit_file, 'VISIT_ID'), visit_ids)
+    calib_verr = np.array(get_calib_verr_rows()[np.where(rows < 0, 0, rows)])
+    calib_verr[rows < 0] = np.nan
+    return calib_verr
+
+
+def worker(task):
+    t0 = time.time()
+    map_estimate = fit_bin(task['data'])
+    logger.debug(f"TEFF={task['teff_ctr']:.0f}, LOGG={task['logg_ctr']:.1f}: "
+                 f"{task['n_stars']} stars, {len(task['data']['vs'])} visits, "
+                 f"fit in {time.time() - t0:.1f} seconds")
+    return task['i'], map_estimate
+
+
+def main(pool, overwrite=False):
+    if model_file.exists() and not overwrite:
+        logger.warn(f'Output file exists at {model_file!s}')
+        return
+
+    allstar = load_allstar(allstar_colnames)
+    allvisit = load_allvisit(allvisit_colnames)
+    stars, visits, offsets = get_calibration_visits(allstar, allvisit)
+    logger.info(f'{len(stars)} stars and {len(visits)} visits for the '
+                'calibration')
+
+    med_ccfwhm = get_med_ccfwhm(stars, visits, offsets)
+
+    bins = get_bins(stars, offsets)
+    logger.info(f'Fitting {len(bins)} bins')
+
+    tasks = []
+    for i, b in enumerate(bins):
+        tasks.append({
+            'i': i,
+            'teff_ctr': b['teff_ctr'],
+            'logg_ctr': b['logg_ctr'],
+            'n_stars': len(b['star_idx']),
+            'data': get_model_data(visits[b['visit_idx']], med_ccfwhm)
+        })
+
+    map_estimates = [None] * len(bins)
+    for i, map_estimate in pool.map(worker, tasks):
+        map_estimates[i] = map_estimate
+
+    # Bins where the optimizer failed are dropped, as in the notebook:
+    good = [i for i, x in enumerate(map_estimates) if x is not None]
+    bins = [bins[i] for i in good]
+    map_estimates = [map_estimates[i] for i in good]
+
+    tbl = at.Table()
+    tbl['TEFF_CTR'] = [b['teff_ctr'] for b in bins]
+    tbl['LOGG_CTR'] = [b['logg_ctr'] for b in bins]
+    tbl['TEFF_MEAN'] = [np.mean(stars['TEFF'][b['star_idx']]) for b in bins]
+    tbl['LOGG_MEAN'] = [np.mean(stars['LOGG'][b['star_idx']]) for b in bins]
+    tbl['N_STARS'] = [len(b['star_idx']) for b in bins]
+    tbl['N_VISITS'] = [len(b['visit_idx']) for b in bins]
+    for name in model_parnames:
+        tbl[name] = np.array([x[name] for x in map_estimates])
+
+    tbl.meta['MEDCCFWH'] = float(med_ccfwhm)
+    tbl.meta['SNR0'] = snr0
+    tbl.meta['Z0'] = Z0
+    tbl.meta['R'] = R
+    tbl.meta['TEFFSTEP'] = teff_step
+    tbl.meta['LOGGSTEP'] = logg_step
+    tbl.write(model_file, overwrite=True)
+    logger.info(f'Wrote {len(tbl)} bins to {model_file!s}')
+
+    bin_means = np.stack((tbl['TEFF_MEAN'], tbl['LOGG_MEAN'])).T
+    with open(map_pickle_file, 'wb') as f:
+        pickle.dump((bin_means, map_estimates), f)
+
+
+def check_calib_verr(visit_ids, calib_verr, filename, rtol=0.):
+    """
+    Compare calibrated errors with the ones in an existing ``CALIB_VERR``
+    file, and log the number of visits that differ and the largest relative
+    difference.
+
+    Returns
+    -------
+    match : bool
+        True if the file has the same visits and all errors agree to within
+        ``rtol`` (relative), or are bit-identical if ``rtol`` is 0.
+    """
+    old = read_fits_columns(filename, cache_path=False)
+    old_index = np.unique(np.asarray(old['VISIT_ID']), return_index=True)
+    i = lookup_rows(old_index, visit_ids)
+    found = i >= 0
+
+    old_verr = np.asarray(old['CALIB_VERR'], dtype=np.float64)[i[found]]
+    new_verr = np.asarray(calib_verr, dtype=np.float64)[found]
+    n_diff = np.sum(old_verr.view(np.uint64) != new_verr.view(np.uint64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rel_diff = np.abs(new_verr - old_verr) / np.abs(old_verr)
+    rel_diff[old_verr == new_verr] = 0.
+    max_rel_diff = np.max(np.nan_to_num(rel_diff, nan=np.inf), initial=0.)
+
+    n_new = np.sum(~found)
+    n_old = len(old) - len(np.unique(i[found]))
+    logger.info(f'{np.sum(found)} visits in both: {n_diff} differ, max '
+                f'relative difference {max_rel_diff:.3g}')
+    logger.info(f'{n_new} visits not in {filename!s}, {n_old} visits only in '
+                f'{filename!s}')
+    return max_rel_diff <= rtol and n_new == 0 and n_old == 0
+
+
+def apply_main(model_filename=None, overwrite=False, check=False,
+               rtol=default_check_rtol):
+    if calib_verr_file.exists() and not overwrite and not check:
+        logger.warn(f'Output file exists at {calib_verr_file!s}')
+        return
+
+    model_tbl = read_model(model_filename)
+    med_ccfwhm = model_tbl.meta.get('MEDCCFWH')
+    if med_ccfwhm is None:
+        stars, visits, offsets = get_calibration_visits(
+            load_allstar(allstar_colnames), load_allvisit(allvisit_colnames))
+        med_ccfwhm = get_med_ccfwhm(stars, visits, offsets)
+
+    allstar = load_allstar(apply_allstar_colnames)
+    allvisit = load_allvisit(apply_allvisit_colnames)
+    visit_idx, star_idx = get_apply_visits(allstar, allvisit)
+
+    t0 = time.time()
+    calib_verr = get_calib_verr(
+        model_tbl,
+        teff=np.asarray(allstar['TEFF'])[star_idx],
+        logg=np.asarray(allstar['LOGG'])[star_idx],
+        snr=np.asarray(allvisit['SNR'])[visit_idx],
+        m_h=np.asarray(allstar['M_H'])[star_idx],
+        ccfwhm=np.asarray(allvisit['CCFWHM'])[visit_idx],
+        med_ccfwhm=med_ccfwhm)
+    logger.info(f'Computed CALIB_VERR for {len(calib_verr)} visits in '
+                f'{time.time() - t0:.1f} seconds')
+
+    visit_ids = np.asarray(allvisit['VISIT_ID'])[visit_idx]
+    if calib_verr_file.exists():
+        # Never silently replace the errors computed by the notebook (with
+        # theano) by ones that don't match them:
+        match = check_calib_verr(visit_ids, calib_verr, calib_verr_file,
+                                 rtol=rtol)
+        if check:
+            return
+        if not match:
+            raise RuntimeError(
+                f'The errors differ from the ones in {calib_verr_file!s} by '
+                f'more than rtol={rtol:g} (or the visits differ), so the file '
+                'was not replaced. Use a larger --rtol, or delete the file, '
+                'to replace it anyway.')
+
+    elif check:
+        logger.warn(f'No CALIB_VERR file to check at {calib_verr_file!s}')
+        return
+
+    tbl = at.Table()
+    tbl['VISIT_ID'] = visit_ids
+    tbl['CALIB_VERR'] = calib_verr
+    tbl.write(calib_verr_file, overwrite=True)
+    logger.info(f'Wrote {len(tbl)} visits to {calib_verr_file!s}')
+
+    # The per-row array is always made from the file just written, so it
+    # has the same values that a join on VISIT_ID with the file would give:
+    get_calib_verr_rows()
+
+
+if __name__ == '__main__':
+    import sys
+    from threadpoolctl import threadpool_limits
+    from hq.cli.helpers import get_parser
+
+    parser = get_parser(loggers=[logger])
+
+    parser.add_argument("--apply", dest="apply", default=False,
+                        action="store_true",
+                        help="Compute CALIB_VERR for the allVisit file with "
+                             "the fitted model")
+    parser.add_argument("--check", dest="check", default=False,
+                        action="store_true",
+                        help="With --apply, compare with the existing "
+                             "CALIB_VERR file instead of writing it")
+    parser.add_argument("--rtol", dest="rtol", default=default_check_rtol,
+                        type=float,
+                        help="With --apply, the largest relative difference "
+                             "from the existing CALIB_VERR file that is "
+                             "accepted before replacing it")
+    parser.add_argument("--model-file", dest="model_file", default=None,
+                        help="The fitted model to apply (this stage's output "
+                             "file by default, or a notebook pickle file)")
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.apply:
+        apply_main(model_filename=args.model_file,
+                   overwrite=args.overwrite,
+                   check=args.check,
+                   rtol=args.rtol)
+        sys.exit(0)
+
+    with threadpool_limits(limits=1, user_api='blas'):
+        with args.Pool(**args.Pool_kwargs) as pool:
+            main(pool=pool, overwrite=args.overwrite)
+
+    sys.exit(0)
@@ -0,0 +1,256 @@
+"""
+Column-projected access to large FITS catalogs (allStar, allVisit, StarHorse).
+
+Only the requested columns are read from the (memory-mapped) FITS binary
+table, and each column is also saved as a ``.npy`` file in a cache directory,
+so later reads memory-map just the columns they need. The cache for a file is
+discarded when the file's size or modification time change.
+"""
+
+# Standard library
+import json
+import os
+import pathlib
+import shutil
+import time
+
+# Third-party
+from astropy.io import fits
+import astropy.table as at
+import astropy.units as u
+import numpy as np
+
+# Project
+from hq.log import logger
+
+__all__ = ['read_fits_columns', 'get_row_index', 'lookup_rows',
+           'load_allstar', 'load_allvisit']
+
+allstar_file = pathlib.Path(
+    '/mnt/home/apricewhelan/data/APOGEE_DR17/allStar-dr17-synspec.fits')
+allvisit_file = pathlib.Path(
+    '/mnt/home/apricewhelan/data/APOGEE_DR17/allVisit-dr17-synspec.fits')
+starhorse_file = pathlib.Path(
+    '/mnt/home/apricewhelan/data/APOGEE_DR17/'
+    'APOGEE_DR17_EDR3_STARHORSE_v1.fits')
+
+default_cache_path = (pathlib.Path(__file__).resolve().parent.parent /
+                      'cache' / 'catalog-columns')
+
+# Tables already read by this process, keyed by (filename, colnames, hdu),
+# with the file key (size and modification time) they were read with
+_tables = {}
+
+# Row indices already built or loaded by this process, keyed by
+# (filename, key, hdu), with the file key they were made with
+_row_indices = {}
+
+
+def _get_file_key(filename, hdu):
+    stat = os.stat(filename)
+    return {'filename': str(filename),
+            'hdu': hdu,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+def _convert_column(data, name):
+    """
+    Convert a FITS column to a plain numpy array the same way
+    `astropy.table.Table.read` does for string columns (decoded, with
+    trailing whitespace removed).
+    """
+    arr = np.asarray(data[name])
+    if arr.dtype.kind == 'S':
+        arr = np.char.rstrip(np.char.decode(arr, 'ascii'))
+    return arr
+
+
+def _save_npy(filename, arr):
+    # Write to a temporary file first, so that processes reading the cache at
+    # the same time never see a partial file:
+    tmp_filename = filename.with_name(f'.{filename.name}.{os.getpid()}.npy')
+    np.save(tmp_filename, arr)
+    os.replace(tmp_filename, filename)
+
+
+def read_fits_columns(filename, colnames=None, hdu=1, cache_path=None):
+    """
+    Read columns from a FITS binary table.
+
+    Parameters
+    ----------
+    filename : path-like
+    colnames : iterable (optional)
+        The names of the columns to read. If not specified, all columns are
+        read.
+    hdu : int (optional)
+    cache_path : path-like, False (optional)
+        The directory to keep column caches in. Defaults to
+        ``cache/catalog-columns`` in the pipeline directory. Set this to False
+        to read the columns directly from the FITS file without a cache.
+
+    Returns
+    -------
+    tbl : `~astropy.table.Table`
+        The columns are read-only, memory-mapped arrays.
+    """
+    filename = pathlib.Path(filename).resolve()
+    if colnames is not None:
+        colnames = tuple(colnames)
+
+    # Tables read before are reused unless the file changed since (e.g., if
+    # this process rewrote it). Return shallow copies, so adding or removing
+    # columns in the returned table doesn't change the cached table:
+    key = (str(filename), colnames, hdu)
+    file_key = _get_file_key(filename, hdu)
+    if key in _tables and _tables[key][0] == file_key:
+        return _tables[key][1].copy(copy_data=False)
+
+    t0 = time.time()
+
+    if cache_path is False:
+        cols, units = _read_fits(filename, colnames, hdu)
+    else:
+        if cache_path is None:
+            cache_path = default_cache_path
+        cols, units = _read_cached(filename, colnames, hdu, file_key,
+                                   pathlib.Path(cache_path))
+
+    tbl = at.Table(cols, copy=False)
+    for name, unit in units.items():
+        if unit is not None and name in tbl.colnames:
+            tbl[name].unit = u.Unit(unit, parse_strict='silent')
+
+    logger.debug(f'Loaded {len(tbl.colnames)} columns for {len(tbl)} rows '
+                 f'from {filename.name} in {time.time() - t0:.2f} seconds')
+
+    _tables[key] = (file_key, tbl)
+    return tbl.copy(copy_data=False)
+
+
+def _read_fits(filename, colnames, hdu):
+    with fits.open(filename, memmap=True) as hdul:
+        data = hdul[hdu].data
+        columns = hdul[hdu].columns
+        if colnames is None:
+            colnames = columns.names
+        cols = {name: _convert_column(data, name) for name in colnames}
+        units = {name: columns[name].unit for name in colnames}
+    return cols, units
+
+
+def _read_cached(filename, colnames, hdu, file_key, cache_path):
+    this_cache_path = cache_path / f'{filename.stem}-hdu{hdu}'
+    manifest_file = this_cache_path / 'manifest.json'
+
+    manifest = None
+    if manifest_file.exists():
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        if manifest['file'] != file_key:
+            logger.debug(f'{filename.name} has changed: clearing the column '
+                         'cache')
+            shutil.rmtree(this_cache_path, ignore_errors=True)
+            manifest = None
+
+    if manifest is None:
+        with fits.open(filename, memmap=True) as hdul:
+            columns = hdul[hdu].columns
+            manifest = {'file': file_key,
+                        'colnames': list(columns.names),
+                        'units': {name: columns[name].unit
+                                  for name in columns.names},
+                        'cached': []}
+    if colnames is None:
+        colnames = manifest['colnames']
+
+    missing = [name for name in colnames if name not in manifest['cached']]
+    if missing:
+        this_cache_path.mkdir(parents=True, exist_ok=True)
+        cols, _ = _read_fits(filename, missing, hdu)
+        for name, arr in cols.items():
+            _save_npy(this_cache_path / f'{name}.npy', arr)
+        manifest['cached'] = sorted(set(manifest['cached']) | set(missing))
+
+        tmp_file = manifest_file.with_name(f'.manifest.{os.getpid()}.json')
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_file, manifest_file)
+
+    cols = {name: np.load(this_cache_path / f'{name}.npy', mmap_mode='r')
+            for name in colnames}
+    units = {name: manifest['units'].get(name) for name in colnames}
+    return cols, units
+
+
+def get_row_index(filename, key='APOGEE_ID', hdu=1, cache_path=None):
+    """
+    Get a sorted index of the unique values in a column of a FITS binary
+    table, to look up rows by value (see `lookup_rows`).
+
+    The index is saved next to the column cache, so it is only built once
+    for each version of the file.
+
+    Returns
+    -------
+    keys : `numpy.ndarray`
+        The unique values of the column, sorted.
+    rows : `numpy.ndarray`
+        For each value in ``keys``, the index of the first row in the file
+        with that value.
+    """
+    filename = pathlib.Path(filename).resolve()
+    memo_key = (str(filename), key, hdu)
+    file_key = _get_file_key(filename, hdu)
+    if (memo_key in _row_indices and
+            _row_indices[memo_key][0] == file_key):
+        return _row_indices[memo_key][1]
+
+    # This also makes sure that the column cache is up to date:
+    values = read_fits_columns(filename, [key], hdu=hdu,
+                               cache_path=cache_path)[key]
+
+    if cache_path is False:
+        keys, rows = np.unique(np.asarray(values), return_index=True)
+    else:
+        if cache_path is None:
+            cache_path = default_cache_path
+        this_cache_path = (pathlib.Path(cache_path) /
+                           f'{filename.stem}-hdu{hdu}')
+        keys_file = this_cache_path / f'index-{key}-keys.npy'
+        rows_file = this_cache_path / f'index-{key}-rows.npy'
+        if not keys_file.exists() or not rows_file.exists():
+            keys, rows = np.unique(np.asarray(values), return_index=True)
+            _save_npy(keys_file, keys)
+            _save_npy(rows_file, rows)
+        keys = np.load(keys_file, mmap_mode='r')
+        rows = np.load(rows_file, mmap_mode='r')
+
+    _row_indices[memo_key] = (file_key, (keys, rows))
+    return keys, rows
+
+
+def lookup_rows(index, values):
+    """
+    Look up the rows with the given values in an index made by
+    `get_row_index`. Returns -1 for values that are not in the index.
+    """
+    keys, rows = index
+    values = np.asarray(values)
+    if len(keys) == 0:
+        return np.full(len(values), -1, dtype=np.int64)
+
+    i = np.clip(np.searchsorted(keys, values), 0, len(keys) - 1)
+    found = keys[i] == values
+    return np.where(found, rows[i], -1)
+
+
+def load_allstar(colnames=None, **kwargs):
+    """Read columns from the DR17 allStar file (see `read_fits_columns`)."""
+    return read_fits_columns(allstar_file, colnames, **kwargs)
+
+
+def load_allvisit(colnames=None, **kwargs):
+    """Read columns from the DR17 allVisit file (see `read_fits_columns`)."""
+    return read_fits_columns(allvisit_file, colnames, **kwargs)
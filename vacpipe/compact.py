@@ -0,0 +1,196 @@
+"""
+Export all posterior samples from the per-source HDF5 groups in the HQ result
+files to a single "compact" store: one contiguous column per parameter, with
+an offset index per source. Run this as a pipeline stage with::
+
+    python -m vacpipe.compact -v
+
+Scanning all samples (e.g., to compute percentiles or apply cuts) is then a
+sequential read of a handful of arrays instead of one small read per source.
+"""
+
+# Standard library
+import time
+
+# Third-party
+import h5py
+import numpy as np
+
+# Project
+from hq.config import Config
+from hq.log import logger
+from .samples import SamplesReader
+
+__all__ = ['write_compact_samples', 'CompactSamples']
+
+compact_parnames = ['P', 'e', 'K', 'v0', 's', 'omega', 'M0']
+
+
+def write_compact_samples(conf, output_file, compression=None,
+                          chunk_size=2**18):
+    """
+    Parameters
+    ----------
+    conf : `hq.config.Config`
+    output_file : path-like
+    compression : str (optional)
+        If None (the default), the columns are stored uncompressed and
+        contiguous, so that they can be memory-mapped by `CompactSamples`.
+        Otherwise, this is passed to h5py (e.g., 'gzip' or 'lzf') and the
+        columns are chunked and compressed.
+    chunk_size : int (optional)
+        The number of samples per chunk when ``compression`` is set.
+    """
+    with SamplesReader(conf) as reader, h5py.File(output_file, 'w') as f:
+        for name, mcmc in [('joker', False), ('mcmc', True)]:
+            t0 = time.time()
+
+            source_ids = reader.get_source_ids(mcmc)
+            order = reader.get_disk_order(source_ids, mcmc)
+            source_ids = [source_ids[i] for i in order]
+            n_samples = np.array([
+                reader.get_dataset(source_id, mcmc).shape[0]
+                for source_id in source_ids])
+            offsets = np.concatenate(([0], np.cumsum(n_samples)))
+
+            g = f.create_group(name)
+            g.create_dataset('source_id', data=np.array(source_ids, dtype='S'))
+            g.create_dataset('offset', data=offsets)
+
+            if len(source_ids) == 0:
+                continue
+
+            units = reader.get_units(mcmc)
+            dtype = reader.get_dataset(source_ids[0], mcmc).dtype
+            kw = dict()
+            if compression is not None:
+                kw['compression'] = compression
+                kw['chunks'] = (min(chunk_size, offsets[-1]), )
+
+            for par in compact_parnames:
+                dset = g.create_dataset(par, shape=(offsets[-1], ),
+                                        dtype=dtype[par], **kw)
+                dset.attrs['unit'] = units[par].to_string()
+
+            i = 0
+            for batch in reader.iter_batches(source_ids, mcmc,
+                                             max_samples=chunk_size):
+                i1 = offsets[i]
+                i2 = offsets[i + len(batch)]
+                for par in compact_parnames:
+                    g[par][i1:i2] = np.concatenate([samples[par]
+                                                    for _, samples in batch])
+                i += len(batch)
+
+            logger.debug(f"Wrote {offsets[-1]} {name} samples for "
+                         f"{len(source_ids)} sources in "
+                         f"{time.time() - t0:.1f} seconds")
+
+
+class CompactSamples:
+    """
+    Read-only access to a compact samples store written by
+    `write_compact_samples`.
+
+    Columns stored contiguously (i.e. uncompressed) are memory-mapped, so
+    slicing out the samples for a source, or scanning a full column, does not
+    go through h5py. Compressed columns are returned as h5py datasets.
+
+    Parameters
+    ----------
+    filename : path-like
+    which : str (optional)
+        Either 'joker' or 'mcmc'.
+    """
+
+    def __init__(self, filename, which='joker'):
+        self.filename = filename
+        self.which = which
+
+        with h5py.File(filename, 'r') as f:
+            g = f[which]
+            self.source_ids = g['source_id'][()].astype(str)
+            self.offsets = g['offset'][()]
+            self.units = {par: g[par].attrs['unit'] for par in compact_parnames
+                          if par in g}
+
+            self._columns = {}
+            for par in self.units:
+                dset = g[par]
+                offset = dset.id.get_offset()
+                if dset.chunks is None and offset is not None:
+                    self._columns[par] = np.memmap(filename, mode='r',
+                                                   dtype=dset.dtype,
+                                                   offset=offset,
+                                                   shape=dset.shape)
+
+        self._h5f = None
+        self._sort_idx = np.argsort(self.source_ids)
+
+    def _get_h5_column(self, par):
+        if self._h5f is None:
+            self._h5f = h5py.File(self.filename, 'r')
+        return self._h5f[self.which][par]
+
+    def __len__(self):
+        return len(self.source_ids)
+
+    def __contains__(self, source_id):
+        i = np.searchsorted(self.source_ids, source_id, sorter=self._sort_idx)
+        return (i < len(self.source_ids) and
+                self.source_ids[self._sort_idx[i]] == source_id)
+
+    def get_column(self, par):
+        """The full (memory-mapped, if possible) column for a parameter."""
+        if par in self._columns:
+            return self._columns[par]
+        return self._get_h5_column(par)
+
+    def get_slice(self, source_id):
+        i = np.searchsorted(self.source_ids, source_id, sorter=self._sort_idx)
+        if (i >= len(self.source_ids) or
+                self.source_ids[self._sort_idx[i]] != source_id):
+            raise KeyError(f"No samples for source {source_id}")
+        i = self._sort_idx[i]
+        return slice(self.offsets[i], self.offsets[i+1])
+
+    def __getitem__(self, source_id):
+        """
+        A dictionary of the samples (one array per parameter) for a source.
+        """
+        slc = self.get_slice(source_id)
+        return {par: self.get_column(par)[slc] for par in self.units}
+
+    def close(self):
+        if self._h5f is not None:
+            self._h5f.close()
+            self._h5f = None
+
+
+def main(run_path, overwrite=False, compression=None):
+    conf = Config(run_path / 'config.yml')
+    output_file = conf.cache_path / 'samples-compact.hdf5'
+
+    if output_file.exists() and not overwrite:
+        logger.warn(f'Output file exists at {output_file!s}')
+        return
+
+    write_compact_samples(conf, output_file, compression=compression)
+
+
+if __name__ == '__main__':
+    import sys
+    from hq.cli.helpers import get_parser
+
+    parser = get_parser(loggers=[logger])
+    parser.add_argument("--compression", dest="compression", default=None,
+                        help="h5py compression filter for the columns (e.g., "
+                             "lzf or gzip). The default is no compression, "
+                             "so the columns can be memory-mapped.")
+    args = parser.parse_args(sys.argv[1:])
+
+    main(run_path=args.run_path,
+         overwrite=args.overwrite,
+         compression=args.compression)
+
+    sys.exit(0)
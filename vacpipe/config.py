@@ -0,0 +1,21 @@
+# Standard library
+import importlib.util
+
+__all__ = ['get_prior_module']
+
+# Loaded prior definition modules, keyed by filename
+_prior_modules = {}
+
+
+def get_prior_module(conf):
+    """
+    Import (once per process) the prior definition file for the run, i.e.
+    the ``prior_file`` setting in the run configuration.
+    """
+    filename = str(conf.prior_file)
+    if filename not in _prior_modules:
+        spec = importlib.util.spec_from_file_location('prior', filename)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _prior_modules[filename] = module
+    return _prior_modules[filename]
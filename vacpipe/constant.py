@@ -0,0 +1,223 @@
+"""
+Batched maximum-likelihood fits of constant and linear (in time) radial
+velocity models, with a free jitter (excess variance) term, for all sources in
+the visit table. Run this as a pipeline stage with::
+
+    python3 -m vacpipe.constant -v
+
+The visits of many sources are packed into padded 2D arrays (one row per
+source, sorted by number of visits to keep the padding small), and all of the
+fits in a chunk are done with array operations: for a given jitter, the
+best-fit constant or linear model is a weighted linear least-squares solution,
+so the only non-linear parameter is the jitter, which is optimized with a
+grid search followed by a golden-section refinement.
+
+The output (``cache/hq/constant-batched.fits``) has the columns
+``batched_constant_ln_likelihood`` and ``batched_linear_ln_likelihood`` (and
+the best-fit jitters). These have not been validated against the
+``robust_*_ln_likelihood`` values from ``hq run_constant``
+(``mpi/3-fit-constant.sh``), which are the ones ``hq combine_metadata`` adds
+to the metadata file and the catalog cuts use, so this file does not replace
+that stage.
+"""
+
+# Standard library
+import pathlib
+
+# Third-party
+import astropy.table as at
+import astropy.units as u
+import numpy as np
+
+# Project
+from hq.config import Config
+from hq.log import logger
+from .telemetry import get_telemetry
+from .visits import get_visit_index
+
+__all__ = ['pack_visits', 'fit_constant_linear']
+
+# Grid of jitter values to search, in km/s
+jitter_grid = np.concatenate(([0.], np.geomspace(1e-3, 300., 96)))
+
+
+def pack_visits(visit_index, idx):
+    """
+    Pack the visits for the sources at indices ``idx`` (into
+    ``visit_index.source_ids``) into padded arrays with shape
+    ``(len(idx), max_n_visits)``.
+
+    Returns
+    -------
+    t, rv, rv_err : `numpy.ndarray`
+        Times (days, relative to each source's mean time), radial velocities,
+        and uncertainties (km/s). Padded entries are 0 (or 1 for errors).
+    mask : `numpy.ndarray`
+        True for real visits, False for padding.
+    """
+    data = visit_index.data
+    offsets = visit_index.offsets[idx]
+    counts = visit_index.get_counts()[idx]
+
+    col = np.arange(counts.max())
+    mask = col[None] < counts[:, None]
+    take = np.where(mask, offsets[:, None] + col[None], 0)
+
+    t = np.asarray(data[visit_index.time_colname], dtype=float)[take]
+    rv = u.Quantity(data[visit_index.rv_colname], u.km/u.s).value[take]
+    rv_err = u.Quantity(data[visit_index.rv_error_colname],
+                        u.km/u.s).value[take]
+
+    t = np.where(mask, t, 0.)
+    t = np.where(mask, t - t.sum(axis=1, keepdims=True) / counts[:, None], 0.)
+    rv = np.where(mask, rv, 0.)
+    rv_err = np.where(mask, rv_err, 1.)
+
+    return t, rv, rv_err, mask
+
+
+def _ln_likelihood(t, rv, rv_err, mask, jitter, linear):
+    """
+    Maximum log-likelihood over the mean (and slope, if ``linear``) for each
+    source, at fixed jitter values (one per source).
+    """
+    var = rv_err**2 + jitter[:, None]**2
+    w = mask / var
+
+    S0 = w.sum(axis=1)
+    Sy = (w * rv).sum(axis=1)
+    if linear:
+        S1 = (w * t).sum(axis=1)
+        S2 = (w * t**2).sum(axis=1)
+        Sty = (w * t * rv).sum(axis=1)
+        det = S0 * S2 - S1**2
+        b = (S0 * Sty - S1 * Sy) / det
+        a = (S2 * Sy - S1 * Sty) / det
+    else:
+        b = np.zeros_like(S0)
+        a = Sy / S0
+
+    resid = rv - a[:, None] - b[:, None] * t
+    return -0.5 * np.sum(mask * (resid**2 / var + np.log(2*np.pi * var)),
+                         axis=1)
+
+
+def _maximize_jitter(t, rv, rv_err, mask, linear, n_iter=32):
+    n = len(t)
+
+    # Grid search:
+    lnL_grid = np.stack([
+        _ln_likelihood(t, rv, rv_err, mask, np.full(n, s), linear)
+        for s in jitter_grid])
+    k = np.argmax(lnL_grid, axis=0)
+    best_lnL = lnL_grid[k, np.arange(n)]
+    best_s = jitter_grid[k]
+
+    # Golden-section search between the neighbors of the best grid point:
+    lo = jitter_grid[np.clip(k - 1, 0, None)]
+    hi = jitter_grid[np.clip(k + 1, None, len(jitter_grid) - 1)]
+    g = (np.sqrt(5) - 1) / 2
+    for _ in range(n_iter):
+        x1 = hi - g * (hi - lo)
+        x2 = lo + g * (hi - lo)
+        left = (_ln_likelihood(t, rv, rv_err, mask, x1, linear) >
+                _ln_likelihood(t, rv, rv_err, mask, x2, linear))
+        hi = np.where(left, x2, hi)
+        lo = np.where(left, lo, x1)
+
+    s = 0.5 * (lo + hi)
+    lnL = _ln_likelihood(t, rv, rv_err, mask, s, linear)
+    better = lnL > best_lnL
+    best_lnL = np.where(better, lnL, best_lnL)
+    best_s = np.where(better, s, best_s)
+
+    return best_lnL, best_s
+
+
+def fit_constant_linear(t, rv, rv_err, mask):
+    """
+    Fit constant and linear models (with jitter) to packed visit arrays (see
+    `pack_visits`) and return a table with the maximum log-likelihood and
+    best-fit jitter for each model.
+    """
+    tbl = at.QTable()
+    for name, linear in [('constant', False), ('linear', True)]:
+        lnL, s = _maximize_jitter(t, rv, rv_err, mask, linear)
+        tbl[f'batched_{name}_ln_likelihood'] = lnL
+        tbl[f'batched_{name}_jitter'] = s * u.km/u.s
+    return tbl
+
+
+def get_chunks(counts, max_chunk_size=2**18):
+    """
+    Split sources into chunks, in order of increasing number of visits, so
+    that each padded chunk has at most ``max_chunk_size`` elements.
+    """
+    order = np.argsort(counts, kind='stable')
+    chunks = []
+    i1 = 0
+    while i1 < len(order):
+        # Sources are sorted by count, so the last source sets the padding:
+        i2 = i1 + 1
+        while (i2 < len(order) and
+               (i2 - i1 + 1) * counts[order[i2]] <= max_chunk_size):
+            i2 += 1
+        chunks.append(order[i1:i2])
+        i1 = i2
+    return chunks
+
+
+def worker(task):
+    # The sources in a chunk are fit together, so each source's telemetry
+    # record gets a share of the chunk time by its number of visits:
+    telemetry = get_telemetry(task['conf'], 'constant')
+    with telemetry.record_batch(task['source_ids'],
+                                weights=task['n_visits'],
+                                n_visits=task['n_visits']):
+        tbl = fit_constant_linear(*task['arrays'])
+    tbl.add_column(task['source_ids'], name='APOGEE_ID', index=0)
+    tbl.add_column(task['n_visits'], name='n_visits', index=1)
+    return tbl
+
+
+def main(run_path, pool, overwrite=False):
+    conf = Config(run_path / 'config.yml')
+
+    output_file = pathlib.Path(conf.cache_path) / 'constant-batched.fits'
+    if output_file.exists() and not overwrite:
+        logger.warn(f'Output file exists at {output_file!s}')
+        return
+
+    visit_index = get_visit_index(conf)
+    counts = visit_index.get_counts()
+
+    tasks = []
+    for idx in get_chunks(counts):
+        tasks.append({
+            'conf': conf,
+            'arrays': pack_visits(visit_index, idx),
+            'source_ids': visit_index.source_ids[idx],
+            'n_visits': counts[idx]
+        })
+    logger.info(f'Fitting {len(counts)} sources in {len(tasks)} chunks')
+
+    tbl = at.vstack(list(pool.map(worker, tasks)))
+    tbl.sort('APOGEE_ID')
+    tbl.write(output_file, overwrite=True)
+
+
+if __name__ == '__main__':
+    import sys
+    from threadpoolctl import threadpool_limits
+    from hq.cli.helpers import get_parser
+
+    parser = get_parser(loggers=[logger])
+    args = parser.parse_args(sys.argv[1:])
+
+    with threadpool_limits(limits=1, user_api='blas'):
+        with args.Pool(**args.Pool_kwargs) as pool:
+            main(run_path=args.run_path,
+                 pool=pool,
+                 overwrite=args.overwrite)
+
+    sys.exit(0)
@@ -0,0 +1,333 @@
+"""
+Incremental reprocessing after partial reruns (e.g., ``hq rerun_thejoker``, or
+MCMC for a subset of sources). Each source has a version: a hash of its
+samples in the Joker and MCMC result files, and of its row in the metadata
+file. Run this as a pipeline stage with::
+
+    mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+        -m vacpipe.incremental -v --mpi --detect
+
+to compute the current versions. The downstream stages that are run with
+``--update`` (``vacpipe.percentiles``, ``make_masses.py``, and
+``vacpipe.assemble``) then only recompute the sources whose version changed
+since the last commit (`get_changed_sources`), and merge the new rows into
+their existing output files (`merge_rows`). When all of them have finished,
+record the current versions as the reference for the next run with::
+
+    python3 -m vacpipe.incremental -v --commit
+
+``mpi/10-incremental.sh`` runs all of these steps. After a full run of the
+pipeline, run ``--detect`` and then ``--commit`` once to start from there.
+
+Only these leaf products (and the diagnostic plots) are updated
+incrementally. The HQ analyze and combine steps (``mpi/4-analyze.sh``,
+``mpi/6-mcmc-analyze.sh``, and ``mpi/7-combine-metadata.sh``) must still be
+rerun in full before ``--detect``, since the versions are computed from their
+output, and the gold sample and binary catalogs and the release archives are
+still rebuilt in full afterwards.
+
+By default, the samples version only hashes the shape and the first and last
+``n_probe`` samples of each source (a rerun draws new samples, so these
+change), which is a few small reads per source instead of reading all of the
+samples. Use ``--full-hash`` to hash all of the samples instead. Result files
+that have not changed since the last commit (by size and modification time)
+are not read at all.
+"""
+
+# Standard library
+import hashlib
+import json
+import os
+import pathlib
+
+# Third-party
+import astropy.table as at
+import numpy as np
+
+# Project
+from hq.config import Config
+from hq.log import logger
+from .catalogs import lookup_rows
+from .samples import SamplesReader
+
+__all__ = ['get_samples_versions', 'get_row_versions', 'get_changed_sources',
+           'merge_rows']
+
+# The number of samples from each end of a source's samples to hash:
+default_n_probe = 16
+
+# Increment this when the versions change:
+version_format = 1
+
+
+def get_state_file(conf, name):
+    return pathlib.Path(conf.cache_path) / 'incremental' / f'{name}.npz'
+
+
+def _get_file_key(filename):
+    filename = pathlib.Path(filename)
+    if not filename.exists():
+        return None
+    stat = os.stat(filename)
+    return {'filename': str(filename),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+def _get_ids(tbl):
+    return np.char.strip(np.asarray(tbl['APOGEE_ID'], dtype=str))
+
+
+def get_samples_versions(reader, source_ids, mcmc=False,
+                         n_probe=default_n_probe):
+    """
+    Hash the samples of each source in one of the result files.
+
+    Parameters
+    ----------
+    reader : `vacpipe.samples.SamplesReader`
+    source_ids : array-like
+    mcmc : bool (optional)
+    n_probe : int, None (optional)
+        Only hash the first and last ``n_probe`` samples (and the shape and
+        data type) of each source. If None, hash all of the samples.
+
+    Returns
+    -------
+    versions : `numpy.ndarray`
+        The hex digests, or empty strings for sources with no samples.
+    """
+    source_ids = [str(x).strip() for x in source_ids]
+    versions = np.zeros(len(source_ids), dtype='S40')
+
+    for i in reader.get_disk_order(source_ids, mcmc):
+        try:
+            dset = reader.get_dataset(source_ids[i], mcmc)
+        except KeyError:
+            continue
+
+        h = hashlib.sha1()
+        h.update(repr((dset.shape, dset.dtype.descr)).encode())
+        if n_probe is None:
+            h.update(dset[()].tobytes())
+        else:
+            n = dset.shape[0]
+            h.update(dset[:min(n_probe, n)].tobytes())
+            h.update(dset[max(n - n_probe, 0):].tobytes())
+        versions[i] = h.hexdigest()
+
+    return versions
+
+
+def get_row_versions(tbl):
+    """Hash each row of a table (all columns)."""
+    arr = np.ascontiguousarray(np.asarray(tbl.as_array()))
+    rows = arr.view(np.dtype((np.void, arr.dtype.itemsize)))
+    return np.array([hashlib.sha1(row.tobytes()).hexdigest()
+                     for row in rows], dtype='S40')
+
+
+def save_state(conf, name, state):
+    filename = get_state_file(conf, name)
+    filename.parent.mkdir(exist_ok=True)
+
+    tmp_filename = filename.with_name(f'.{filename.name}.{os.getpid()}')
+    with open(tmp_filename, 'wb') as f:
+        np.savez(f, **{k: v for k, v in state.items() if k != 'keys'},
+                 keys=np.array(json.dumps(state['keys'])))
+    os.replace(tmp_filename, filename)
+
+
+def load_state(conf, name):
+    """
+    Read the ``'pending'`` (last detected) or ``'committed'`` source
+    versions, or return None if there are none.
+    """
+    filename = get_state_file(conf, name)
+    if not filename.exists():
+        return None
+
+    with np.load(filename) as f:
+        state = {k: f[k] for k in f.files}
+    state['keys'] = json.loads(str(state['keys']))
+    if state['keys'].get('format') != version_format:
+        return None
+    return state
+
+
+def _remap(state, name, source_ids):
+    """The versions in a state for the input sources (empty if missing)."""
+    index = np.unique(state['source_ids'], return_index=True)
+    idx = lookup_rows(index, source_ids)
+    versions = np.where(idx >= 0, state[name][np.maximum(idx, 0)], b'')
+    return versions.astype('S40')
+
+
+def get_changed_sources(conf):
+    """
+    The sources whose samples or metadata changed between the last commit and
+    the last ``--detect`` run.
+
+    Returns
+    -------
+    changed : `numpy.ndarray`
+        The APOGEE_IDs of new sources and sources with a changed version.
+    removed : `numpy.ndarray`
+        The APOGEE_IDs of sources that are no longer in the metadata file.
+    """
+    pending = load_state(conf, 'pending')
+    if pending is None:
+        raise RuntimeError('No source versions to compare with: run '
+                           '"python3 -m vacpipe.incremental --detect" first')
+
+    source_ids = pending['source_ids']
+    committed = load_state(conf, 'committed')
+    if committed is None:
+        return source_ids, np.array([], dtype=source_ids.dtype)
+
+    same = np.ones(len(source_ids), dtype=bool)
+    for name in ['joker', 'mcmc', 'meta']:
+        same &= _remap(committed, name, source_ids) == pending[name]
+    # New sources have empty committed versions, so only match if they have
+    # no samples and no metadata row, which can't happen:
+    same &= np.isin(source_ids, committed['source_ids'])
+
+    removed = np.setdiff1d(committed['source_ids'], source_ids)
+    return source_ids[~same], removed
+
+
+def merge_rows(old, new, replace_ids, order_ids=None):
+    """
+    Merge updated rows into an existing output table.
+
+    Parameters
+    ----------
+    old : `~astropy.table.Table`
+        The existing output table.
+    new : `~astropy.table.Table`
+        The recomputed rows.
+    replace_ids : array-like
+        The APOGEE_IDs of the rows in ``old`` to drop, i.e. all sources that
+        were recomputed or removed (whether or not they have a row in
+        ``new``).
+    order_ids : array-like (optional)
+        Put the rows in the order of these APOGEE_IDs, and drop rows for
+        sources that are not in this list. If not specified, the rows are
+        sorted by APOGEE_ID.
+    """
+    keep = ~np.isin(_get_ids(old), np.asarray(replace_ids, dtype=str))
+    tbl = old[keep]
+    if len(new) > 0:
+        tbl = at.vstack([tbl, new], metadata_conflicts='silent')
+
+    ids = _get_ids(tbl)
+    if order_ids is None:
+        order = np.argsort(ids, kind='stable')
+    else:
+        order_ids = np.char.strip(np.asarray(order_ids, dtype=str))
+        pos = lookup_rows(np.unique(order_ids, return_index=True), ids)
+        rows = np.flatnonzero(pos >= 0)
+        order = rows[np.argsort(pos[rows], kind='stable')]
+    return tbl[order]
+
+
+def worker(task):
+    with SamplesReader(task['conf']) as reader:
+        versions = get_samples_versions(reader, task['source_ids'],
+                                        task['mcmc'], task['n_probe'])
+    return task['index'], versions
+
+
+def detect(conf, pool, n_probe=default_n_probe, max_task_size=4096):
+    meta = at.Table.read(conf.metadata_file)
+    source_ids = _get_ids(meta)
+    committed = load_state(conf, 'committed')
+
+    state = {'source_ids': source_ids,
+             'meta': get_row_versions(meta),
+             'keys': {'format': version_format,
+                      'n_probe': n_probe}}
+
+    for name, filename, mcmc in [('joker', conf.joker_results_file, False),
+                                 ('mcmc', conf.mcmc_results_file, True)]:
+        file_key = _get_file_key(filename)
+        state['keys'][name] = file_key
+
+        if (committed is not None and
+                committed['keys'].get(name) == file_key and
+                committed['keys'].get('n_probe') == n_probe):
+            logger.info(f'{filename!s} has not changed since the last commit')
+            state[name] = _remap(committed, name, source_ids)
+            continue
+
+        state[name] = np.zeros(len(source_ids), dtype='S40')
+        if file_key is None:
+            continue
+
+        n_tasks = max(4 * pool.size, len(source_ids) // max_task_size + 1)
+        tasks = [{'conf': conf,
+                  'index': idx,
+                  'source_ids': source_ids[idx],
+                  'mcmc': mcmc,
+                  'n_probe': n_probe}
+                 for idx in np.array_split(np.arange(len(source_ids)),
+                                           n_tasks)
+                 if len(idx) > 0]
+        logger.info(f'Hashing the samples in {filename!s} in '
+                    f'{len(tasks)} tasks')
+        for idx, versions in pool.map(worker, tasks):
+            state[name][idx] = versions
+
+    save_state(conf, 'pending', state)
+
+    changed, removed = get_changed_sources(conf)
+    logger.info(f'{len(changed)} of {len(source_ids)} sources changed, and '
+                f'{len(removed)} removed, since the last commit')
+
+
+def main(run_path, pool, detect_changes=False, commit=False,
+         full_hash=False):
+    conf = Config(run_path / 'config.yml')
+
+    if detect_changes:
+        detect(conf, pool, n_probe=None if full_hash else default_n_probe)
+
+    if commit:
+        pending_file = get_state_file(conf, 'pending')
+        if not pending_file.exists():
+            raise RuntimeError('No source versions to commit: run '
+                               '"python3 -m vacpipe.incremental --detect" '
+                               'first')
+        os.replace(pending_file, get_state_file(conf, 'committed'))
+        logger.info('Committed the source versions')
+
+
+if __name__ == '__main__':
+    import sys
+    from threadpoolctl import threadpool_limits
+    from hq.cli.helpers import get_parser
+
+    parser = get_parser(loggers=[logger])
+
+    parser.add_argument("--detect", dest="detect_changes", default=False,
+                        action="store_true",
+                        help="Compute the current source versions, and find "
+                             "the sources that changed since the last commit")
+    parser.add_argument("--commit", dest="commit", default=False,
+                        action="store_true",
+                        help="Record the last detected source versions as "
+                             "processed")
+    parser.add_argument("--full-hash", dest="full_hash", default=False,
+                        action="store_true",
+                        help="Hash all samples of each source")
+    args = parser.parse_args(sys.argv[1:])
+
+    with threadpool_limits(limits=1, user_api='blas'):
+        with args.Pool(**args.Pool_kwargs) as pool:
+            main(run_path=args.run_path,
+                 pool=pool,
+                 detect_changes=args.detect_changes,
+                 commit=args.commit,
+                 full_hash=args.full_hash)
+
+    sys.exit(0)
@@ -0,0 +1,298 @@
+"""
+Run The Joker for all sources with blocks of prior samples from the sharded
+prior cache. Run this as a pipeline stage (after ``vacpipe.prior_cache``)
+with::
+
+    mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+        -m vacpipe.joker -v --mpi
+
+This is an alternative to ``hq run_thejoker``, which is still the default in
+``mpi/2-run.sh`` until this stage has been validated against it on real
+sources (set ``VACPIPE_JOKER=1`` to run this stage there instead).
+
+For each source, the first block has ``init_batch_size`` prior samples (from
+the run configuration), and each block after that is ``growth_factor`` times
+larger than the last, until enough posterior samples are accepted or the
+prior samples run out. Each block is rejection sampled against its maximum
+marginal likelihood, and the accepted samples are then thinned by
+``exp(block max - overall max)`` of the marginal log-likelihood, so the
+result is the same as rejection sampling with all of the prior samples used
+at once.
+
+With ``--adaptive`` (as run by ``mpi/2-run.sh``), the first block size is
+instead estimated for each source from the number of visits, the time
+baseline, and the excess chi-squared of the best-fit constant RV model, which
+is computed from the source's visits in the worker. This heuristic has not
+been calibrated against ``hq run_thejoker`` on real sources yet.
+
+The number of blocks and prior samples used for each source are logged, and
+stored as attributes of the source's group in the Joker results file. The
+time, likelihood evaluations, and memory use for each source are also written
+as telemetry records (see `vacpipe.telemetry`).
+"""
+
+# Standard library
+import pathlib
+import time
+
+# Third-party
+import astropy.table as at
+import astropy.units as u
+import h5py
+import numpy as np
+import thejoker as tj
+
+# Project
+from hq.config import Config
+from hq.log import logger
+from .config import get_prior_module
+from .prior_cache import PriorCache
+from .telemetry import get_telemetry
+from .visits import get_visit_index
+
+__all__ = ['get_init_batch_size', 'adaptive_rejection_sample']
+
+
+def get_constant_chi2(data):
+    """
+    The chi-squared of the best-fit (inverse-variance weighted mean) constant
+    RV model for the input `~thejoker.RVData` instance.
+    """
+    rv = data.rv.to_value(u.km/u.s)
+    ivar = 1 / data.rv_err.to_value(u.km/u.s)**2
+    mean = np.sum(ivar * rv) / np.sum(ivar)
+    return np.sum(ivar * (rv - mean)**2)
+
+
+def get_init_batch_size(n_visits, baseline, constant_chi2=None,
+                        min_size=2**16, max_size=2**22):
+    """
+    Estimate the number of prior samples to start with for one source.
+
+    A source with few visits over a short baseline that is consistent with a
+    constant RV has a broad posterior, so a small block already gives enough
+    samples. More visits and longer baselines resolve the period more
+    finely, and a large excess chi-squared over a constant model means the
+    posterior is narrow, so the acceptance fraction is small.
+
+    Parameters
+    ----------
+    n_visits : int
+    baseline : `~astropy.units.Quantity`
+        The time between the first and last visit.
+    constant_chi2 : float (optional)
+        The chi-squared of the best-fit constant RV model.
+    """
+    log_size = np.log(min_size)
+    log_size += np.log(max(n_visits, 3) / 3)
+    log_size += 0.5 * np.log(max(baseline.to_value(u.day), 100.) / 100.)
+
+    if constant_chi2 is not None and np.isfinite(constant_chi2):
+        excess = max(constant_chi2 - (n_visits - 1), 0.)
+        log_size += 0.5 * excess
+
+    return int(np.exp(np.clip(log_size, np.log(min_size), np.log(max_size))))
+
+
+def adaptive_rejection_sample(joker, data, prior_cache, n_requested,
+                              init_batch_size, growth_factor=4,
+                              max_prior_samples=None, max_batch_size=2**22,
+                              randomize_prior_order=True, random_state=None):
+    """
+    Iterative rejection sampling with blocks of prior samples that grow by
+    ``growth_factor`` until ``n_requested`` samples are accepted. Samples
+    from different blocks are combined by thinning each block with the ratio
+    of its maximum marginal likelihood to the overall maximum.
+
+    Returns
+    -------
+    samples : `~thejoker.JokerSamples`
+    n_batches : int
+    n_prior : int
+        The total number of prior samples (likelihood evaluations) used.
+    """
+    if max_prior_samples is None:
+        max_prior_samples = len(prior_cache)
+
+    batches = []
+    max_lnLs = []
+    n_prior = 0
+    blocks = prior_cache.iter_blocks(init_batch_size,
+                                     random_state if randomize_prior_order
+                                     else None,
+                                     growth_factor=growth_factor,
+                                     max_size=max_batch_size)
+    for block in blocks:
+        # The rejection step uses the marginal likelihood (over the linear
+        # parameters) of every prior sample in the block, relative to its
+        # maximum in the block:
+        samples, marginal_lnL = joker.rejection_sample(
+            data, block, return_logprobs=True, return_all_logprobs=True)
+        n_prior += len(block)
+
+        batches.append(samples)
+        max_lnLs.append(np.max(marginal_lnL))
+
+        # Expected number of samples left after thinning to the overall max:
+        n_eff = np.sum([len(s) * np.exp(lnL - max(max_lnLs))
+                        for s, lnL in zip(batches, max_lnLs)])
+        if n_eff >= n_requested or n_prior >= max_prior_samples:
+            break
+
+    # Thin all blocks to the overall maximum marginal likelihood, as if all of
+    # the prior samples were used in a single rejection step:
+    max_lnL = max(max_lnLs)
+    keep = []
+    for samples, lnL in zip(batches, max_lnLs):
+        mask = random_state.uniform(size=len(samples)) < np.exp(lnL - max_lnL)
+        keep.append(samples[mask])
+
+    samples = tj.JokerSamples(samples=at.vstack([s.tbl for s in keep]),
+                              t_ref=keep[0].t_ref,
+                              n_offsets=keep[0].n_offsets,
+                              poly_trend=keep[0].poly_trend)
+    if len(samples) > n_requested:
+        idx = random_state.choice(len(samples), n_requested, replace=False)
+        samples = samples[np.sort(idx)]
+
+    return samples, len(batches), n_prior
+
+
+def worker(task):
+    conf = task['conf']
+    rng = np.random.default_rng(task['seed'])
+
+    prior, _ = get_prior_module(conf).get_prior()
+    joker = tj.TheJoker(prior, random_state=rng)
+    prior_cache = PriorCache(task['prior_cache_path'])
+    visit_index = get_visit_index(conf)
+    telemetry = get_telemetry(conf, 'joker')
+
+    n_requested = conf.requested_samples_per_star
+    max_prior_samples = conf.max_prior_samples
+    if max_prior_samples is None:
+        max_prior_samples = len(prior_cache)
+
+    results = []
+    for source_id in task['source_ids']:
+        t0 = time.time()
+        with telemetry.record(source_id) as record:
+            data = visit_index.get_rvdata(source_id)
+            record['n_visits'] = len(data)
+
+            if task['adaptive']:
+                init_batch_size = get_init_batch_size(
+                    len(data), data.t.max() - data.t.min(),
+                    get_constant_chi2(data))
+            else:
+                init_batch_size = task['init_batch_size']
+
+            samples, n_batches, n_prior = adaptive_rejection_sample(
+                joker, data, prior_cache, n_requested,
+                init_batch_size=init_batch_size,
+                growth_factor=task['growth_factor'],
+                max_prior_samples=max_prior_samples,
+                randomize_prior_order=conf.randomize_prior_order,
+                random_state=rng)
+            record['n_evals'] = n_prior
+            record['n_samples'] = len(samples)
+            record['n_batches'] = n_batches
+
+        logger.debug(f'{source_id}: {len(samples)} samples from {n_batches} '
+                     f'batches ({n_prior} prior samples, initial batch '
+                     f'{init_batch_size}) in {time.time() - t0:.1f} sec')
+        results.append((source_id, samples, n_batches, n_prior))
+
+    return results
+
+
+def main(run_path, pool, overwrite=False, seed=None, adaptive=False,
+         growth_factor=4, max_task_size=256):
+    conf = Config(run_path / 'config.yml')
+
+    prior_cache_path = pathlib.Path(conf.cache_path) / 'prior-shards'
+    results_file = pathlib.Path(conf.joker_results_file)
+    if overwrite and results_file.exists():
+        results_file.unlink()
+
+    source_ids = get_visit_index(conf).source_ids
+    if results_file.exists():
+        with h5py.File(results_file, 'r') as f:
+            done = set(f.keys())
+        source_ids = np.array([x for x in source_ids if x not in done])
+        logger.info(f'{len(done)} sources already done')
+
+    init_batch_size = conf.init_batch_size
+    if init_batch_size is None:
+        init_batch_size = min(250_000, conf.n_prior_samples)
+
+    n_tasks = max(4 * pool.size, len(source_ids) // max_task_size + 1)
+    seeds = np.random.SeedSequence(seed).spawn(n_tasks)
+    tasks = []
+    for i, idx in enumerate(np.array_split(np.arange(len(source_ids)),
+                                           n_tasks)):
+        if len(idx) == 0:
+            continue
+        tasks.append({
+            'conf': conf,
+            'prior_cache_path': prior_cache_path,
+            'source_ids': source_ids[idx],
+            'adaptive': adaptive,
+            'init_batch_size': init_batch_size,
+            'growth_factor': growth_factor,
+            'seed': seeds[i]
+        })
+    logger.info(f'Running The Joker for {len(source_ids)} sources in '
+                f'{len(tasks)} tasks')
+
+    n_prior_total = 0
+
+    def callback(results):
+        nonlocal n_prior_total
+        with h5py.File(results_file, 'a') as f:
+            for source_id, samples, n_batches, n_prior in results:
+                if source_id in f:
+                    del f[source_id]
+                g = f.create_group(source_id)
+                samples.write(g, path='samples')
+                g.attrs['n_batches'] = n_batches
+                g.attrs['n_prior_samples'] = n_prior
+                n_prior_total += n_prior
+
+    for _ in pool.map(worker, tasks, callback=callback):
+        pass
+
+    logger.info(f'Used {n_prior_total} prior samples (likelihood '
+                f'evaluations) in total for {len(source_ids)} sources')
+
+
+if __name__ == '__main__':
+    import sys
+    from threadpoolctl import threadpool_limits
+    from hq.cli.helpers import get_parser
+
+    parser = get_parser(loggers=[logger])
+
+    parser.add_argument("-s", "--seed", dest="seed", default=None,
+                        type=int, help="Random number seed")
+    parser.add_argument("--adaptive", dest="adaptive", default=False,
+                        action="store_true",
+                        help="Estimate the initial batch size for each "
+                             "source instead of using init_batch_size "
+                             "(not yet calibrated)")
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.seed is None:
+        args.seed = np.random.randint(2**32 - 1)
+        logger.log(
+            1, f"No random seed specified, so using seed: {args.seed}")
+
+    with threadpool_limits(limits=1, user_api='blas'):
+        with args.Pool(**args.Pool_kwargs) as pool:
+            main(run_path=args.run_path,
+                 pool=pool,
+                 overwrite=args.overwrite,
+                 seed=args.seed,
+                 adaptive=args.adaptive)
+
+    sys.exit(0)
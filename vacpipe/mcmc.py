@@ -0,0 +1,173 @@
+"""
+Run MCMC for all sources with unimodal samplings from The Joker in a single MPI
+job. Run this as a pipeline stage with::
+
+    mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+        -m vacpipe.mcmc -v --mpi
+
+Each MPI worker is a long-lived process, so the imports (pymc3, theano, etc.)
+and the configuration are loaded once per worker instead of once per source.
+Sources are handed out one at a time to whichever worker is free, with the
+most expensive sources first. Every finished source is appended (by APOGEE_ID)
+to ``cache/hq/mcmc-checkpoint.jsonl``, and sources listed there are skipped
+when the job is restarted. The time and memory use for each source are also
+written as telemetry records (see `vacpipe.telemetry`).
+
+The sources are read from the same table as ``hq run_mcmc``: the unimodal rows
+of the Joker analysis file written by ``hq analyze_thejoker``
+(``mpi/4-analyze.sh``), not the combined metadata file, which is only made
+after this stage (``mpi/7-combine-metadata.sh``).
+
+The pymc3 model is still built from scratch for every source (inside
+``run_mcmc``). Reusing one compiled model template across sources, by
+swapping the data into shared variables, is not implemented: a template would
+first have to be checked to give the same model (and log-probability) as
+``thejoker``'s ``setup_mcmc`` for each source, and that check hasn't been
+done.
+"""
+
+# Standard library
+import json
+import pathlib
+import time
+
+# Third-party
+import astropy.table as at
+import numpy as np
+
+# Project
+from hq.config import Config
+from hq.log import logger
+from hq.cli.run_mcmc import run_mcmc
+from .telemetry import get_telemetry
+
+__all__ = ['get_mcmc_metadata', 'get_mcmc_cost', 'read_checkpoint']
+
+
+def get_mcmc_metadata(conf):
+    """
+    Rows of the Joker analysis table for the sources to run MCMC on. This is
+    the table that ``hq run_mcmc`` indexes, so row ``i`` is the source that
+    ``hq run_mcmc --index i`` runs on.
+    """
+    meta = at.QTable.read(conf.metadata_joker_file)
+    return meta[np.asarray(meta['unimodal'], dtype=bool)]
+
+
+def get_mcmc_cost(meta):
+    """
+    A rough, relative estimate of the MCMC run time for each source. The cost
+    of a likelihood evaluation scales with the number of visits, and
+    eccentric orbits need more (smaller) integration steps.
+    """
+    n_visits = np.asarray(meta['n_visits'], dtype=float)
+    e = np.clip(np.nan_to_num(np.asarray(meta['MAP_e'], dtype=float)), 0, 0.95)
+    return n_visits / (1 - e)
+
+
+def read_checkpoint(checkpoint_file):
+    """Read the APOGEE_IDs of sources that finished in previous runs."""
+    done = set()
+    if not checkpoint_file.exists():
+        return done
+
+    with open(checkpoint_file, 'r') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:  # partially-written final line
+                continue
+            if row['status'] == 'done':
+                done.add(str(row['APOGEE_ID']).strip())
+    return done
+
+
+def worker(task):
+    t0 = time.time()
+    result = {'index': task['index'],
+              'APOGEE_ID': task['source_id']}
+
+    conf = task['conf']
+    telemetry = get_telemetry(conf, 'mcmc')
+    try:
+        with telemetry.record(task['source_id'],
+                              n_visits=task['n_visits']) as record:
+            run_mcmc(run_path=task['run_path'],
+                     index=task['index'],
+                     seed=task['seed'],
+                     overwrite=task['overwrite'])
+            record['n_samples'] = conf.mcmc_draw_steps * conf.mcmc_chains
+        result['status'] = 'done'
+
+    except Exception:
+        logger.exception(f"MCMC failed for {task['source_id']} "
+                         f"(index {task['index']})")
+        result['status'] = 'failed'
+
+    result['time'] = time.time() - t0
+    return result
+
+
+def main(run_path, pool, overwrite=False, seed=None):
+    conf = Config(run_path / 'config.yml')
+
+    checkpoint_file = pathlib.Path(conf.cache_path) / 'mcmc-checkpoint.jsonl'
+    if overwrite and checkpoint_file.exists():
+        checkpoint_file.unlink()
+    done = read_checkpoint(checkpoint_file)
+
+    meta = get_mcmc_metadata(conf)
+    cost = get_mcmc_cost(meta)
+
+    source_ids = np.char.strip(np.asarray(meta['APOGEE_ID'], dtype=str))
+    if len(np.unique(source_ids)) != len(source_ids):
+        raise ValueError(f'Duplicate APOGEE_IDs in {conf.metadata_joker_file}')
+
+    tasks = []
+    for i in np.argsort(-cost, kind='stable'):
+        if source_ids[i] in done:
+            continue
+        tasks.append({
+            'run_path': run_path,
+            'conf': conf,
+            'index': int(i),
+            'source_id': source_ids[i],
+            'n_visits': int(meta['n_visits'][i]),
+            'seed': seed,
+            'overwrite': overwrite
+        })
+    logger.info(f'Running MCMC for {len(tasks)} sources '
+                f'({len(done)} already done)')
+
+    def callback(result):
+        with open(checkpoint_file, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+        logger.debug(f"{result['APOGEE_ID']}: {result['status']} "
+                     f"({result['time']:.1f} sec)")
+
+    results = list(pool.map(worker, tasks, callback=callback))
+
+    n_failed = sum(r['status'] != 'done' for r in results)
+    if n_failed:
+        logger.warn(f'MCMC failed for {n_failed} sources: rerun to retry them')
+
+
+if __name__ == '__main__':
+    import sys
+    from threadpoolctl import threadpool_limits
+    from hq.cli.helpers import get_parser
+
+    parser = get_parser(loggers=[logger])
+
+    parser.add_argument("-s", "--seed", dest="seed", default=None,
+                        type=int, help="Random number seed")
+    args = parser.parse_args(sys.argv[1:])
+
+    with threadpool_limits(limits=1, user_api='blas'):
+        with args.Pool(**args.Pool_kwargs) as pool:
+            main(run_path=args.run_path,
+                 pool=pool,
+                 overwrite=args.overwrite,
+                 seed=args.seed)
+
+    sys.exit(0)
@@ -0,0 +1,305 @@
+"""
+Package the posterior samples for release: one ``.tar.gz`` archive per FIELD
+(or whatever ``expand_subdir_column`` is set to in the run configuration),
+written to ``cache/hq/samples-archives/``. Run this as a pipeline stage with::
+
+    mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+        -m vacpipe.package -v --mpi
+
+By default, the samples are streamed straight from the HQ result files into
+the archives, with each source written as a FITS table
+``samples/<FIELD>/<APOGEE_ID>.fits`` (with the table metadata of the samples,
+e.g. ``t_ref``), so the expanded file tree made by ``hq expand_samples`` is not
+needed. The MCMC samples are used where MCMC finished with an acceptable
+status (`vacpipe.samples.get_use_mcmc`, the same rule as the mass catalog), and
+The Joker samples otherwise. With ``--from-expanded``, the existing tree in
+``cache/hq/samples/`` is archived instead.
+
+Each archive is written (and compressed) by a separate worker, and the SHA-256
+checksum is computed as the archive is written. The archive sizes, checksums,
+and number of sources are recorded in ``manifest.json`` (and the checksums
+also in ``SHA256SUMS``, for ``sha256sum -c``) as each archive is finished, so
+an interrupted run only redoes the archives that were not finished.
+"""
+
+# Standard library
+import gzip
+import hashlib
+import io
+import json
+import os
+import pathlib
+import tarfile
+import time
+import warnings
+
+# Third-party
+from astropy.io.fits.verify import VerifyWarning
+import astropy.table as at
+from astropy.time import Time
+import astropy.units as u
+import numpy as np
+
+# Project
+from hq.config import Config
+from hq.log import logger
+from .samples import SamplesReader, get_use_mcmc
+from .visits import get_visit_index
+
+__all__ = ['get_source_groups', 'write_archive']
+
+
+class HashWriter:
+    """
+    A write-only file wrapper that computes the SHA-256 checksum and size of
+    everything written through it.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def get_source_groups(conf, source_ids):
+    """
+    Group sources by the value of the ``expand_subdir_column`` in their
+    first visit in the input data file.
+
+    Returns
+    -------
+    groups : dict
+        Keys are the group names, and values are arrays of indices into
+        ``source_ids``.
+    """
+    visit_index = get_visit_index(conf)
+    colname = conf.expand_subdir_column
+
+    source_ids = np.array([str(x).strip() for x in source_ids])
+    index_ids = visit_index.source_ids
+    i = np.clip(np.searchsorted(index_ids, source_ids), 0,
+                len(index_ids) - 1)
+    if np.any(index_ids[i] != source_ids):
+        missing = source_ids[index_ids[i] != source_ids]
+        raise KeyError(f'{len(missing)} sources have no visits in the input '
+                       f'data file, e.g. {missing[0]}')
+
+    values = np.asarray(visit_index.data[colname])[visit_index.offsets[i]]
+    values = np.char.strip(np.asarray(values, dtype=str))
+    # Group names are used as paths in the archives:
+    values = np.char.replace(values, '/', '_')
+
+    groups = {}
+    names, inverse = np.unique(values, return_inverse=True)
+    for k, name in enumerate(names):
+        groups[str(name)] = np.flatnonzero(inverse == k)
+    return groups
+
+
+def _add_bytes(tar, name, data, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _samples_to_fits(samples, units, meta):
+    tbl = at.QTable(samples)
+    for name in tbl.colnames:
+        unit = units.get(name, u.one)
+        if unit != u.one:
+            tbl[name] = tbl[name] * unit
+
+    # The JokerSamples metadata (t_ref, poly_trend, n_offsets). FITS headers
+    # can't store times, so t_ref is written as an MJD (in its time scale):
+    for key, val in meta.items():
+        if key == '__serialized_columns__':
+            continue
+        if isinstance(val, Time):
+            val = val.mjd
+        tbl.meta[key] = val
+
+    buf = io.BytesIO()
+    with warnings.catch_warnings():
+        # Keys longer than 8 characters are written as HIERARCH cards:
+        warnings.simplefilter('ignore', VerifyWarning)
+        tbl.write(buf, format='fits')
+    return buf.getvalue()
+
+
+def write_archive(filename, group, source_ids=None, mcmc=None, conf=None,
+                  expanded_path=None, compresslevel=6):
+    """
+    Write one archive, either from the samples in the result files (if
+    ``source_ids`` are given) or from a directory of expanded samples.
+
+    Returns
+    -------
+    info : dict
+        The archive filename, size, SHA-256 checksum, and number of sources.
+    """
+    filename = pathlib.Path(filename)
+    tmp_filename = filename.with_name(f'.{filename.name}.{os.getpid()}')
+
+    n_sources = 0
+    mtime = int(time.time())
+    with open(tmp_filename, 'wb') as f:
+        writer = HashWriter(f)
+        with gzip.GzipFile(fileobj=writer, mode='wb', mtime=mtime,
+                           compresslevel=compresslevel) as gz, \
+                tarfile.open(fileobj=gz, mode='w|') as tar:
+            if expanded_path is not None:
+                for path in sorted(pathlib.Path(expanded_path).iterdir()):
+                    tar.add(path, arcname=f'samples/{group}/{path.name}')
+                    n_sources += 1
+
+            else:
+                with SamplesReader(conf) as reader:
+                    mcmc = np.asarray(mcmc, dtype=bool)
+                    units = {bool(x): reader.get_units(x)
+                             for x in np.unique(mcmc)}
+                    mcmc_lookup = dict(zip(source_ids, mcmc))
+                    for batch in reader.iter_batches(source_ids, mcmc):
+                        for source_id, samples in batch:
+                            use_mcmc = mcmc_lookup[source_id]
+                            data = _samples_to_fits(
+                                samples, units[use_mcmc],
+                                reader.get_meta(source_id, use_mcmc))
+                            _add_bytes(tar,
+                                       f'samples/{group}/{source_id}.fits',
+                                       data, mtime)
+                            n_sources += 1
+
+    os.replace(tmp_filename, filename)
+
+    return {'filename': filename.name,
+            'group': group,
+            'n_sources': n_sources,
+            'size': writer.size,
+            'sha256': writer.sha256.hexdigest()}
+
+
+def worker(task):
+    t0 = time.time()
+    info = write_archive(task['filename'], task['group'],
+                         source_ids=task.get('source_ids'),
+                         mcmc=task.get('mcmc'),
+                         conf=task.get('conf'),
+                         expanded_path=task.get('expanded_path'),
+                         compresslevel=task['compresslevel'])
+    logger.debug(f"Wrote {info['filename']} with {info['n_sources']} "
+                 f"sources ({info['size'] / 1024**2:.1f} MB) in "
+                 f"{time.time() - t0:.1f} seconds")
+    return info
+
+
+def write_manifest(output_path, manifest):
+    tmp_file = output_path / f'.manifest.{os.getpid()}.json'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, output_path / 'manifest.json')
+
+    with open(output_path / 'SHA256SUMS', 'w') as f:
+        for name in sorted(manifest):
+            f.write(f"{manifest[name]['sha256']}  {name}\n")
+
+
+def main(run_path, pool, overwrite=False, from_expanded=False,
+         compresslevel=6):
+    conf = Config(run_path / 'config.yml')
+
+    output_path = pathlib.Path(conf.cache_path) / 'samples-archives'
+    output_path.mkdir(exist_ok=True)
+
+    manifest = {}
+    manifest_file = output_path / 'manifest.json'
+    if manifest_file.exists() and not overwrite:
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+
+    tasks = []
+    if from_expanded:
+        expanded_path = pathlib.Path(conf.cache_path) / 'samples'
+        for path in sorted(expanded_path.iterdir()):
+            if path.is_dir():
+                tasks.append({'group': path.name,
+                              'expanded_path': path,
+                              'size': len(os.listdir(path))})
+
+    else:
+        meta = at.QTable.read(conf.metadata_file)
+        source_ids = np.array([str(x).strip() for x in meta['APOGEE_ID']])
+        mcmc = get_use_mcmc(meta)
+        for group, idx in get_source_groups(conf, source_ids).items():
+            tasks.append({'group': group,
+                          'conf': conf,
+                          'source_ids': source_ids[idx],
+                          'mcmc': mcmc[idx],
+                          'size': len(idx)})
+
+    for task in tasks:
+        task['filename'] = output_path / f"samples-{task['group']}.tar.gz"
+        task['compresslevel'] = compresslevel
+
+    # Skip archives that were finished in a previous run:
+    n_tasks = len(tasks)
+    tasks = [task for task in tasks
+             if not (task['filename'].name in manifest and
+                     task['filename'].exists() and
+                     task['filename'].stat().st_size ==
+                     manifest[task['filename'].name]['size'])]
+    if len(tasks) < n_tasks:
+        logger.info(f'{n_tasks - len(tasks)} archives already done')
+
+    # Start with the largest groups, so that the smaller ones fill in the gaps
+    # at the end:
+    tasks = sorted(tasks, key=lambda task: task['size'], reverse=True)
+    logger.info(f'Writing {len(tasks)} archives to {output_path!s}')
+
+    def callback(info):
+        manifest[info['filename']] = info
+        write_manifest(output_path, manifest)
+
+    for _ in pool.map(worker, tasks, callback=callback):
+        pass
+
+    write_manifest(output_path, manifest)
+    total_size = sum(info['size'] for info in manifest.values())
+    logger.info(f'{len(manifest)} archives, {total_size / 1024**3:.2f} GB '
+                'in total')
+
+
+if __name__ == '__main__':
+    import sys
+    from threadpoolctl import threadpool_limits
+    from hq.cli.helpers import get_parser
+
+    parser = get_parser(loggers=[logger])
+
+    parser.add_argument("--from-expanded", dest="from_expanded",
+                        default=False, action="store_true",
+                        help="Archive the file tree written by hq "
+                             "expand_samples instead of reading the result "
+                             "files")
+    parser.add_argument("--compresslevel", dest="compresslevel", default=6,
+                        type=int, help="gzip compression level")
+    args = parser.parse_args(sys.argv[1:])
+
+    with threadpool_limits(limits=1, user_api='blas'):
+        with args.Pool(**args.Pool_kwargs) as pool:
+            main(run_path=args.run_path,
+                 pool=pool,
+                 overwrite=args.overwrite,
+                 from_expanded=args.from_expanded,
+                 compresslevel=args.compresslevel)
+
+    sys.exit(0)
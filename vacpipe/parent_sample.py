@@ -0,0 +1,175 @@
+"""
+Build the parent sample of visits that HQ is run on, i.e. the input data file
+(``allVisit-dr17-synspec-min3-calibverr.fits``). Run this as a pipeline stage
+with::
+
+    python3 -m vacpipe.parent_sample -v
+
+This applies the same cuts as ``notebooks/pipeline/2-Make-Parent-Sample.ipynb``
+(with the flag bits and visit cuts set in ``hq-config/parent-sample.yml``), but
+only the needed columns are read from the allStar and allVisit files (with
+`vacpipe.catalogs.read_fits_columns`), the APOGEE_ID strings are converted to
+integer codes once, and all of the per-source cuts are done with
+`numpy.bincount` on those codes. The join with the calibrated visit errors is
+a binary search on VISIT_ID.
+"""
+
+# Standard library
+import pathlib
+
+# Third-party
+import astropy.table as at
+import numpy as np
+import yaml
+
+# Project
+from hq.log import logger
+from .catalogs import read_fits_columns
+
+__all__ = ['get_parent_sample_mask']
+
+# allStar and allVisit columns needed for the cuts:
+allstar_colnames = ['APOGEE_ID', 'STARFLAG', 'ASPCAPFLAG']
+allvisit_cut_colnames = ['APOGEE_ID', 'VISIT_ID', 'VHELIO', 'VRELERR',
+                         'STARFLAG', 'RV_FLAG']
+
+
+def get_bitmask(bits):
+    return int(np.sum(2 ** np.array(bits, dtype=np.int64)))
+
+
+def get_parent_sample_mask(allstar, allvisit, verr_visit_ids, conf):
+    """
+    Apply the parent sample cuts.
+
+    Parameters
+    ----------
+    allstar : `~astropy.table.Table`, dict
+        Columns ``allstar_colnames`` from the allStar file.
+    allvisit : `~astropy.table.Table`, dict
+        Columns ``allvisit_cut_colnames`` from the allVisit file.
+    verr_visit_ids : array-like
+        The VISIT_ID values in the calibrated visit error file.
+    conf : dict
+        The parent sample settings.
+
+    Returns
+    -------
+    mask : `numpy.ndarray`
+        Boolean mask for rows of the allVisit file to keep.
+    verr_idx : `numpy.ndarray`
+        For each allVisit row, the index of the matching row in the visit
+        error file (only valid where ``mask`` is True).
+    """
+    min_nvisits = conf['min_nvisits']
+
+    # Integer codes for all APOGEE_IDs in either file (stripped, in case the
+    # two files pad the strings differently):
+    ids, codes = np.unique(np.char.rstrip(np.concatenate((
+        np.asarray(allstar['APOGEE_ID']),
+        np.asarray(allvisit['APOGEE_ID'])))), return_inverse=True)
+    star_code = codes[:len(allstar['APOGEE_ID'])]
+    visit_code = codes[len(allstar['APOGEE_ID']):]
+    n_ids = len(ids)
+
+    def count(mask):
+        return np.bincount(visit_code[mask], minlength=n_ids)
+
+    # Remove bad velocities / NaN / Inf values:
+    vhelio = allvisit['VHELIO']
+    vrelerr = allvisit['VRELERR']
+    good = (np.isfinite(vhelio) &
+            np.isfinite(vrelerr) &
+            (vrelerr < 100.) &
+            (vhelio != -9999) &
+            (np.abs(vhelio) < 500.))
+    logger.debug(f'Filtered {len(good) - good.sum()} bad/NaN/-9999 visits')
+    has_good_visit = count(good) > 0
+
+    # Sources with at least one allStar row that passes the flag cuts:
+    starflag_bitmask = get_bitmask(conf['starflag_bits'])
+    aspcapflag_bitmask = get_bitmask(conf['aspcapflag_bits'])
+    star_ok = (((allstar['STARFLAG'] & starflag_bitmask) == 0) &
+               ((allstar['ASPCAPFLAG'] & aspcapflag_bitmask) == 0) &
+               has_good_visit[star_code])
+    id_star_ok = np.bincount(star_code[star_ok], minlength=n_ids) > 0
+
+    # Visit flag cuts:
+    rvflag_bitmask = get_bitmask(conf['rvflag_bits'])
+    good &= (((allvisit['STARFLAG'] & starflag_bitmask) == 0) &
+             ((allvisit['RV_FLAG'] & rvflag_bitmask) == 0))
+
+    keep_id = id_star_ok & (count(good) >= min_nvisits)
+    good &= keep_id[visit_code]
+
+    # Only keep visits with a calibrated visit error:
+    verr_visit_ids = np.char.rstrip(np.asarray(verr_visit_ids))
+    visit_ids = np.char.rstrip(np.asarray(allvisit['VISIT_ID']))
+    verr_order = np.argsort(verr_visit_ids, kind='stable')
+    sorted_ids = verr_visit_ids[verr_order]
+    i = np.searchsorted(sorted_ids, visit_ids)
+    i = np.clip(i, 0, len(sorted_ids) - 1)
+    has_verr = sorted_ids[i] == visit_ids
+    good &= has_verr
+    verr_idx = verr_order[i]
+
+    # Final check for min nvisits, and remove sources where more than half of
+    # all visits (in the full allVisit file) were filtered:
+    n_good = count(good)
+    n_all = count(np.ones(len(good), dtype=bool))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        keep_id = ((n_good >= min_nvisits) &
+                   (n_good / n_all > conf['min_good_visit_fraction']))
+    good &= keep_id[visit_code]
+
+    logger.debug(f'{keep_id.sum()} unique stars left')
+    logger.debug(f'{good.sum()} unique visits left')
+
+    return good, verr_idx
+
+
+def main(run_path, overwrite=False):
+    with open(run_path / 'parent-sample.yml', 'r') as f:
+        conf = yaml.safe_load(f)
+
+    output_file = pathlib.Path(conf['output_file'])
+    if output_file.exists() and not overwrite:
+        logger.warn(f'Output file exists at {output_file!s}')
+        return
+
+    allstar = read_fits_columns(conf['allstar_file'], allstar_colnames)
+    allvisit = read_fits_columns(
+        conf['allvisit_file'],
+        list(dict.fromkeys(allvisit_cut_colnames +
+                           [x for x in conf['colnames']
+                            if x != 'CALIB_VERR'])))
+    verr = read_fits_columns(conf['calib_verr_file'],
+                             ['VISIT_ID', 'CALIB_VERR'])
+
+    mask, verr_idx = get_parent_sample_mask(allstar, allvisit,
+                                            verr['VISIT_ID'], conf)
+
+    # Output rows are ordered by VISIT_ID (as from a join on VISIT_ID):
+    idx = np.flatnonzero(mask)
+    idx = idx[np.argsort(allvisit['VISIT_ID'][idx], kind='stable')]
+
+    tbl = at.Table()
+    for name in conf['colnames']:
+        if name == 'CALIB_VERR':
+            tbl[name] = verr['CALIB_VERR'][verr_idx[idx]]
+        else:
+            tbl[name] = allvisit[name][idx]
+    tbl.write(output_file, overwrite=True)
+    logger.info(f'Wrote {len(tbl)} visits to {output_file!s}')
+
+
+if __name__ == '__main__':
+    import sys
+    from hq.cli.helpers import get_parser
+
+    parser = get_parser(loggers=[logger])
+    args = parser.parse_args(sys.argv[1:])
+
+    main(run_path=args.run_path, overwrite=args.overwrite)
+
+    sys.exit(0)
@@ -0,0 +1,243 @@
+"""
+Compute percentiles of the posterior samples for every source in the HQ
+metadata file, and write them to ``cache/hq/metadata-percentiles.fits``. Each
+parameter column holds the percentiles listed in the ``PERCENTILES`` header
+keyword, and the ``<name>_n_nan`` columns count the NaN samples. Run this as a
+pipeline stage with::
+
+    mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+        -m vacpipe.percentiles -v --mpi
+
+Each task writes its rows to a separate part file as soon as it finishes, so
+an interrupted run picks up where it stopped. The inputs (result file sizes and
+modification times, and the requested percentiles and parameters) are recorded
+next to the output file, and the output is only reused if they are unchanged.
+
+With ``--update``, only the sources that changed since the last incremental
+commit (see `vacpipe.incremental`) are recomputed, and their rows are merged
+into the existing output file.
+"""
+
+# Standard library
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+
+# Third-party
+import astropy.table as at
+import numpy as np
+from schwimmbad.utils import batch_tasks
+
+# Project
+from hq.config import Config
+from hq.log import logger
+from .incremental import get_changed_sources, merge_rows
+from .samples import SamplesReader
+from .stats import get_sample_percentiles
+
+__all__ = ['get_cache_key', 'get_percentile_table']
+
+percentiles = [1, 5, 50, 95, 99]
+params = [
+    'P', 'e', 'K', 'v0', 's',
+    'logP', 'logK'
+]
+
+# Increment this when the columns in the output file change:
+output_version = 2
+
+
+def get_file_key(filename):
+    stat = os.stat(filename)
+    return {'filename': str(filename),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+def get_cache_key(conf, percentiles, params):
+    return {
+        'metadata_file': get_file_key(conf.metadata_file),
+        'joker_results_file': get_file_key(conf.joker_results_file),
+        'mcmc_results_file': get_file_key(conf.mcmc_results_file),
+        'percentiles': list(percentiles),
+        'params': list(params),
+        'version': output_version
+    }
+
+
+def get_percentile_table(reader, source_ids, mcmc, percentiles, params):
+    rows = {}
+    for batch in reader.iter_batches(source_ids, mcmc):
+        for source_id, samples in batch:
+            vals, n_nan = get_sample_percentiles(samples, params, percentiles)
+
+            row = {'APOGEE_ID': source_id}
+            for i, par in enumerate(params):
+                row[par] = vals[i]
+            for i, par in enumerate(params):
+                row[f'{par}_n_nan'] = n_nan[i]
+            rows[source_id] = row
+
+    # Samples are read in on-disk order, so put the rows back in input order:
+    source_ids = [str(x).strip() for x in source_ids]
+    return at.Table([rows[source_id] for source_id in source_ids
+                     if source_id in rows])
+
+
+def compute_rows(task):
+    metadata = task['metadata']
+    with SamplesReader(task['conf']) as reader:
+        return get_percentile_table(reader,
+                                    metadata['APOGEE_ID'],
+                                    np.asarray(metadata['mcmc_completed']),
+                                    task['percentiles'],
+                                    task['params'])
+
+
+def worker(task):
+    part_file = task['part_file']
+    if part_file.exists():
+        tbl = at.Table.read(part_file)
+        if (tbl.meta.get('CACHEKEY') == task['cache_hash'] and
+                tbl.meta.get('ROWS') == task['rows']):
+            return part_file
+
+    tbl = compute_rows(task)
+
+    tbl.meta['CACHEKEY'] = task['cache_hash']
+    tbl.meta['ROWS'] = task['rows']
+    tbl.write(part_file, overwrite=True)
+
+    return part_file
+
+
+def update_output(conf, pool, output_file, max_task_size=4096):
+    """
+    Recompute the rows for the sources that changed since the last
+    incremental commit, and merge them into the existing output file.
+    """
+    changed, removed = get_changed_sources(conf)
+
+    meta = at.QTable.read(conf.metadata_file)
+    source_ids = np.char.strip(np.asarray(meta['APOGEE_ID'], dtype=str))
+    meta = meta[np.isin(source_ids, changed)]
+
+    tasks = []
+    if len(meta) > 0:
+        n_tasks = max(4 * pool.size, len(meta) // max_task_size + 1)
+        for i1, i2 in batch_tasks(min(n_tasks, len(meta)), len(meta)):
+            tasks.append({
+                'conf': conf,
+                'metadata': meta['APOGEE_ID', 'mcmc_completed'][i1:i2],
+                'percentiles': percentiles,
+                'params': params
+            })
+
+    parts = []
+    for part in pool.map(compute_rows, tasks):
+        if len(part) > 0:
+            parts.append(part)
+
+    old = at.Table.read(output_file)
+    new = at.vstack(parts) if parts else old[:0]
+    tbl = merge_rows(old, new, np.union1d(changed, removed),
+                     order_ids=source_ids)
+    tbl.meta['PERCENTILES'] = json.dumps(percentiles)
+    tbl.write(output_file, overwrite=True)
+
+    logger.info(f'Updated {len(new)} rows of {output_file!s} '
+                f'({len(tbl)} rows)')
+
+
+def main(run_path, pool, overwrite=False, update=False,
+         max_task_size=4096):
+    conf = Config(run_path / 'config.yml')
+
+    output_file = pathlib.Path(conf.cache_path) / 'metadata-percentiles.fits'
+    cache_key_file = output_file.with_suffix('.json')
+    parts_path = output_file.with_name('metadata-percentiles-parts')
+
+    cache_key = get_cache_key(conf, percentiles, params)
+    cache_hash = hashlib.sha1(
+        json.dumps(cache_key, sort_keys=True).encode()).hexdigest()
+
+    if output_file.exists() and cache_key_file.exists() and not overwrite:
+        with open(cache_key_file, 'r') as f:
+            old_cache_key = json.load(f)
+        if old_cache_key == cache_key:
+            logger.info(f'Output file {output_file!s} is up to date')
+            return
+
+        # Only merge into an output file with the same columns:
+        same_columns = all(old_cache_key.get(k) == cache_key[k]
+                           for k in ['percentiles', 'params', 'version'])
+        if update and same_columns:
+            update_output(conf, pool, output_file, max_task_size=max_task_size)
+            with open(cache_key_file, 'w') as f:
+                json.dump(cache_key, f, indent=2)
+            return
+
+        logger.info(f'Inputs changed since {output_file!s} was made: '
+                    'recomputing')
+
+    if overwrite and parts_path.exists():
+        shutil.rmtree(parts_path)
+    parts_path.mkdir(exist_ok=True)
+
+    meta = at.QTable.read(conf.metadata_file)
+
+    n_tasks = max(4 * pool.size, len(meta) // max_task_size + 1)
+    tasks = []
+    for i, (i1, i2) in enumerate(batch_tasks(n_tasks, len(meta))):
+        tasks.append({
+            'conf': conf,
+            'metadata': meta['APOGEE_ID', 'mcmc_completed'][i1:i2],
+            'percentiles': percentiles,
+            'params': params,
+            'part_file': parts_path / f'part-{i:05d}.fits',
+            'rows': f'{i1}:{i2}',
+            'cache_hash': cache_hash
+        })
+
+    part_files = []
+    for part_file in pool.map(worker, tasks):
+        part_files.append(part_file)
+
+    parts = []
+    for part_file in sorted(part_files):
+        part = at.Table.read(part_file)
+        part.meta.clear()
+        parts.append(part)
+
+    tbl = at.vstack(parts)
+    tbl.meta['PERCENTILES'] = json.dumps(percentiles)
+    tbl.write(output_file, overwrite=True)
+
+    with open(cache_key_file, 'w') as f:
+        json.dump(cache_key, f, indent=2)
+
+    shutil.rmtree(parts_path)
+
+
+if __name__ == '__main__':
+    import sys
+    from threadpoolctl import threadpool_limits
+    from hq.cli.helpers import get_parser
+
+    parser = get_parser(loggers=[logger])
+    parser.add_argument("--update", dest="update", default=False,
+                        action="store_true",
+                        help="Only recompute the sources that changed since "
+                             "the last incremental commit")
+    args = parser.parse_args(sys.argv[1:])
+
+    with threadpool_limits(limits=1, user_api='blas'):
+        with args.Pool(**args.Pool_kwargs) as pool:
+            main(run_path=args.run_path,
+                 pool=pool,
+                 overwrite=args.overwrite,
+                 update=args.update)
+
+    sys.exit(0)
@@ -0,0 +1,238 @@
+"""
+A sharded, memory-mappable cache of prior samples for The Joker. Make the
+cache as a pipeline stage with::
+
+    mpirun python3 -m mpi4py.run -rc thread_level='funneled' \
+        -m vacpipe.prior_cache -v --mpi
+
+The cache is a directory (``cache/hq/prior-shards``) with a ``manifest.json``
+file and one ``.npy`` file per shard. Each shard is a 2D float64 array with one
+row per parameter (including ``ln_prior``), so a contiguous block of samples
+for one parameter is a contiguous slice of the file. The shards are opened
+with ``mmap_mode='r'``, so all processes on a node share the same pages
+through the OS page cache, and only the blocks that are used are read.
+
+All samples within a shard are independent draws from the prior, so a random
+subset of the prior cache is a random choice of (shard, offset) blocks; the
+samples within the cache are never shuffled or read in full.
+"""
+
+# Standard library
+import json
+import os
+import pathlib
+
+# Third-party
+import astropy.table as at
+import astropy.units as u
+import numpy as np
+import thejoker as tj
+
+# Project
+from hq.config import Config
+from hq.log import logger
+from .config import get_prior_module
+from .telemetry import get_telemetry
+
+__all__ = ['PriorCache', 'make_prior_shard']
+
+
+class PriorCache:
+    """
+    Read blocks of prior samples from a sharded prior cache.
+
+    Parameters
+    ----------
+    path : path-like
+        The prior cache directory, containing ``manifest.json``.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        with open(self.path / 'manifest.json', 'r') as f:
+            self.manifest = json.load(f)
+
+        self.par_names = self.manifest['par_names']
+        self.units = {name: u.Unit(unit)
+                      for name, unit in self.manifest['units'].items()}
+        self.shard_sizes = np.array(self.manifest['shard_sizes'])
+        self._shards = {}
+
+    def __len__(self):
+        return int(self.shard_sizes.sum())
+
+    def get_shard(self, i):
+        if i not in self._shards:
+            self._shards[i] = np.load(
+                self.path / self.manifest['shard_files'][i], mmap_mode='r')
+        return self._shards[i]
+
+    def get_block_slots(self, size, random_state=None):
+        """
+        Split the cache into non-overlapping blocks of (at most) ``size``
+        samples that do not cross shard boundaries, and return them as an
+        array of ``(shard, start, stop)`` rows. If a random state is passed in,
+        the blocks are returned in a random order.
+        """
+        slots = []
+        for i, shard_size in enumerate(self.shard_sizes):
+            starts = np.arange(0, shard_size, size)
+            stops = np.minimum(starts + size, shard_size)
+            slots.append(np.stack((np.full_like(starts, i), starts, stops),
+                                  axis=1))
+        slots = np.concatenate(slots)
+
+        if random_state is not None:
+            slots = slots[random_state.permutation(len(slots))]
+        return slots
+
+    def iter_blocks(self, size, random_state=None, growth_factor=1,
+                    max_size=None):
+        """
+        Yield blocks of prior samples (as `~thejoker.JokerSamples`) until the
+        cache is exhausted. The first block has ``size`` samples, and each
+        block after that is ``growth_factor`` times larger (up to
+        ``max_size``). Blocks are views of the memory-mapped shards unless a
+        block has to be combined from more than one shard block.
+        """
+        slot_size = min(size, int(self.shard_sizes.max()))
+        if max_size is None:
+            max_size = len(self)
+
+        parts = []
+        n = 0
+        for i, i1, i2 in self.get_block_slots(slot_size, random_state):
+            parts.append(self.get_shard(i)[:, i1:i2])
+            n += i2 - i1
+            if n >= size:
+                yield self._to_samples(parts)
+                parts = []
+                n = 0
+                size = min(int(size * growth_factor), max_size)
+
+        if parts:
+            yield self._to_samples(parts)
+
+    def _to_samples(self, parts):
+        if len(parts) == 1:
+            block = parts[0]
+        else:
+            block = np.concatenate(parts, axis=1)
+
+        tbl = at.QTable()
+        for name, row in zip(self.par_names, block):
+            tbl[name] = u.Quantity(row, self.units[name], copy=False)
+        return tj.JokerSamples(tbl)
+
+
+def get_par_units(prior):
+    """Names and units of the prior parameters, including ``ln_prior``."""
+    samples = prior.sample(size=1, return_logprobs=True)
+    par_names = list(samples.par_names) + ['ln_prior']
+    units = {name: u.Quantity(samples[name]).unit.to_string()
+             for name in par_names}
+    return par_names, units
+
+
+def make_prior_shard(prior, par_names, size, filename, random_state):
+    """
+    Generate ``size`` samples from the prior and write them to a shard file.
+    The file is written to a temporary name and then renamed, so a shard file
+    only exists once it is complete.
+    """
+    samples = prior.sample(size=size, return_logprobs=True,
+                           random_state=random_state)
+
+    block = np.empty((len(par_names), size), dtype=np.float64)
+    for j, name in enumerate(par_names):
+        block[j] = u.Quantity(samples[name]).value
+
+    tmp_filename = filename.with_suffix('.tmp.npy')
+    np.save(tmp_filename, block)
+    os.replace(tmp_filename, filename)
+
+
+def worker(task):
+    filename = task['filename']
+    telemetry = get_telemetry(task['conf'], 'prior_cache')
+    with telemetry.record(filename.name, n_sources=0,
+                          n_samples=task['size']) as record:
+        if filename.exists() and not task['overwrite']:
+            record['status'] = 'skipped'
+            return
+
+        logger.debug(f'Generating prior shard {filename.name}')
+        prior, _ = get_prior_module(task['conf']).get_prior()
+        make_prior_shard(prior, task['par_names'], task['size'], filename,
+                         np.random.default_rng(task['seed']))
+
+
+def main(run_path, pool, overwrite=False, seed=None, shard_size=2**22):
+    conf = Config(run_path / 'config.yml')
+
+    cache_path = pathlib.Path(conf.cache_path) / 'prior-shards'
+    manifest_file = cache_path / 'manifest.json'
+    n_samples = int(conf.n_prior_samples)
+
+    if manifest_file.exists() and not overwrite:
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        if sum(manifest['shard_sizes']) == n_samples:
+            logger.warn(f'Prior cache exists at {cache_path!s}')
+            return
+    cache_path.mkdir(exist_ok=True)
+
+    shard_sizes = [shard_size] * (n_samples // shard_size)
+    if n_samples % shard_size:
+        shard_sizes.append(n_samples % shard_size)
+
+    prior, _ = get_prior_module(conf).get_prior()
+    par_names, units = get_par_units(prior)
+
+    seeds = np.random.SeedSequence(seed).spawn(len(shard_sizes))
+    tasks = [{'conf': conf,
+              'par_names': par_names,
+              'size': size,
+              'filename': cache_path / f'shard-{i:05d}.npy',
+              'seed': seeds[i],
+              'overwrite': overwrite}
+             for i, size in enumerate(shard_sizes)]
+    logger.info(f'Generating {n_samples} prior samples in '
+                f'{len(tasks)} shards')
+
+    for _ in pool.map(worker, tasks):
+        pass
+
+    manifest = {'par_names': par_names,
+                'units': units,
+                'shard_files': [task['filename'].name for task in tasks],
+                'shard_sizes': shard_sizes,
+                'seed': seed}
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+if __name__ == '__main__':
+    import sys
+    from threadpoolctl import threadpool_limits
+    from hq.cli.helpers import get_parser
+
+    parser = get_parser(loggers=[logger])
+
+    parser.add_argument("-s", "--seed", dest="seed", default=None,
+                        type=int, help="Random number seed")
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.seed is None:
+        args.seed = np.random.randint(2**32 - 1)
+        logger.log(
+            1, f"No random seed specified, so using seed: {args.seed}")
+
+    with threadpool_limits(limits=1, user_api='blas'):
+        with args.Pool(**args.Pool_kwargs) as pool:
+            main(run_path=args.run_path,
+                 pool=pool,
+                 overwrite=args.overwrite,
+                 seed=args.seed)
+
+    sys.exit(0)
@@ -0,0 +1,156 @@
+# Third-party
+import astropy.table as at
+import astropy.units as u
+import h5py
+import numpy as np
+from astropy.table.meta import get_header_from_yaml
+
+__all__ = ['SamplesReader', 'get_use_mcmc']
+
+
+def get_use_mcmc(meta):
+    """
+    Whether to use the MCMC samples (rather than The Joker samples) for each
+    row of the metadata table: only where MCMC finished with an acceptable
+    status (``0 < mcmc_status <= 2``).
+    """
+    status = np.asarray(meta['mcmc_status'])
+    return (status > 0) & (status <= 2)
+
+
+class SamplesReader:
+    """
+    Bulk reader for the per-source samples in the HQ result files.
+
+    Use this as a context manager: both the Joker and MCMC result files are
+    kept open while it is in use. The samples table for a source is read in a
+    single call (all fields at once) as a numpy structured array.
+
+    Parameters
+    ----------
+    conf : `hq.config.Config`
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self._files = None
+        self._units = {}
+
+    def __enter__(self):
+        self._files = {
+            False: h5py.File(self.conf.joker_results_file, 'r'),
+            True: h5py.File(self.conf.mcmc_results_file, 'r')
+        }
+        return self
+
+    def __exit__(self, *args):
+        for f in self._files.values():
+            f.close()
+        self._files = None
+
+    def get_source_ids(self, mcmc=False):
+        """All sources with samples in the Joker (or MCMC) results file."""
+        return list(self._files[bool(mcmc)].keys())
+
+    def get_dataset(self, source_id, mcmc=False):
+        return self._files[bool(mcmc)][source_id]['samples']
+
+    def read(self, source_id, mcmc=False):
+        return self.get_dataset(source_id, mcmc)[()]
+
+    def get_meta(self, source_id, mcmc=False):
+        """
+        The table metadata of a source's samples (e.g., ``t_ref``,
+        ``poly_trend``, and ``n_offsets`` for JokerSamples), read from the
+        serialized header without reading the samples.
+        """
+        group = self._files[bool(mcmc)][source_id]
+        if 'samples.__table_column_meta__' in group:
+            lines = group['samples.__table_column_meta__'][()]
+        elif '__table_column_meta__' in group['samples'].attrs:
+            lines = group['samples'].attrs['__table_column_meta__']
+        else:
+            return {}
+        header = get_header_from_yaml(x.decode('utf-8') for x in lines)
+        return dict(header.get('meta', {}))
+
+    def get_units(self, mcmc=False):
+        """
+        Units of the sample columns in the Joker (or MCMC) results file. These
+        are the same for all sources, so they are read once from the table
+        metadata of the first source in the file.
+        """
+        mcmc = bool(mcmc)
+        if mcmc not in self._units:
+            f = self._files[mcmc]
+            tbl = at.QTable.read(f[next(iter(f.keys()))], path='samples')
+
+            units = {}
+            for name in tbl.colnames:
+                unit = getattr(tbl[name], 'unit', None)
+                units[name] = u.one if unit is None else unit
+            self._units[mcmc] = units
+        return self._units[mcmc]
+
+    def get_disk_order(self, source_ids, mcmc):
+        """
+        Sort indices for the input sources by the file (Joker or MCMC) and
+        byte offset of their samples, so that reading in this order streams
+        through each file instead of seeking around it.
+        """
+        mcmc = np.broadcast_to(np.asarray(mcmc, dtype=bool),
+                               (len(source_ids), ))
+
+        locs = np.zeros(len(source_ids))
+        for i, (source_id, use_mcmc) in enumerate(zip(source_ids, mcmc)):
+            try:
+                offset = self.get_dataset(source_id, use_mcmc).id.get_offset()
+            except KeyError:
+                offset = None
+            # Chunked, compressed, or missing datasets have no single offset:
+            locs[i] = np.inf if offset is None else offset
+
+        return np.lexsort((np.arange(len(source_ids)), locs, mcmc))
+
+    def iter_batches(self, source_ids, mcmc=False, max_sources=1024,
+                     max_samples=None):
+        """
+        Read the samples for all of the input sources, in on-disk order, and
+        yield them in batches as lists of ``(source_id, samples)`` tuples,
+        where ``samples`` is a numpy structured array. Sources without samples
+        in the result file are skipped.
+
+        Parameters
+        ----------
+        source_ids : array-like
+        mcmc : bool, array-like
+            Whether to read each source's samples from the MCMC results file
+            (True) or The Joker results file (False).
+        max_sources : int (optional)
+            The maximum number of sources in a batch.
+        max_samples : int (optional)
+            The (approximate) maximum total number of samples in a batch.
+        """
+        source_ids = [str(x).strip() for x in source_ids]
+        mcmc = np.broadcast_to(np.asarray(mcmc, dtype=bool),
+                               (len(source_ids), ))
+
+        batch = []
+        n_samples = 0
+        for i in self.get_disk_order(source_ids, mcmc):
+            try:
+                samples = self.read(source_ids[i], mcmc[i])
+            except KeyError:
+                continue
+
+            batch.append((source_ids[i], samples))
+            n_samples += len(samples)
+
+            if (len(batch) >= max_sources or
+                    (max_samples is not None and n_samples >= max_samples)):
+                yield batch
+                batch = []
+                n_samples = 0
+
+        if batch:
+            yield batch
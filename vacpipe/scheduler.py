@@ -0,0 +1,170 @@
+"""
+Cost-based task scheduling for the MPI / multiprocessing helper scripts.
+
+The run time for one source varies a lot (with the number of visits and the
+number of samples, i.e. whether MCMC was run), so cutting the sources into a
+few contiguous slices leaves some workers running long after the others are
+done. Instead, `get_source_cost` estimates the relative cost of each source
+from the metadata, `make_chunks` packs the sources into many small chunks of
+about equal total cost (ordered most expensive first), and `map_tasks` hands
+the chunks out to whichever worker is free and logs the busy and idle time of
+each worker at the end.
+"""
+
+# Standard library
+from collections import defaultdict
+import heapq
+import time
+
+# Third-party
+import numpy as np
+
+# Project
+from hq.log import logger
+from .telemetry import get_worker_name
+
+__all__ = ['get_n_samples', 'get_source_cost', 'make_chunks', 'map_tasks']
+
+
+def get_n_samples(meta, conf):
+    """
+    The number of posterior samples for each source: from the ``n_samples``
+    column of the metadata if there is one, otherwise the number of MCMC
+    draws for sources where MCMC completed and the number of requested Joker
+    samples for the others.
+    """
+    if 'n_samples' in meta.colnames:
+        return np.asarray(meta['n_samples'], dtype=float)
+
+    mcmc = np.asarray(meta['mcmc_completed'], dtype=bool)
+    n_mcmc = conf.mcmc_draw_steps * conf.mcmc_chains
+    n_joker = conf.requested_samples_per_star
+    return np.where(mcmc, n_mcmc, n_joker).astype(float)
+
+
+def get_source_cost(meta, conf, per_source=1., per_visit=0., per_sample=0.):
+    """
+    A rough, relative estimate of the time to process each source, as a fixed
+    cost plus a cost per visit and per posterior sample.
+
+    Parameters
+    ----------
+    meta : `~astropy.table.Table`
+        The HQ metadata for the sources.
+    conf : `hq.config.Config`
+    per_source, per_visit, per_sample : float (optional)
+        The relative cost of each part.
+    """
+    n_visits = np.asarray(meta['n_visits'], dtype=float)
+    return (per_source +
+            per_visit * n_visits +
+            per_sample * get_n_samples(meta, conf))
+
+
+def make_chunks(cost, n_chunks):
+    """
+    Split sources into chunks with about equal total cost.
+
+    Sources are assigned from the most to the least expensive, each to the
+    chunk with the lowest total cost so far.
+
+    Parameters
+    ----------
+    cost : array-like
+        The cost of each source (see `get_source_cost`).
+    n_chunks : int
+
+    Returns
+    -------
+    chunks : list of `numpy.ndarray`
+        The (sorted) indices of the sources in each chunk, with the most
+        expensive chunks first. Empty chunks are not returned.
+    """
+    cost = np.asarray(cost, dtype=float)
+    n_chunks = max(1, min(int(n_chunks), len(cost)))
+
+    heap = [(0., i) for i in range(n_chunks)]
+    members = [[] for _ in range(n_chunks)]
+    for j in np.argsort(-cost, kind='stable'):
+        total, i = heapq.heappop(heap)
+        members[i].append(j)
+        heapq.heappush(heap, (total + cost[j], i))
+
+    totals = {i: total for total, i in heap}
+    order = sorted(range(n_chunks), key=lambda i: -totals[i])
+    return [np.sort(np.array(members[i], dtype=int))
+            for i in order if members[i]]
+
+
+class _TimedWorker:
+    """Wrap a worker function to also return the worker name and run time."""
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def __call__(self, indexed_task):
+        i, task = indexed_task
+        t0 = time.time()
+        result = self.worker(task)
+        return i, result, get_worker_name(), time.time() - t0
+
+
+def map_tasks(pool, worker, tasks, callback=None):
+    """
+    Run ``worker`` on all tasks, handing each task to the next free worker
+    (in the order of ``tasks``), and log the busy and idle time of each
+    worker when all tasks are done.
+
+    Parameters
+    ----------
+    pool : `schwimmbad` pool
+    worker : callable
+    tasks : list
+    callback : callable (optional)
+        Called in the main process with the result of each task, as soon as
+        the task is done.
+
+    Returns
+    -------
+    results : list
+        The results, in the same order as ``tasks``.
+    """
+    t0 = time.time()
+    results = [None] * len(tasks)
+    busy = defaultdict(float)
+    n_done = defaultdict(int)
+
+    def _callback(res):
+        i, result, name, dt = res
+        results[i] = result
+        busy[name] += dt
+        n_done[name] += 1
+        if callback is not None:
+            callback(result)
+
+    timed_worker = _TimedWorker(worker)
+    indexed_tasks = list(enumerate(tasks))
+    if hasattr(pool, 'imap_unordered'):
+        # multiprocessing-based pools split the tasks into large chunks in
+        # map(), so hand out the tasks one at a time instead:
+        for res in pool.imap_unordered(timed_worker, indexed_tasks,
+                                       chunksize=1):
+            _callback(res)
+    else:
+        for _ in pool.map(timed_worker, indexed_tasks, callback=_callback):
+            pass
+
+    wall_time = time.time() - t0
+    for name in sorted(busy):
+        logger.info(f'{name}: {n_done[name]} tasks, busy '
+                    f'{busy[name]:.1f} sec, idle '
+                    f'{max(wall_time - busy[name], 0):.1f} sec')
+    n_workers = max(getattr(pool, 'size', 1), len(busy))
+    if n_workers > len(busy):
+        logger.info(f'{n_workers - len(busy)} workers got no tasks')
+    if tasks and wall_time > 0:
+        efficiency = sum(busy.values()) / (n_workers * wall_time)
+        logger.info(f'{len(tasks)} tasks on {n_workers} workers in '
+                    f'{wall_time:.1f} sec ({efficiency:.0%} busy)')
+
+    return results
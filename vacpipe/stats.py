@@ -0,0 +1,117 @@
+# Third-party
+import numpy as np
+
+__all__ = ['nanpercentiles', 'grouped_nanpercentiles',
+           'get_param_values', 'get_sample_percentiles']
+
+
+def nanpercentiles(x, q):
+    """
+    Compute percentiles (ignoring NaN values) along the last axis of a 1D or
+    2D array. All of the requested percentiles (and all rows) are computed
+    from a single call to `numpy.partition` instead of a full sort per
+    percentile. This uses the same (linear) interpolation as
+    `numpy.nanpercentile`.
+
+    Parameters
+    ----------
+    x : array-like
+        Shape ``(n_rows, n)`` or ``(n, )``.
+    q : array-like
+        The percentiles to compute, in the range [0, 100].
+
+    Returns
+    -------
+    vals : `numpy.ndarray`
+        Shape ``(n_rows, len(q))``.
+    n_nan : `numpy.ndarray`
+        The number of NaN values in each row, shape ``(n_rows, )``.
+    """
+    x = np.atleast_2d(x)
+    q = np.asarray(q, dtype=float)
+
+    n_nan = np.isnan(x).sum(axis=1)
+    n_valid = x.shape[1] - n_nan
+    if x.shape[1] == 0:
+        return np.full((len(x), len(q)), np.nan), n_nan
+
+    pos = q[None] / 100. * (n_valid[:, None] - 1)
+    lo = np.clip(np.floor(pos).astype(int), 0, None)
+    hi = np.clip(np.minimum(lo + 1, n_valid[:, None] - 1), 0, None)
+
+    # NaN values are partitioned to the end of each row, past n_valid:
+    kth = np.unique(np.concatenate((lo.ravel(), hi.ravel())))
+    xp = np.partition(x, kth, axis=1)
+
+    rows = np.arange(len(x))[:, None]
+    x_lo = xp[rows, lo]
+    x_hi = xp[rows, hi]
+
+    # Interpolate from the nearer end, as numpy does:
+    t = pos - lo
+    with np.errstate(invalid='ignore'):
+        diff = x_hi - x_lo
+        vals = np.where(t < 0.5, x_lo + diff * t, x_hi - diff * (1 - t))
+        vals = np.where(x_lo == x_hi, x_lo, vals)
+    vals[n_valid == 0] = np.nan
+
+    return vals, n_nan
+
+
+def grouped_nanpercentiles(x, offsets, q):
+    """
+    Compute percentiles (ignoring NaN values) of contiguous groups of values
+    in a flat array, where group ``i`` is ``x[offsets[i]:offsets[i+1]]``. If
+    all groups are the same size (the usual case for posterior samples), this
+    is a single partition of the reshaped array.
+
+    Returns
+    -------
+    vals : `numpy.ndarray`
+        Shape ``(len(offsets) - 1, len(q))``.
+    n_nan : `numpy.ndarray`
+        The number of NaN values in each group.
+    """
+    offsets = np.asarray(offsets)
+    sizes = np.diff(offsets)
+
+    if len(sizes) > 0 and np.all(sizes == sizes[0]):
+        return nanpercentiles(
+            x[offsets[0]:offsets[-1]].reshape(len(sizes), sizes[0]), q)
+
+    vals = np.full((len(sizes), len(q)), np.nan)
+    n_nan = np.zeros(len(sizes), dtype=int)
+    for i, (i1, i2) in enumerate(zip(offsets[:-1], offsets[1:])):
+        group_vals, group_n_nan = nanpercentiles(x[i1:i2], q)
+        vals[i] = group_vals[0]
+        n_nan[i] = group_n_nan[0]
+    return vals, n_nan
+
+
+def get_param_values(samples, name):
+    """
+    Get the values of a parameter from a table or structured array of
+    samples. Names starting with ``log`` are the base-10 log of the absolute
+    value of the parameter, e.g., ``logK``.
+    """
+    if name.startswith('log'):
+        with np.errstate(divide='ignore'):
+            return np.log10(np.abs(samples[name[3:]]))
+    return samples[name]
+
+
+def get_sample_percentiles(samples, params, q):
+    """
+    Compute percentiles of several (possibly derived) parameters from the
+    samples for one source, all in one partition.
+
+    Returns
+    -------
+    vals : `numpy.ndarray`
+        Shape ``(len(params), len(q))``.
+    n_nan : `numpy.ndarray`
+        The number of NaN samples of each parameter.
+    """
+    x = np.stack([np.asarray(get_param_values(samples, name), dtype=float)
+                  for name in params])
+    return nanpercentiles(x, q)
@@ -0,0 +1,425 @@
+"""
+Per-source timing and memory telemetry for the pipeline stages.
+
+The workers of each stage append one JSON record per source (or per shard,
+for the prior cache) to a file of their own,
+``cache/hq/telemetry/<stage>/<host>-<pid>.jsonl``, so MPI ranks never write to
+the same file. Each record has the fields:
+
+- ``stage``, ``item``: the stage name and the APOGEE_ID (or the shard name)
+- ``n_sources``: the number of sources in the item
+- ``rank``, ``host``, ``pid``: the MPI rank (or None) and process of the
+  worker
+- ``start``, ``wall_time``: the UNIX time the work started, and the time it
+  took in seconds. For stages that process a batch of sources at once, this
+  is the source's share of the batch time (`Telemetry.record_batch`), and
+  the records also have ``batch``, ``batch_size``, and ``batch_wall_time``
+- ``peak_rss``: the peak resident memory of the worker process so far, in MB
+  (None for the single record of a whole run written with ``--record-run``)
+- ``status``: ``'ok'``, ``'skipped'``, or ``'failed'``, and ``error``: the
+  reason for a failure
+
+plus any stage-specific fields, e.g. ``n_evals`` (likelihood evaluations),
+``n_samples`` (samples drawn), or ``n_visits``. Records from resumed runs are
+added to the same directory. Summarize them with::
+
+    python3 -m vacpipe.telemetry -v
+
+which reports the total time and throughput of each stage, the time per rank,
+the slowest sources (stragglers), and the failures.
+"""
+
+# Standard library
+from collections import Counter, defaultdict
+import contextlib
+import datetime
+import json
+import os
+import pathlib
+import resource
+import socket
+import sys
+import time
+
+# Third-party
+import numpy as np
+
+# Project
+from hq.config import Config
+from hq.log import logger
+
+__all__ = ['get_worker_name', 'get_telemetry', 'load_records',
+           'summarize']
+
+# Telemetry writers already opened by this process, keyed by (path, stage)
+_telemetry = {}
+
+
+def get_telemetry_path(conf):
+    return pathlib.Path(conf.cache_path) / 'telemetry'
+
+
+def get_rank():
+    """The MPI rank of this process, or None if MPI is not in use."""
+    # Only ask MPI for the rank if the pool has already imported (and
+    # initialized) it:
+    if 'mpi4py.MPI' in sys.modules:
+        MPI = sys.modules['mpi4py.MPI']
+        if MPI.Is_initialized():
+            return MPI.COMM_WORLD.Get_rank()
+    return None
+
+
+def get_worker_name():
+    rank = get_rank()
+    if rank is not None:
+        return f'rank {rank}'
+    return f'pid {os.getpid()}'
+
+
+def get_peak_rss():
+    """The peak resident memory of this process, in MB."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere:
+    if sys.platform == 'darwin':
+        return maxrss / 1024**2
+    return maxrss / 1024
+
+
+def _to_json(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, bytes):
+        return obj.decode()
+    return str(obj)
+
+
+class Telemetry:
+    """
+    Writes telemetry records for one stage from one process. Use
+    `get_telemetry` to get the writer for a stage.
+    """
+
+    def __init__(self, path, stage):
+        self.path = pathlib.Path(path) / stage
+        self.stage = stage
+        self._f = None
+        self._pid = None
+
+    def _get_file(self):
+        # Reopen after a fork, so that each process writes its own file:
+        if self._f is None or self._pid != os.getpid():
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._pid = os.getpid()
+            filename = self.path / f'{socket.gethostname()}-{self._pid}.jsonl'
+            self._f = open(filename, 'a', buffering=1)
+        return self._f
+
+    def write(self, item, **fields):
+        """Write one record, adding the stage, worker, and memory fields."""
+        record = {'stage': self.stage,
+                  'item': str(item).strip(),
+                  'n_sources': 1,
+                  'rank': get_rank(),
+                  'host': socket.gethostname(),
+                  'pid': os.getpid(),
+                  'peak_rss': get_peak_rss(),
+                  'status': 'ok'}
+        record.update(fields)
+        # A single write of a full line, so a killed job leaves at most one
+        # partial line at the end of the file:
+        self._get_file().write(json.dumps(record, default=_to_json) + '\n')
+
+    @contextlib.contextmanager
+    def record(self, item, **fields):
+        """
+        Time the work done inside the ``with`` block and write a record for
+        it when the block ends. The context manager returns the record
+        fields as a dict, so the block can add fields (or set ``status``
+        to ``'skipped'``). If the block raises an exception, the record is
+        written with ``status='failed'`` and the exception is re-raised.
+        """
+        fields = dict(fields)
+        fields['start'] = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield fields
+        except Exception as e:
+            fields['status'] = 'failed'
+            fields['error'] = f'{type(e).__name__}: {e!s}'
+            raise
+        finally:
+            fields['wall_time'] = time.perf_counter() - t0
+            self.write(item, **fields)
+
+    @contextlib.contextmanager
+    def record_batch(self, items=None, weights=None, **fields):
+        """
+        Like `record`, but for work done on a batch of sources at once (e.g.,
+        with array operations), so the time for each source can't be
+        measured on its own. One record is written per source, and the wall
+        time of the batch is split between them in proportion to
+        ``weights`` (e.g., the number of visits or samples of each source),
+        or evenly if not given.
+
+        Field values that are arrays with one value per source are split
+        between the records. Each record also has the first item, number
+        of sources, and total wall time of the batch (``batch``,
+        ``batch_size``, ``batch_wall_time``). The items and weights can also
+        be set in the block (as ``'items'`` and ``'weights'`` in the
+        returned dict), e.g. if they are only known after reading the
+        batch.
+        """
+        fields = dict(fields, items=items, weights=weights)
+        fields['start'] = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield fields
+        except Exception as e:
+            fields['status'] = 'failed'
+            fields['error'] = f'{type(e).__name__}: {e!s}'
+            raise
+        finally:
+            wall_time = time.perf_counter() - t0
+            items = fields.pop('items')
+            weights = fields.pop('weights')
+            if items is not None and len(items) > 0:
+                n = len(items)
+                if weights is None:
+                    weights = np.ones(n)
+                weights = np.asarray(weights, dtype=float)
+                if weights.sum() > 0:
+                    share = weights / weights.sum()
+                else:
+                    share = np.full(n, 1. / n)
+
+                # The shares are laid end to end in time, so the summary of
+                # the elapsed time is the same as for the batch:
+                start = fields['start'] + wall_time * (np.cumsum(share) -
+                                                       share)
+                fields.update(batch=str(items[0]).strip(), batch_size=n,
+                              batch_wall_time=wall_time)
+                for i, item in enumerate(items):
+                    this = {k: (v[i] if np.ndim(v) == 1 and len(v) == n
+                                else v)
+                            for k, v in fields.items()}
+                    this['start'] = start[i]
+                    this['wall_time'] = wall_time * share[i]
+                    self.write(item, **this)
+
+
+def get_telemetry(conf, stage):
+    """
+    Get the telemetry writer for a stage in this process.
+
+    Parameters
+    ----------
+    conf : `hq.config.Config`
+    stage : str
+    """
+    path = get_telemetry_path(conf)
+    key = (str(path), stage)
+    if key not in _telemetry:
+        _telemetry[key] = Telemetry(path, stage)
+    return _telemetry[key]
+
+
+def load_records(conf, stages=None, since=None):
+    """
+    Read the telemetry records for a run.
+
+    Parameters
+    ----------
+    conf : `hq.config.Config`
+    stages : iterable (optional)
+        Only read the records for these stages.
+    since : float (optional)
+        Only keep records for work that started after this UNIX time.
+
+    Returns
+    -------
+    records : dict
+        Keys are stage names, and values are lists of records.
+    """
+    records = defaultdict(list)
+    path = get_telemetry_path(conf)
+    if not path.exists():
+        return records
+
+    for stage_path in sorted(path.iterdir()):
+        if not stage_path.is_dir():
+            continue
+        if stages is not None and stage_path.name not in stages:
+            continue
+
+        for filename in sorted(stage_path.glob('*.jsonl')):
+            with open(filename, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:  # partially-written line
+                        continue
+                    if since is not None and record['start'] < since:
+                        continue
+                    records[stage_path.name].append(record)
+
+    return records
+
+
+def _summarize_stage(stage, records, n_top):
+    wall_time = np.array([r['wall_time'] for r in records])
+    n_sources = np.array([r.get('n_sources', 1) for r in records])
+    start = np.array([r['start'] for r in records])
+    status = Counter(r['status'] for r in records)
+
+    total_time = wall_time.sum()
+    elapsed = max(np.max(start + wall_time) - np.min(start), 1e-9)
+    logger.info(
+        f'{stage}: {len(records)} items ({n_sources.sum()} sources), '
+        + ', '.join(f'{n} {name}' for name, n in sorted(status.items())))
+    logger.info(
+        f'  {total_time / 3600:.2f} CPU hours in {elapsed / 3600:.2f} hours '
+        f'elapsed, {n_sources.sum() / elapsed:.2f} sources/sec overall, '
+        f'{n_sources.sum() / max(total_time, 1e-9):.3f} sources/sec per '
+        'worker')
+
+    pct = np.percentile(wall_time, [50, 90, 99])
+    logger.info(f'  time per item: median {pct[0]:.2f}, 90% {pct[1]:.2f}, '
+                f'99% {pct[2]:.2f}, max {wall_time.max():.2f} sec')
+
+    # The tail: how much of the time goes to the slowest 1% of items
+    n_tail = max(1, len(wall_time) // 100)
+    tail_time = np.sort(wall_time)[-n_tail:].sum()
+    logger.info(f'  the slowest {n_tail} items took '
+                f'{tail_time / max(total_time, 1e-9):.1%} of the time')
+
+    busy = defaultdict(float)
+    peak_rss = defaultdict(float)
+    for r in records:
+        name = (f"rank {r['rank']}" if r['rank'] is not None
+                else f"{r['host']}:{r['pid']}")
+        busy[name] += r['wall_time']
+        # (None for records of whole runs, see `record_run`)
+        peak_rss[name] = max(peak_rss[name], r['peak_rss'] or 0.)
+    busy_time = np.array(list(busy.values()))
+    logger.info(f'  {len(busy)} workers: busy time min '
+                f'{busy_time.min():.1f}, median {np.median(busy_time):.1f}, '
+                f'max {busy_time.max():.1f} sec; peak memory max '
+                f'{max(peak_rss.values()):.0f} MB')
+
+    for i in np.argsort(-wall_time, kind='stable')[:n_top]:
+        r = records[i]
+        extra = ', '.join(f'{k}={r[k]}'
+                          for k in ['n_visits', 'n_evals', 'n_samples']
+                          if r.get(k) is not None)
+        logger.info(f"  straggler {r['item']}: {r['wall_time']:.1f} sec "
+                    f"({r['status']}{', ' + extra if extra else ''})")
+
+    errors = Counter(r.get('error') for r in records
+                     if r['status'] == 'failed')
+    for error, n in errors.most_common(n_top):
+        logger.info(f'  {n} failed with {error}')
+
+    return total_time
+
+
+def summarize(records, n_top=10):
+    """
+    Log a summary of the telemetry records for each stage (see
+    `load_records`), and the sources that took the most time over all
+    stages.
+    """
+    totals = {}
+    for stage, stage_records in records.items():
+        if stage_records:
+            totals[stage] = _summarize_stage(stage, stage_records, n_top)
+
+    total_time = sum(totals.values())
+    if total_time <= 0:
+        logger.info('No telemetry records')
+        return
+
+    logger.info('Time per stage:')
+    for stage, t in sorted(totals.items(), key=lambda x: -x[1]):
+        logger.info(f'  {stage}: {t / 3600:.2f} CPU hours '
+                    f'({t / total_time:.1%})')
+
+    source_time = defaultdict(float)
+    for stage_records in records.values():
+        for r in stage_records:
+            if r.get('n_sources', 1) == 1:
+                source_time[r['item']] += r['wall_time']
+    top = sorted(source_time.items(), key=lambda x: -x[1])[:n_top]
+    if top:
+        logger.info('Sources with the most time over all stages:')
+        for source_id, t in top:
+            logger.info(f'  {source_id}: {t:.1f} sec')
+
+
+def record_run(conf, stage, start, exit_status=0):
+    """
+    Write a single record for a whole run of a stage that can't write
+    telemetry itself (e.g., an ``hq`` command), from the UNIX time it started
+    and its exit status. The item is the stage name, ``n_sources`` is 0
+    because the sources it processed are not known, and ``peak_rss`` is None
+    because the memory use of the run's processes is not known. The wall time
+    is the elapsed time of the run, so for an MPI run the CPU time in the
+    summary is the elapsed time, not summed over the ranks.
+    """
+    telemetry = get_telemetry(conf, stage)
+    fields = {'n_sources': 0,
+              'start': start,
+              'wall_time': time.time() - start,
+              'peak_rss': None}
+    if exit_status != 0:
+        fields['status'] = 'failed'
+        fields['error'] = f'exit status {exit_status}'
+    telemetry.write(stage, **fields)
+
+
+def main(run_path, stages=None, since=None, n_top=10, record_stage=None,
+         start=None, exit_status=0):
+    conf = Config(run_path / 'config.yml')
+
+    if record_stage is not None:
+        record_run(conf, record_stage, start, exit_status)
+        return
+
+    if since is not None:
+        since = datetime.datetime.fromisoformat(since).timestamp()
+    records = load_records(conf, stages=stages, since=since)
+    summarize(records, n_top=n_top)
+
+
+if __name__ == '__main__':
+    from hq.cli.helpers import get_parser
+
+    parser = get_parser(loggers=[logger])
+
+    parser.add_argument("--stage", dest="stages", default=None,
+                        action="append",
+                        help="Only summarize this stage (can be given more "
+                             "than once)")
+    parser.add_argument("--since", dest="since", default=None, type=str,
+                        help="Only use records after this (ISO format) "
+                             "date and time, e.g. 2021-06-01T12:00")
+    parser.add_argument("--top", dest="n_top", default=10, type=int,
+                        help="Number of stragglers to list")
+    parser.add_argument("--record-run", dest="record_stage", default=None,
+                        type=str,
+                        help="Instead of summarizing, write one record for a "
+                             "whole run of this stage (for commands that "
+                             "don't write telemetry, e.g. hq rerun_thejoker)")
+    parser.add_argument("--start", dest="start", default=None, type=float,
+                        help="With --record-run, the UNIX time the run "
+                             "started")
+    parser.add_argument("--exit-status", dest="exit_status", default=0,
+                        type=int,
+                        help="With --record-run, the exit status of the run")
+    args = parser.parse_args(sys.argv[1:])
+
+    main(run_path=args.run_path, stages=args.stages, since=args.since,
+         n_top=args.n_top, record_stage=args.record_stage, start=args.start,
+         exit_status=args.exit_status)
+
+    sys.exit(0)
@@ -0,0 +1,126 @@
+# Third-party
+import astropy.table as at
+from astropy.time import Time
+import astropy.units as u
+import numpy as np
+import thejoker as tj
+
+__all__ = ['VisitIndex', 'get_visit_index']
+
+
+def _normalize_source_ids(ids):
+    """
+    Return the input source ID(s) as (an array of) stripped ``str``. String
+    columns read from FITS files are bytes (e.g., ``|S18``) and may be padded
+    with spaces, so they would never compare equal to ``str`` IDs.
+    """
+    ids = np.asarray(ids)
+    if ids.dtype.kind == 'S':
+        ids = np.char.decode(ids)
+    if ids.dtype.kind == 'U':
+        ids = np.char.strip(ids)
+    if ids.ndim == 0:
+        return ids.item()
+    return ids
+
+
+class VisitIndex:
+    """
+    A view of a visit table grouped by source.
+
+    The table is sorted by source ID once (and only if it is not already
+    grouped), and the start row of each source is stored in an offset table.
+    Looking up the visits for a source is then a binary search plus a slice,
+    which returns a view of the underlying table rather than a copy.
+
+    Parameters
+    ----------
+    data : `~astropy.table.Table`
+        The visit table.
+    source_id_colname : str
+        The name of the column that uniquely identifies a source.
+    time_colname, time_format, time_scale, rv_colname, rv_error_colname : str
+        Used to turn the visits of a source into a `~thejoker.RVData`
+        instance (see `get_rvdata`).
+    """
+
+    def __init__(self, data, source_id_colname='APOGEE_ID',
+                 time_colname='JD', time_format='jd', time_scale='tdb',
+                 rv_colname='VHELIO', rv_error_colname='CALIB_VERR'):
+        ids = _normalize_source_ids(data[source_id_colname])
+        order = np.argsort(ids, kind='stable')
+        if np.any(order != np.arange(len(order))):
+            data = data[order]
+            ids = ids[order]
+
+        self.data = data
+        self.source_id_colname = source_id_colname
+        self.source_ids, offsets = np.unique(ids, return_index=True)
+        self.offsets = np.append(offsets, len(ids))
+
+        self.time_colname = time_colname
+        self.time_format = time_format
+        self.time_scale = time_scale
+        self.rv_colname = rv_colname
+        self.rv_error_colname = rv_error_colname
+
+    @classmethod
+    def from_config(cls, conf):
+        data = at.Table.read(conf.input_data_file,
+                             format=conf.input_data_format)
+        return cls(data,
+                   source_id_colname=conf.source_id_colname,
+                   time_colname=conf.time_colname,
+                   time_format=conf.time_format,
+                   time_scale=conf.time_scale,
+                   rv_colname=conf.rv_colname,
+                   rv_error_colname=conf.rv_error_colname)
+
+    def __len__(self):
+        return len(self.source_ids)
+
+    def __contains__(self, source_id):
+        source_id = _normalize_source_ids(source_id)
+        i = np.searchsorted(self.source_ids, source_id)
+        return i < len(self.source_ids) and self.source_ids[i] == source_id
+
+    def get_slice(self, source_id):
+        """
+        Return the slice of rows in ``data`` containing the visits for the
+        specified source.
+        """
+        source_id = _normalize_source_ids(source_id)
+        i = np.searchsorted(self.source_ids, source_id)
+        if i >= len(self.source_ids) or self.source_ids[i] != source_id:
+            raise KeyError(f"No visits for source {source_id}")
+        return slice(self.offsets[i], self.offsets[i+1])
+
+    def __getitem__(self, source_id):
+        return self.data[self.get_slice(source_id)]
+
+    def get_counts(self):
+        """The number of visits for each source in ``source_ids``."""
+        return np.diff(self.offsets)
+
+    def get_rvdata(self, source_id):
+        visits = self[source_id]
+        return tj.RVData(
+            Time(visits[self.time_colname],
+                 format=self.time_format,
+                 scale=self.time_scale),
+            u.Quantity(visits[self.rv_colname], u.km/u.s),
+            u.Quantity(visits[self.rv_error_colname], u.km/u.s))
+
+
+_visit_indices = {}
+
+
+def get_visit_index(conf):
+    """
+    Build (once per process) and return the grouped view of the visit data
+    file referenced by the input `hq.config.Config` instance.
+    """
+    key = (str(conf.input_data_file), conf.source_id_colname)
+    if key not in _visit_indices:
+        _visit_indices[key] = VisitIndex.from_config(conf)
+    return _visit_indices[key]